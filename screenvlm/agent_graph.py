@@ -1,24 +1,39 @@
 from typing import TypedDict, List, Any, Optional
 from langgraph.graph import StateGraph, END
 from PIL import Image
+from .config import settings
+from .tracing import tracer
 
 class AgentState(TypedDict):
+    request_id: Optional[str]
+    session_id: Optional[str]
     question: str
     image: Any
+    image_key: Optional[str]
+    resolution: Optional[dict]
     rag_enabled: bool
     context: List[dict]
     grade: str
     web_results: str
     final_response: str
 
+def traced(name, node):
+    """
+    Wrap a graph node so each run is recorded as a span under the request's id.
+    """
+    def run(state):
+        with tracer.span(name, state.get("request_id")):
+            return node(state)
+    return run
+
 def build_graph(worker):
     workflow = StateGraph(AgentState)
     
     # Add nodes
-    workflow.add_node("retrieve", worker.retrieve_node)
-    workflow.add_node("grade", worker.grade_node)
-    workflow.add_node("web_search", worker.web_search_node)
-    workflow.add_node("generate", worker.generate_node)
+    workflow.add_node("retrieve", traced("retrieve", worker.retrieve_node))
+    workflow.add_node("grade", traced("grade", worker.grade_node))
+    workflow.add_node("web_search", traced("web_search", worker.web_search_node))
+    workflow.add_node("generate", traced("generate", worker.generate_node))
     
     # Conditional Entry Point
     def route_start(state):
@@ -34,7 +49,34 @@ def build_graph(worker):
         }
     )
     
-    workflow.add_edge("retrieve", "grade")
+    # Retrieval scores settle the clear cases without a VLM grading pass
+    pass_score = float(settings.get("retrieval_pass_score", 0.75))
+    fail_score = float(settings.get("retrieval_fail_score", 0.4))
+
+    def route_retrieve(state):
+        context = state.get("context") or []
+        if not context:
+            return "web_search"
+        scores = [c["score"] for c in context if c.get("score") is not None]
+        if not scores:
+            return "grade"
+        top = max(scores)
+        if top >= pass_score:
+            return "generate"
+        if top < fail_score:
+            # An exact identifier match (error code, symbol name) is worth a grading pass; weak vector hits aren't
+            return "grade" if any(c.get("exact_match") for c in context) else "web_search"
+        return "grade"
+
+    workflow.add_conditional_edges(
+        "retrieve",
+        route_retrieve,
+        {
+            "generate": "generate",
+            "grade": "grade",
+            "web_search": "web_search"
+        }
+    )
     
     def route_grade(state):
         #add_conditiona_edge needs a function that returns a string and cant accept a string key directly
@@ -1,15 +1,16 @@
 import sys
 import threading
 import time
+import uuid
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                                QHBoxLayout, QTextEdit, QLineEdit, QPushButton, 
                                QCheckBox, QLabel, QScrollArea, QFrame)
 from PySide6.QtCore import Qt, Signal, QObject, Slot
-from PySide6.QtGui import QFont, QKeySequence, QShortcut
+from PySide6.QtGui import QFont, QKeySequence, QShortcut, QTextCursor
 
-from .config import settings
-from .capture import capture_fullscreen
-from .vlm.worker import VLMWorker
+from .config import settings, as_bool
+from .capture import capture_frame, active_window_rect, CaptureWatcher
+from .vlm.process_worker import create_worker
 
 class WorkerSignals(QObject):
     response_ready = Signal(object)
@@ -22,8 +23,18 @@ class ScreenVLMApp(QMainWindow):
         self.resize(400, 600)
         
         # Initialize components
-        self.worker = VLMWorker()
+        self.worker = create_worker()
         self.worker.start()
+
+        # Optional background capture so asking doesn't need hide/sleep/show
+        self.watcher = None
+        if as_bool(settings.get("watch_mode", False)):
+            self.watcher = CaptureWatcher(
+                fps=float(settings.get("watch_fps", 2.0)),
+                capacity=int(settings.get("watch_buffer_frames", 4)),
+                min_change_fraction=float(settings.get("change_min_fraction", 0.0)),
+            )
+            self.watcher.start()
         
         # Setup UI
         self.central_widget = QWidget()
@@ -34,6 +45,10 @@ class ScreenVLMApp(QMainWindow):
         self.output_area = QTextEdit()
         self.output_area.setReadOnly(True)
         self.layout.addWidget(self.output_area)
+        self._streaming = False
+        self._current_request = None
+        # Questions in one chat are follow-ups; "New Chat" starts a fresh session
+        self.session_id = uuid.uuid4().hex
         
         # Status Label
         self.status_label = QLabel("Ready")
@@ -47,6 +62,9 @@ class ScreenVLMApp(QMainWindow):
         self.input_box.setPlaceholderText("Ask a question about your screen...")
         self.input_box.returnPressed.connect(self.handle_ask)
         self.input_layout.addWidget(self.input_box)
+        # Focusing the input box brings an idle-offloaded model back before the question is sent
+        if as_bool(settings.get("prewarm_on_focus", True)):
+            QApplication.instance().focusChanged.connect(self.handle_focus_changed)
         
         self.ask_btn = QPushButton("Ask")
         self.ask_btn.clicked.connect(self.handle_ask)
@@ -59,6 +77,10 @@ class ScreenVLMApp(QMainWindow):
         self.rag_checkbox = QCheckBox("Use RAG")
         self.options_layout.addWidget(self.rag_checkbox)
         
+        self.new_chat_btn = QPushButton("New Chat")
+        self.new_chat_btn.clicked.connect(self.handle_new_chat)
+        self.options_layout.addWidget(self.new_chat_btn)
+
         self.ingest_btn = QPushButton("Ingest Docs")
         self.ingest_btn.clicked.connect(self.handle_ingest)
         self.options_layout.addWidget(self.ingest_btn)
@@ -88,44 +110,137 @@ class ScreenVLMApp(QMainWindow):
         self.status_label.setText("Capturing & Thinking...")
         
         # Capture screen
+        crop = None
+        try:
+            screenshot = self.watcher.latest() if self.watcher else None
+            if screenshot is None:
+                screenshot, crop = self.capture_hidden()
+        except Exception as e:
+            self.output_area.append(f"System: Capture failed: {e}")
+            self.status_label.setText("Error")
+            return
+
+        # Submit to worker
+        self.status_label.setText("Thinking...")
+        rag_enabled = self.rag_checkbox.isChecked()
+        if self._streaming:
+            self.output_area.append("[superseded]")
+            self._streaming = False
+        # A new question makes any answer still in progress stale
+        self._current_request = self.worker.submit_task(screenshot, question, rag_enabled=rag_enabled,
+                                                        supersede=True, session_id=self.session_id, crop=crop)
+
+    def handle_new_chat(self):
+        self.worker.cancel()
+        self.worker.reset_session(self.session_id)
+        self.session_id = uuid.uuid4().hex
+        self._current_request = None
+        self._streaming = False
+        self.output_area.clear()
+        self.status_label.setText("Ready")
+
+    def handle_focus_changed(self, old, new):
+        if new is self.input_box:
+            self.worker.prewarm()
+
+    def capture_hidden(self):
+        """
+        Returns (frame, crop). crop is the window that got focus once this
+        one was hidden, if resolution_crop is "active". In watch mode this
+        window stays in front, so there is no other active window to crop to.
+        """
         try:
             # Hide window to capture clean screenshot
             self.hide()
             QApplication.processEvents()
             time.sleep(0.2)  # Give OS time to repaint
             
-            screenshot = capture_fullscreen()
-        except Exception as e:
-            self.output_area.append(f"System: Capture failed: {e}")
-            self.status_label.setText("Error")
-            return
+            crop = active_window_rect() if settings.get("resolution_crop") == "active" else None
+            return capture_frame(), crop
         finally:
             self.show()
             self.activateWindow()
 
-        # Submit to worker
-        self.status_label.setText("Thinking...")
-        rag_enabled = self.rag_checkbox.isChecked()
-        self.worker.submit_task(screenshot, question, rag_enabled=rag_enabled)
+    def update_exclude_region(self):
+        # Geometry events can arrive before __init__ has created the watcher
+        if not getattr(self, "watcher", None):
+            return
+        if not self.isVisible():
+            self.watcher.set_exclude_region(None)
+            return
+        # Qt geometry is in logical pixels, mss works in physical ones
+        ratio = self.devicePixelRatioF()
+        geo = self.frameGeometry()
+        self.watcher.set_exclude_region((
+            int(geo.x() * ratio), int(geo.y() * ratio),
+            int(geo.width() * ratio) + 1, int(geo.height() * ratio) + 1,
+        ))
+
+    def moveEvent(self, event):
+        super().moveEvent(event)
+        self.update_exclude_region()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.update_exclude_region()
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.update_exclude_region()
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self.update_exclude_region()
 
     def handle_ingest(self):
         self.output_area.append("System: Ingestion triggers via CLI for now. Run `screenvlm ingest`.")
 
     def poll_worker(self):
-        # Check for results
-        result = self.worker.get_result(block=False)
-        if result:
+        # Drain everything that arrived since the last tick (streamed tokens come in bursts)
+        while True:
+            result = self.worker.get_result(block=False)
+            if not result:
+                break
             self.signals.response_ready.emit(result)
         
         # Reschedule
         self.timer = threading.Timer(0.1, self.poll_worker)
         self.timer.start()
 
+    def append_stream_text(self, text):
+        if not self._streaming:
+            self._streaming = True
+            self.output_area.append("Assistant: ")
+        cursor = self.output_area.textCursor()
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(text)
+        self.output_area.setTextCursor(cursor)
+        self.output_area.ensureCursorVisible()
+
     @Slot(object)
     def update_ui(self, result):
+        request_id = result.get("request_id")
+        if request_id is not None and request_id != self._current_request:
+            # Late events from a superseded question
+            return
+        if result.get("status") == "cancelled":
+            return
+
+        if result.get("status") == "partial":
+            self.status_label.setText("Answering...")
+            self.append_stream_text(result["text"])
+            return
+
+        streamed, self._streaming = self._streaming, False
         self.status_label.setText("Ready")
+        timings = result.get("timings")
+        if timings and timings.get("ttft") is not None:
+            self.status_label.setText(f"Ready (first token {timings['ttft']:.1f}s, done {timings['ttlt']:.1f}s)")
+
         if "response" in result:
-             self.output_area.append(f"Assistant: {result['response']}\n")
+             if not streamed:
+                 self.output_area.append(f"Assistant: {result['response']}")
+             self.output_area.append("")
              self.output_area.ensureCursorVisible()
         elif "error" in result:
              self.output_area.append(f"System Error: {result['error']}\n")
@@ -139,6 +254,9 @@ class ScreenVLMApp(QMainWindow):
 
     def closeEvent(self, event):
         self.timer.cancel()
+        self.worker.stop()
+        if self.watcher:
+            self.watcher.stop()
         event.accept()
 
 def main():
@@ -0,0 +1,366 @@
+import inspect
+import json
+import os
+import platform
+import subprocess
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .config import settings, as_bool
+from .perf import peak_rss_mb, percentiles
+from .tracing import tracer
+
+DEFAULT_RESOLUTIONS = [(1280, 720), (1920, 1080), (3840, 2160)]
+
+# Mirrors the SmolVLM chat format closely enough for prompt lengths to be realistic
+TINY_CHAT_TEMPLATE = (
+    "<|im_start|>{% for message in messages %}{{ message['role'] | capitalize }}"
+    "{% if message['content'][0]['type'] == 'image' %}{{ ':' }}{% else %}{{ ': ' }}{% endif %}"
+    "{% for line in message['content'] %}{% if line['type'] == 'text' %}{{ line['text'] }}"
+    "{% elif line['type'] == 'image' %}{{ '<image>' }}{% endif %}{% endfor %}<end_of_utterance>\n"
+    "{% endfor %}{% if add_generation_prompt %}{{ 'Assistant:' }}{% endif %}"
+)
+
+BENCH_QUESTIONS = [
+    "What application is open on the screen?",
+    "Summarize the error message shown in the dialog.",
+    "Which menu item is highlighted?",
+    "What is the value in the second column of the table?",
+]
+
+
+def synthetic_frame(width: int, height: int, seed: int = 0):
+    """
+    Deterministic BGRA frame that looks vaguely like a desktop: flat panels,
+    a title bar and rows of high-contrast "text" strokes.
+    """
+    from .capture.session import Frame
+
+    rng = np.random.default_rng(seed)
+    array = np.empty((height, width, 4), dtype=np.uint8)
+    array[...] = (236, 236, 236, 255)
+    array[: max(height // 30, 8)] = (60, 60, 60, 255)
+    for _ in range(12):
+        x0, y0 = rng.integers(0, width * 3 // 4), rng.integers(height // 20, height * 3 // 4)
+        w, h = rng.integers(width // 8, width // 3), rng.integers(height // 10, height // 3)
+        array[y0:y0 + h, x0:x0 + w, :3] = rng.integers(180, 255, size=3, dtype=np.uint8)
+        # text lines: short dark dashes on every other pixel row band
+        for line_y in range(y0 + 6, min(y0 + h, height) - 6, 14):
+            mask = rng.random(min(w, width - x0)) < 0.55
+            array[line_y:line_y + 7, x0:x0 + w][:, mask, :3] = 30
+    return Frame(array)
+
+
+def _vlm_classes():
+    try:
+        from transformers import (SmolVLMConfig, SmolVLMForConditionalGeneration,
+                                  SmolVLMImageProcessor, SmolVLMProcessor)
+        return SmolVLMConfig, SmolVLMForConditionalGeneration, SmolVLMImageProcessor, SmolVLMProcessor
+    except ImportError:
+        # Same architecture under its original name
+        from transformers import (Idefics3Config, Idefics3ForConditionalGeneration,
+                                  Idefics3ImageProcessor, Idefics3Processor)
+        return Idefics3Config, Idefics3ForConditionalGeneration, Idefics3ImageProcessor, Idefics3Processor
+
+
+def _tiny_tokenizer():
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+    from .vlm.worker import GRADE_LABELS, GRADE_PREFIX
+
+    specials = ["<unk>", "<|im_start|>", "<end_of_utterance>", "<|endoftext|>",
+                "<fake_token_around_image>", "<image>", "<global-img>"]
+    specials += [f"<row_{r}_col_{c}>" for r in range(1, 7) for c in range(1, 7)]
+    words = sorted({w.strip("?.,:").lower() for q in BENCH_QUESTIONS for w in q.split()})
+    # The grade labels and the JSON around them need real tokens, or logit grading can't tell them apart
+    pre_tokenizer = pre_tokenizers.Whitespace()
+    for text in [GRADE_PREFIX] + [json.dumps({"grade": label}) for label in GRADE_LABELS]:
+        words += [piece for piece, _ in pre_tokenizer.pre_tokenize_str(text)]
+    words += [chr(c) for c in range(33, 127)]
+    vocab = {tok: i for i, tok in enumerate(dict.fromkeys(specials + words))}
+
+    tok = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tok.pre_tokenizer = pre_tokenizer
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tok,
+        unk_token="<unk>",
+        bos_token="<|im_start|>",
+        eos_token="<end_of_utterance>",
+        pad_token="<|endoftext|>",
+        additional_special_tokens=specials[4:],
+    )
+
+
+def build_tiny_model(seed: int = 0):
+    """
+    Randomly initialised model with SmolVLM's layout (512px tiles, 16px patches,
+    pixel-shuffle factor 4, so 64 image tokens per tile) but tiny widths, plus a
+    processor built entirely offline.
+    """
+    import torch
+    ConfigCls, ModelCls, ImageProcessorCls, ProcessorCls = _vlm_classes()
+
+    tokenizer = _tiny_tokenizer()
+    kwargs = {"image_processor": ImageProcessorCls(), "tokenizer": tokenizer,
+              "chat_template": TINY_CHAT_TEMPLATE, "image_seq_len": 64}
+    if "video_processor" in inspect.signature(ProcessorCls.__init__).parameters:
+        try:
+            from transformers import SmolVLMVideoProcessor
+            kwargs["video_processor"] = SmolVLMVideoProcessor()
+        except ImportError:
+            pass
+    processor = ProcessorCls(**kwargs)
+
+    config = ConfigCls(
+        vision_config={"hidden_size": 64, "intermediate_size": 128, "num_hidden_layers": 2,
+                       "num_attention_heads": 4, "image_size": 512, "patch_size": 16},
+        text_config={"model_type": "llama", "vocab_size": len(tokenizer), "hidden_size": 128,
+                     "intermediate_size": 256, "num_hidden_layers": 2, "num_attention_heads": 4,
+                     "num_key_value_heads": 2, "max_position_embeddings": 16384,
+                     "pad_token_id": tokenizer.pad_token_id},
+        scale_factor=4,
+        image_token_id=tokenizer.convert_tokens_to_ids("<image>"),
+    )
+    torch.manual_seed(seed)
+    model = ModelCls(config).eval()
+    model.generation_config.eos_token_id = tokenizer.eos_token_id
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+    return model, processor
+
+
+def load_local_model(model_dir: str):
+    """
+    Load a real checkpoint from disk (e.g. a `screenvlm merge` output) without touching the hub.
+    """
+    import torch
+    from transformers import AutoModelForImageTextToText, AutoProcessor
+    processor = AutoProcessor.from_pretrained(model_dir, local_files_only=True)
+    model = AutoModelForImageTextToText.from_pretrained(model_dir, torch_dtype=torch.float32,
+                                                        local_files_only=True).eval()
+    return model, processor
+
+
+class BenchRetriever:
+    """
+    Stand-in for Retriever: exact cosine search over random unit vectors, with
+    query vectors from a seeded hash of the text. Measures the search path only.
+    """
+
+    def __init__(self, n_chunks: int = 2000, dim: int = 384, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.dim = dim
+        self.matrix = rng.standard_normal((n_chunks, dim)).astype(np.float32)
+        self.matrix /= np.linalg.norm(self.matrix, axis=1, keepdims=True)
+        self.texts = [f"Synthetic document chunk {i} describing screen element {i % 97}." for i in range(n_chunks)]
+
+    def _embed(self, query: str):
+        rng = np.random.default_rng(zlib.crc32(query.encode()))
+        vec = rng.standard_normal(self.dim).astype(np.float32)
+        return vec / np.linalg.norm(vec)
+
+    def retrieve(self, query: str, k: int = 4):
+        scores = self.matrix @ self._embed(query)
+        top = np.argpartition(-scores, k)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [{"text": self.texts[i], "source": "bench", "chunk_id": int(i) + 1, "score": float(scores[i])}
+                for i in top]
+
+
+def bench_web_search(question: str) -> List[dict]:
+    """
+    Stand-in for DDGS: fixed results after a small simulated delay.
+    """
+    time.sleep(0.05)
+    return [{"title": f"Result {i}", "href": f"https://example.invalid/{i}",
+             "body": f"Offline search snippet {i} for: {question}"} for i in range(3)]
+
+
+def _timed(fn, repeats: int):
+    times, result = [], None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return times, result
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__), timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def bench_capture(resolutions, repeats: int) -> dict:
+    from .capture.fingerprint import ChangeDetector
+    from .capture.session import CaptureSession
+
+    out = {}
+    try:
+        session = CaptureSession()
+        times, frame = _timed(session.grab, repeats)
+        out["live_grab"] = {"size": list(frame.size), "seconds": percentiles(times)}
+    except Exception as e:
+        out["live_grab"] = {"skipped": f"{e}"}
+
+    for width, height in resolutions:
+        frame = synthetic_frame(width, height)
+        detector = ChangeDetector()
+        fp_times, _ = _timed(lambda: detector.tag(frame), repeats)
+        pil_times, _ = _timed(frame.to_pil, repeats)
+        out[f"{width}x{height}"] = {"fingerprint_s": percentiles(fp_times), "to_pil_s": percentiles(pil_times)}
+    return out
+
+
+def bench_preprocess(processor, resolutions, repeats: int) -> dict:
+    out = {}
+    for width, height in resolutions:
+        image = synthetic_frame(width, height).to_pil()
+        times, inputs = _timed(lambda: processor.image_processor([[image]], return_tensors="pt"), repeats)
+        out[f"{width}x{height}"] = {"seconds": percentiles(times),
+                                    "tiles": int(inputs["pixel_values"].shape[1])}
+    return out
+
+
+def run_bench(resolutions=None, repeats: int = 5, requests: int = 12, max_new_tokens: int = 32,
+              model_dir: Optional[str] = None, seed: int = 0) -> dict:
+    import torch
+    from .vlm.cache import image_key
+    from .vlm.prompt import format_chat_messages
+    from .vlm.streaming import CallbackStreamer
+    from .vlm.loader import configure_cpu_threads, cpu_perf_enabled, optimize_for_cpu
+    from .vlm.worker import VLMWorker
+
+    resolutions = resolutions or DEFAULT_RESOLUTIONS
+    perf_mode = cpu_perf_enabled()
+    if perf_mode:
+        configure_cpu_threads()
+    results = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": _git_commit(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "cpu_count": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(),
+            "model": model_dir or "tiny-random-smolvlm",
+            "resolutions": [f"{w}x{h}" for w, h in resolutions],
+            "repeats": repeats,
+            "requests": requests,
+            "max_new_tokens": max_new_tokens,
+            "cpu_perf_mode": perf_mode,
+            "cpu_precision": settings.get("cpu_precision") if perf_mode else "fp32",
+            "cpu_compile": bool(perf_mode and as_bool(settings.get("cpu_compile", False))),
+            "seed": seed,
+        },
+        "stages": {},
+    }
+    stages = results["stages"]
+
+    print("Bench: capture...")
+    stages["capture"] = bench_capture(resolutions, repeats)
+
+    start = time.perf_counter()
+    model, processor = load_local_model(model_dir) if model_dir else build_tiny_model(seed)
+    if perf_mode:
+        model = optimize_for_cpu(model)
+    stages["model_load_s"] = time.perf_counter() - start
+
+    print("Bench: preprocessing...")
+    stages["preprocess"] = bench_preprocess(processor, resolutions, repeats)
+
+    print("Bench: retrieval...")
+    retriever = BenchRetriever(seed=seed)
+    times, _ = _timed(lambda: retriever.retrieve(BENCH_QUESTIONS[0]), max(repeats, 20))
+    stages["retrieve_s"] = percentiles(times)
+
+    worker = VLMWorker(loader=lambda: (model, processor, "cpu"), retriever=retriever, web_search=bench_web_search)
+    worker._max_new_tokens = max_new_tokens
+    worker.start()
+    while not worker.is_loaded():
+        failed = worker.get_result(block=False)
+        if failed and failed.get("status") == "error":
+            raise RuntimeError(failed["error"])
+        time.sleep(0.05)
+
+    frames = [synthetic_frame(w, h, seed=i) for i, (w, h) in enumerate(resolutions)]
+
+    print("Bench: grading...")
+    grade_times = []
+    for i in range(repeats):
+        frame = frames[i % len(frames)]
+        state = {"question": BENCH_QUESTIONS[i % len(BENCH_QUESTIONS)], "image": frame,
+                 "image_key": image_key(frame), "context": retriever.retrieve(BENCH_QUESTIONS[0])}
+        start = time.perf_counter()
+        worker.grade_node(state)
+        grade_times.append(time.perf_counter() - start)
+    stages["grade_s"] = percentiles(grade_times)
+    # The path that actually ran: logit grading falls back to generation if the labels can't be scored
+    results["meta"]["grade_mode"] = worker.grade_mode_used
+
+    print("Bench: generation...")
+    gen = []
+    for i in range(repeats):
+        frame = frames[i % len(frames)]
+        messages = format_chat_messages(BENCH_QUESTIONS[i % len(BENCH_QUESTIONS)])
+        prompt = processor.apply_chat_template(messages, add_generation_prompt=True)
+        streamer = CallbackStreamer(processor.tokenizer, lambda text: None)
+        worker._generate(prompt, frame, image_key(frame), streamer=streamer, max_new_tokens=max_new_tokens)
+        gen.append(streamer.timings())
+    stages["generate"] = {
+        "ttft_s": percentiles(t["ttft"] for t in gen),
+        "tokens_per_s": percentiles(t["tokens_per_s"] for t in gen),
+        "tokens": percentiles(t["tokens"] for t in gen),
+    }
+
+    print("Bench: end to end...")
+    latencies, ttfts = [], []
+    for i in range(requests):
+        frame = frames[i % len(frames)]
+        start = time.perf_counter()
+        worker.submit_task(frame, BENCH_QUESTIONS[i % len(BENCH_QUESTIONS)], rag_enabled=bool(i % 2))
+        while True:
+            result = worker.get_result(block=True)
+            if result["status"] != "partial":
+                break
+        latencies.append(time.perf_counter() - start)
+        if result.get("timings"):
+            ttfts.append(result["timings"]["ttft"])
+    stages["end_to_end_s"] = percentiles(latencies)
+    stages["end_to_end_ttft_s"] = percentiles(ttfts)
+    worker.stop()
+
+    results["peak_rss_mb"] = peak_rss_mb()
+    results["trace"] = tracer.snapshot()
+    return results
+
+
+def parse_resolutions(value: str) -> List[Tuple[int, int]]:
+    out = []
+    for item in value.split(","):
+        w, _, h = item.strip().lower().partition("x")
+        out.append((int(w), int(h)))
+    return out
+
+
+def bench_main(args):
+    results = run_bench(
+        resolutions=parse_resolutions(args.resolutions) if args.resolutions else None,
+        repeats=args.repeats,
+        requests=args.requests,
+        max_new_tokens=args.max_new_tokens,
+        model_dir=args.model_dir,
+        seed=args.seed,
+    )
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    stages = results["stages"]
+    print(f"\nEnd-to-end p50 {stages['end_to_end_s']['p50']:.3f}s  p95 {stages['end_to_end_s']['p95']:.3f}s  "
+          f"peak RSS {results['peak_rss_mb'] or float('nan'):.0f} MiB")
+    print(f"Results written to {args.out}")
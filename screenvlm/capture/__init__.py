@@ -1,24 +1,28 @@
 import sys
 import platform
 
+from .session import CaptureSession, Frame
+from .fingerprint import ChangeDetector
+from .watcher import CaptureWatcher
+
 if platform.system() == "Windows":
-    from .windows import capture_fullscreen
+    from .windows import capture_fullscreen, capture_frame, active_window_rect
 elif platform.system() == "Darwin":
-    from .macos import capture_fullscreen
+    from .macos import capture_fullscreen, capture_frame, active_window_rect
 else:
     # Fallback or Linux support
-    from .base import capture_fullscreen as base_capture
-    def capture_fullscreen(monitor=None):
+    from .base import capture_fullscreen as base_capture, active_window_rect
+    _session = CaptureSession(default_monitor=1, detector=ChangeDetector())
+
+    def capture_frame(monitor=None):
         print(f"Warning: Platform {platform.system()} not explicitly supported. Trying generic.")
         # Try windows/mss logic as generic
         try:
-            import mss
-            from PIL import Image
-            with mss.mss() as sct:
-                mon = monitor if monitor else 1
-                sct_img = sct.grab(sct.monitors[mon])
-                return Image.frombytes("RGB", sct_img.size, sct_img.bgra, "raw", "BGRX")
+            return _session.grab(monitor)
         except Exception as e:
              raise NotImplementedError(f"Capture not implemented for {platform.system()}: {e}")
 
-__all__ = ["capture_fullscreen"]
+    def capture_fullscreen(monitor=None):
+        return capture_frame(monitor).to_pil()
+
+__all__ = ["capture_fullscreen", "capture_frame", "active_window_rect", "CaptureSession", "CaptureWatcher", "ChangeDetector", "Frame"]
@@ -12,3 +12,18 @@ def capture_fullscreen(monitor: Optional[int] = None) -> Image.Image:
         PIL.Image of the screenshot.
     """
     raise NotImplementedError("Platform specific capture not implemented")
+
+def capture_frame(monitor: Optional[int] = None):
+    """
+    Capture the full screen without converting to PIL.
+
+    Returns:
+        capture.session.Frame viewing the raw BGRA pixels.
+    """
+    raise NotImplementedError("Platform specific capture not implemented")
+
+def active_window_rect():
+    """
+    (left, top, width, height) of the foreground window, or None if unknown.
+    """
+    return None
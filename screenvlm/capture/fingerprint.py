@@ -0,0 +1,122 @@
+import hashlib
+import threading
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+Region = Tuple[int, int, int, int]  # (x, y, width, height) in frame pixels
+
+
+def downsample(array: np.ndarray, step: int = 2) -> np.ndarray:
+    """
+    Strided luminance-ish sample of a BGRA frame: sum of B, G and R as uint16.
+    Lossy, so only used to find changed regions, never as a content key.
+    """
+    sample = array[::step, ::step, :3]
+    return sample.sum(axis=2, dtype=np.uint16)
+
+
+def fingerprint(array: np.ndarray) -> str:
+    """
+    Hash of a full-resolution frame buffer, every pixel and channel.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"frame:{array.shape}".encode())
+    h.update(np.ascontiguousarray(array).data)
+    return h.hexdigest()
+
+
+def changed_tiles(prev: np.ndarray, cur: np.ndarray, tile: int) -> np.ndarray:
+    """
+    Boolean (rows, cols) grid of tile x tile blocks where any sampled pixel differs.
+    """
+    diff = prev != cur
+    # Pad up to a whole number of tiles so the reshape below is exact
+    pad_h, pad_w = -diff.shape[0] % tile, -diff.shape[1] % tile
+    if pad_h or pad_w:
+        diff = np.pad(diff, ((0, pad_h), (0, pad_w)))
+    rows, cols = diff.shape[0] // tile, diff.shape[1] // tile
+    return diff.reshape(rows, tile, cols, tile).any(axis=(1, 3))
+
+
+def change_fraction(prev: np.ndarray, cur: np.ndarray, tile: int) -> float:
+    """
+    Share of tiles that differ between two downsampled frames; 1.0 if their sizes differ.
+    """
+    if prev.shape != cur.shape:
+        return 1.0
+    return float(changed_tiles(prev, cur, tile).mean())
+
+
+def tiles_to_regions(grid: np.ndarray, tile_px: int, size: Tuple[int, int]) -> List[Region]:
+    """
+    Merge horizontal runs of changed tiles into (x, y, width, height) rectangles,
+    clipped to the frame size.
+    """
+    width, height = size
+    regions = []
+    for row in range(grid.shape[0]):
+        cols = np.flatnonzero(grid[row])
+        if not len(cols):
+            continue
+        # split into runs of consecutive columns
+        breaks = np.flatnonzero(np.diff(cols) > 1)
+        starts = np.concatenate(([cols[0]], cols[breaks + 1]))
+        ends = np.concatenate((cols[breaks], [cols[-1]]))
+        y = row * tile_px
+        h = min(tile_px, height - y)
+        for c0, c1 in zip(starts, ends):
+            x = int(c0) * tile_px
+            w = min((int(c1) + 1) * tile_px, width) - x
+            regions.append((x, y, w, h))
+    return regions
+
+
+class ChangeDetector:
+    """
+    Tags frames with a content fingerprint (a hash of the full-resolution
+    buffer) and the regions that changed since the last fingerprinted frame,
+    using a vectorized diff of a downsampled copy.
+
+    Only when min_change_fraction is set and fewer tiles than that changed is
+    the previous fingerprint carried over, so downstream caches treat the
+    frame as the same screen. Changes are always measured against the frame
+    that produced the current fingerprint, so small edits can't drift the key.
+    """
+
+    def __init__(self, step: int = 2, tile: int = 64, min_change_fraction: float = 0.0):
+        self.step = max(int(step), 1)
+        self.tile = max(int(tile) // self.step, 1)
+        self.min_change_fraction = float(min_change_fraction)
+        self._prev: Optional[np.ndarray] = None
+        self._prev_fingerprint: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def tag(self, frame) -> bool:
+        """
+        Set frame.fingerprint and frame.changed_regions. Returns True if the
+        frame got a new fingerprint.
+        """
+        sample = downsample(frame.array, self.step)
+        with self._lock:
+            prev = self._prev
+            if prev is None or prev.shape != sample.shape:
+                frame.changed_regions = [(0, 0, frame.size[0], frame.size[1])]
+            else:
+                grid = changed_tiles(prev, sample, self.tile)
+                frame.changed_regions = tiles_to_regions(grid, self.tile * self.step, frame.size)
+                if self.min_change_fraction > 0 and grid.mean() < self.min_change_fraction:
+                    frame.fingerprint = self._prev_fingerprint
+                    return False
+
+            # The sample skips pixels and merges channels, so the key always hashes the full buffer
+            key = fingerprint(frame.array)
+            new = key != self._prev_fingerprint
+            self._prev = sample
+            frame.fingerprint = self._prev_fingerprint = key
+            return new
+
+    def reset(self):
+        with self._lock:
+            self._prev = None
+            self._prev_fingerprint = None
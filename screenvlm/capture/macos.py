@@ -1,32 +1,51 @@
-import mss
 from PIL import Image
-from typing import Optional
-import sys
+from typing import Optional, Tuple
+from .session import CaptureSession, Frame
+from .fingerprint import ChangeDetector
+from ..tracing import tracer
+
+_session = CaptureSession(default_monitor=1, detector=ChangeDetector())
+
+def capture_frame(monitor: Optional[int] = None) -> Frame:
+    try:
+        with tracer.span("capture") as span:
+            frame = _session.grab(monitor)
+            span["width"], span["height"] = frame.size
+    except Exception as e:
+        print(f"Capture failed: {e}")
+        print("Enable Screen & System Audio Recording permission for this app in System Settings -> Privacy & Security.")
+        raise e
+
+    # Check for permission issues (all black or empty)
+    # This is a basic heuristic.
+    if not frame.array[..., :3].any():
+        print("Warning: Screenshot appears blank. Check usage permissions.")
+        print("Enable Screen & System Audio Recording permission for this app in System Settings -> Privacy & Security.")
+
+    return frame
+
+def active_window_rect() -> Optional[Tuple[int, int, int, int]]:
+    """
+    (left, top, width, height) of the frontmost app's main window, or None.
+    Needs pyobjc (Quartz); without it no window crop is applied.
+    """
+    try:
+        import Quartz
+        from AppKit import NSScreen, NSWorkspace
+        pid = NSWorkspace.sharedWorkspace().frontmostApplication().processIdentifier()
+        windows = Quartz.CGWindowListCopyWindowInfo(
+            Quartz.kCGWindowListOptionOnScreenOnly | Quartz.kCGWindowListExcludeDesktopElements,
+            Quartz.kCGNullWindowID,
+        )
+        for info in windows:
+            if info.get("kCGWindowOwnerPID") == pid and info.get("kCGWindowLayer") == 0:
+                bounds = info["kCGWindowBounds"]
+                # window bounds are in points, captures in (Retina) pixels
+                scale = NSScreen.mainScreen().backingScaleFactor()
+                return tuple(int(bounds[k] * scale) for k in ("X", "Y", "Width", "Height"))
+    except Exception:
+        pass
+    return None
 
 def capture_fullscreen(monitor: Optional[int] = None) -> Image.Image:
-    with mss.mss() as sct:
-        if monitor is None:
-            monitor_idx = 1
-        else:
-            monitor_idx = monitor
-            
-        try:
-            sct_img = sct.grab(sct.monitors[monitor_idx])
-            img = Image.frombytes("RGB", sct_img.size, sct_img.bgra, "raw", "BGRX")
-            
-            # Check for permission issues (all black or empty)
-            # This is a basic heuristic.
-            if not img.getbbox():
-                 print("Warning: Screenshot appears blank. Check usage permissions.")
-                 print("Enable Screen & System Audio Recording permission for this app in System Settings -> Privacy & Security.")
-            
-            return img
-        except IndexError:
-             print(f"Monitor {monitor_idx} not found, defaulting to 1")
-             sct_img = sct.grab(sct.monitors[1])
-             img = Image.frombytes("RGB", sct_img.size, sct_img.bgra, "raw", "BGRX")
-             return img
-        except Exception as e:
-            print(f"Capture failed: {e}")
-            print("Enable Screen & System Audio Recording permission for this app in System Settings -> Privacy & Security.")
-            raise e
+    return capture_frame(monitor).to_pil()
@@ -0,0 +1,113 @@
+import threading
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+from .fingerprint import ChangeDetector
+
+
+class Frame:
+    """
+    A captured screen frame.
+
+    `array` is a (height, width, 4) BGRA uint8 array that views the grab
+    buffer directly, no copy is made until to_pil() is called.
+
+    `fingerprint` and `changed_regions` are filled in by a ChangeDetector,
+    if the session has one.
+    """
+
+    def __init__(self, array: np.ndarray, monitor: int = 1, left: int = 0, top: int = 0):
+        self.array = array
+        self.monitor = monitor
+        self.left = left
+        self.top = top
+        self.fingerprint = None
+        self.changed_regions = None
+
+    @property
+    def size(self):
+        return (self.array.shape[1], self.array.shape[0])
+
+    @property
+    def memory(self) -> memoryview:
+        return memoryview(self.array)
+
+    def copy(self) -> "Frame":
+        frame = Frame(self.array.copy(), self.monitor, self.left, self.top)
+        frame.fingerprint = self.fingerprint
+        frame.changed_regions = self.changed_regions
+        return frame
+
+    def to_pil(self) -> Image.Image:
+        """
+        Convert to an RGB PIL image. This is the only full-frame copy.
+        """
+        array = np.ascontiguousarray(self.array)
+        return Image.frombuffer("RGB", self.size, array, "raw", "BGRX", 0, 1)
+
+
+class CaptureSession:
+    """
+    Long-lived screen grabber.
+
+    mss handles are not safe to share between threads, so one grabber is
+    opened lazily per thread and kept for the life of the session.
+
+    If a ChangeDetector is given, every grabbed frame is tagged with a
+    content fingerprint and the regions changed since the last new frame.
+    """
+
+    def __init__(self, default_monitor: int = 1, detector: Optional[ChangeDetector] = None):
+        self.default_monitor = default_monitor
+        self.detector = detector
+        self._local = threading.local()
+
+    def _grabber(self):
+        sct = getattr(self._local, "sct", None)
+        if sct is None:
+            import mss
+            sct = mss.mss()
+            self._local.sct = sct
+        return sct
+
+    @property
+    def monitors(self):
+        return self._grabber().monitors
+
+    def grab(self, monitor: Optional[int] = None, out: Optional[np.ndarray] = None) -> Frame:
+        """
+        Grab a monitor (mss numbering: 0 is all monitors, 1 is primary).
+
+        Without `out` the frame views the grab buffer directly. With `out` the
+        pixels are copied into that preallocated (height, width, 4) uint8 array
+        instead, which lets callers recycle their own buffers.
+        """
+        sct = self._grabber()
+        monitor_idx = self.default_monitor if monitor is None else monitor
+        try:
+            mon = sct.monitors[monitor_idx]
+        except IndexError:
+            print(f"Monitor {monitor_idx} not found, defaulting to 1")
+            monitor_idx = 1
+            mon = sct.monitors[1]
+
+        sct_img = sct.grab(mon)
+        width, height = sct_img.size
+        array = np.frombuffer(sct_img.raw, dtype=np.uint8).reshape(height, width, 4)
+        if out is not None:
+            if out.shape != array.shape:
+                raise ValueError(f"Frame buffer shape {out.shape} does not match capture {array.shape}")
+            np.copyto(out, array)
+            array = out
+        frame = Frame(array, monitor_idx, mon["left"], mon["top"])
+        if self.detector is not None:
+            self.detector.tag(frame)
+        return frame
+
+    def close(self):
+        sct = getattr(self._local, "sct", None)
+        if sct is not None:
+            sct.close()
+            self._local.sct = None
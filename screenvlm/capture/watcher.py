@@ -0,0 +1,122 @@
+import threading
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .session import CaptureSession, Frame
+from .fingerprint import ChangeDetector
+
+
+class CaptureWatcher:
+    """
+    Captures the screen on a background thread into a fixed-size ring buffer
+    so a clean frame is available the moment the user asks.
+
+    The assistant's own window can be masked out with set_exclude_region(),
+    and frames that haven't changed since the last stored one are dropped.
+    """
+
+    def __init__(self, fps: float = 2.0, capacity: int = 4, monitor: Optional[int] = None,
+                 min_change_fraction: float = 0.0):
+        self.interval = 1.0 / max(float(fps), 0.1)
+        self.capacity = max(int(capacity), 2)
+        self.monitor = monitor
+        self._session = CaptureSession()
+        self._slots = []
+        self._frames = [None] * self.capacity
+        self._head = -1
+        # Runs on the masked frame, so our own window repainting doesn't count as a change
+        self._detector = ChangeDetector(min_change_fraction=min_change_fraction)
+        self._last_check = 0.0
+        self._exclude: Optional[Tuple[int, int, int, int]] = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.frames_stored = 0
+        self.frames_skipped = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+            self._thread = None
+
+    def set_exclude_region(self, region: Optional[Tuple[int, int, int, int]]):
+        """
+        region is (left, top, width, height) in screen pixels, or None.
+        Call this from the GUI thread whenever the window moves, resizes or hides.
+        """
+        with self._lock:
+            self._exclude = region
+
+    def latest(self) -> Optional[Frame]:
+        """
+        Return a copy of the newest stored frame, or None if the watcher
+        hasn't checked the screen recently enough to trust it.
+        """
+        with self._lock:
+            if self._head < 0 or time.monotonic() - self._last_check > 3 * self.interval:
+                return None
+            frame = self._frames[self._head]
+            return frame.copy() if frame is not None else None
+
+    def _slot(self, index: int, shape) -> np.ndarray:
+        if not self._slots or self._slots[0].shape != shape:
+            # Resolution changed (or first frame): reallocate the ring
+            self._slots = [np.empty(shape, dtype=np.uint8) for _ in range(self.capacity)]
+            self._frames = [None] * self.capacity
+            self._head = -1
+            self._detector.reset()
+        return self._slots[index]
+
+    def _mask(self, frame: Frame, region):
+        left, top, width, height = region
+        x0 = max(left - frame.left, 0)
+        y0 = max(top - frame.top, 0)
+        x1 = min(left - frame.left + width, frame.size[0])
+        y1 = min(top - frame.top + height, frame.size[1])
+        if x1 > x0 and y1 > y0:
+            frame.array[y0:y1, x0:x1] = 0
+
+    def _capture_once(self):
+        grabbed = self._session.grab(self.monitor)
+        with self._lock:
+            index = (self._head + 1) % self.capacity
+            slot = self._slot(index, grabbed.array.shape)
+            region = self._exclude
+
+        # Writing into the slot after head is safe: readers only touch self._frames[self._head]
+        np.copyto(slot, grabbed.array)
+        frame = Frame(slot, grabbed.monitor, grabbed.left, grabbed.top)
+        if region is not None:
+            self._mask(frame, region)
+
+        self._detector.tag(frame)
+        with self._lock:
+            self._last_check = time.monotonic()
+            # Small changes below min_change_fraction keep the old fingerprint
+            # but are still stored, so the pixels we hand out are current
+            if not frame.changed_regions:
+                self.frames_skipped += 1
+                return
+            self._frames[index] = frame
+            self._head = index
+            self.frames_stored += 1
+
+    def _run_loop(self):
+        while not self._stop_event.is_set():
+            started = time.monotonic()
+            try:
+                self._capture_once()
+            except Exception as e:
+                print(f"Watcher: Capture failed: {e}")
+            self._stop_event.wait(max(0.0, self.interval - (time.monotonic() - started)))
+        self._session.close()
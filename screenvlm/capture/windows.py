@@ -1,30 +1,35 @@
-import mss
 from PIL import Image
-from typing import Optional
+from typing import Optional, Tuple
+from .session import CaptureSession, Frame
+from .fingerprint import ChangeDetector
+from ..tracing import tracer
+
+# mss monitors list: 0 is all, 1 is 1st, 2 is 2nd...
+# Default to the primary monitor (1) when the caller doesn't specify one.
+_session = CaptureSession(default_monitor=1, detector=ChangeDetector())
+
+def capture_frame(monitor: Optional[int] = None) -> Frame:
+    with tracer.span("capture") as span:
+        frame = _session.grab(monitor)
+        span["width"], span["height"] = frame.size
+    return frame
+
+def active_window_rect() -> Optional[Tuple[int, int, int, int]]:
+    """
+    (left, top, width, height) of the foreground window in physical pixels, or None.
+    """
+    try:
+        import ctypes
+        from ctypes import wintypes
+        user32 = ctypes.windll.user32
+        hwnd = user32.GetForegroundWindow()
+        rect = wintypes.RECT()
+        if not hwnd or not user32.GetWindowRect(hwnd, ctypes.byref(rect)):
+            return None
+        width, height = rect.right - rect.left, rect.bottom - rect.top
+        return (rect.left, rect.top, width, height) if width > 0 and height > 0 else None
+    except Exception:
+        return None
 
 def capture_fullscreen(monitor: Optional[int] = None) -> Image.Image:
-    with mss.mss() as sct:
-        if monitor is None:
-            monitor_idx = -1  # All monitors
-            # But spec says "primary", mss uses 1 for primary? 
-            # Actually mss: 1 is primary. -1 is all.
-            # Let's default to primary content monitor if not specified? 
-            # Or usually users want the screen they are looking at.
-            # To be safe and simple, let's use monitor 1 (primary) as default if None.
-            monitor_idx = 1 
-        else:
-            monitor_idx = monitor
-            
-        # mss monitors list: 0 is all, 1 is 1st, 2 is 2nd...
-        # If user asks for 1, we give 1.
-        
-        try:
-            sct_img = sct.grab(sct.monitors[monitor_idx])
-            img = Image.frombytes("RGB", sct_img.size, sct_img.bgra, "raw", "BGRX")
-            return img
-        except IndexError:
-             # Fallback to 1 if index out of bounds
-             print(f"Monitor {monitor_idx} not found, defaulting to 1")
-             sct_img = sct.grab(sct.monitors[1])
-             img = Image.frombytes("RGB", sct_img.size, sct_img.bgra, "raw", "BGRX")
-             return img
+    return capture_frame(monitor).to_pil()
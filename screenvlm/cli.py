@@ -18,7 +18,98 @@ def run_command(args):
     from .app import main as app_main
     app_main()
 
+def host_port(value: str):
+    """
+    argparse type for --server: "host:port" or ":port" -> (host, port).
+    """
+    host, sep, port = value.rpartition(":")
+    if not sep or not port.isdigit() or not 0 < int(port) < 65536:
+        raise argparse.ArgumentTypeError(f"expected host:port, got {value!r}")
+    return host or "127.0.0.1", int(port)
+
+def ask_via_server(args):
+    from .client import ScreenVLMClient
+    if args.unix_socket:
+        client = ScreenVLMClient(unix_path=args.unix_socket)
+    else:
+        host, port = args.server
+        client = ScreenVLMClient(host, port)
+    streamed = False
+    try:
+        for event in client.ask_stream(args.question, image_path=args.image, rag=args.rag):
+            if event["status"] == "partial":
+                if not streamed:
+                    print("Assistant: ", end="", flush=True)
+                    streamed = True
+                print(event["text"], end="", flush=True)
+            elif event["status"] == "success":
+                if not streamed:
+                    print(f"Assistant: {event['response']}", end="")
+                print()
+                timings = event.get("timings")
+                if timings and timings.get("ttft") is not None:
+                    print(f"[time to first token {timings['ttft']:.2f}s, last token {timings['ttlt']:.2f}s, {timings['tokens']} tokens]")
+            else:
+                print(f"\nError: {event.get('error', event['status'])}")
+                sys.exit(1)
+    except (OSError, RuntimeError) as e:
+        where = args.unix_socket or "%s:%d" % args.server
+        print(f"\nError: Request to the server at {where} failed: {e}")
+        sys.exit(1)
+
+def ask_command(args):
+    if args.server or args.unix_socket:
+        ask_via_server(args)
+        return
+
+    if args.image:
+        from PIL import Image
+        image = Image.open(args.image).convert("RGB")
+    else:
+        from .capture import capture_frame
+        image = capture_frame(args.monitor)
+
+    from .vlm.process_worker import create_worker
+    worker = create_worker()
+    worker.start()
+    worker.submit_task(image, args.question, rag_enabled=args.rag)
+
+    # Print tokens as they stream in; everything else the worker logs goes to stdout too
+    streamed = False
+    while True:
+        result = worker.get_result(block=True)
+        if result["status"] == "partial":
+            if not streamed:
+                print("\nAssistant: ", end="", flush=True)
+                streamed = True
+            print(result["text"], end="", flush=True)
+            continue
+        if result["status"] == "cancelled":
+            print("\nCancelled.")
+            sys.exit(1)
+        if result["status"] == "success":
+            if not streamed:
+                print(f"\nAssistant: {result['response']}", end="")
+            print()
+            timings = result.get("timings")
+            if timings and timings.get("ttft") is not None:
+                print(f"[time to first token {timings['ttft']:.2f}s, last token {timings['ttlt']:.2f}s, {timings['tokens']} tokens]")
+        else:
+            print(f"Error: {result.get('error')}")
+            sys.exit(1)
+        break
+
+def serve_command(args):
+    from .server import serve
+    serve(args.host, args.port, args.unix_socket, args.max_queue, args.timeout)
+
+def bench_command(args):
+    from .bench import bench_main
+    bench_main(args)
+
 def ingest_command(args):
+    from .rag.store import default_store_dir
+    args.persist = args.persist or default_store_dir()
     print(f"Ingesting docs from {args.docs} to {args.persist}...")
     if args.rebuild:
         print("Rebuild flag set.")
@@ -26,10 +117,14 @@ def ingest_command(args):
     from .rag.ingest import ingest_docs
     ingest_docs(args.docs, args.persist, args.rebuild)
 
+def migrate_store_command(args):
+    from .rag.store import migrate_from_chroma
+    migrate_from_chroma(args.chroma, args.out)
+
 def merge_command(args):
     print(f"Merging adapter to {args.out} with dtype {args.dtype}...")
     from .vlm.loader import merge_adapter
-    merge_adapter(args.out, args.dtype)
+    merge_adapter(args.out, args.dtype, args.shard_mb)
 
 def doctor_command(args):
     print("Running doctor checks...")
@@ -86,30 +181,73 @@ def main():
     run_parser = subparsers.add_parser("run", help="Launch the UI app")
     run_parser.add_argument("--model", type=str, help="HuggingFace model ID to use")
 
+    # ask
+    ask_parser = subparsers.add_parser("ask", help="Ask one question about the screen (or an image) and stream the answer")
+    ask_parser.add_argument("question", help="Question to ask")
+    ask_parser.add_argument("--image", help="Use this image file instead of capturing the screen")
+    ask_parser.add_argument("--monitor", type=int, default=None, help="Monitor to capture (mss numbering, 1 = primary)")
+    ask_parser.add_argument("--rag", action="store_true", help="Use retrieved context")
+    ask_parser.add_argument("--server", type=host_port, help="Send the question to a running `serve` instance (host:port)")
+    ask_parser.add_argument("--unix-socket", help="Send the question to a `serve` instance on this Unix socket")
+
+    # serve
+    serve_parser = subparsers.add_parser("serve", help="Keep the model loaded and answer questions over a local HTTP API")
+    serve_parser.add_argument("--host", default="127.0.0.1", help="Address to bind (loopback by default)")
+    serve_parser.add_argument("--port", type=int, default=8765, help="TCP port")
+    serve_parser.add_argument("--unix-socket", help="Listen on this Unix socket path instead of TCP")
+    serve_parser.add_argument("--max-queue", type=int, default=8, help="Requests allowed to wait before returning 503")
+    serve_parser.add_argument("--timeout", type=float, default=120.0, help="Per-request timeout in seconds")
+
     # ingest
     ingest_parser = subparsers.add_parser("ingest", help="Ingest documents for RAG")
     ingest_parser.add_argument("--docs", default=settings["docs_dir"], help="Path to documents")
-    ingest_parser.add_argument("--persist", default=settings["chroma_dir"], help="Path to Chroma DB")
-    ingest_parser.add_argument("--rebuild", action="store_true", help="Rebuild index")
+    ingest_parser.add_argument("--persist", help="Path to the vector store (default: vector_dir, or chroma_dir with vector_store: chroma)")
+    ingest_parser.add_argument("--rebuild", action="store_true", help="Rebuild index from scratch (default: only new, changed and removed files)")
+
+    # migrate-store
+    migrate_parser = subparsers.add_parser("migrate-store", help="Copy a Chroma DB into the built-in flat vector store")
+    migrate_parser.add_argument("--chroma", default=settings["chroma_dir"], help="Chroma DB to read")
+    migrate_parser.add_argument("--out", default=settings["vector_dir"], help="Flat store to write")
 
     # merge
     merge_parser = subparsers.add_parser("merge", help="Merge adapter into base model")
-    merge_parser.add_argument("--out", required=True, help="Output directory")
-    merge_parser.add_argument("--dtype", choices=["bf16", "fp16", "fp32"], default="fp16", help="Data type")
+    merge_parser.add_argument("--out", default=settings["merged_dir"],
+                              help="Output directory (default: merged_dir, which the app loads from)")
+    merge_parser.add_argument("--dtype", choices=["bf16", "fp16", "fp32", "int8"], default="fp16",
+                              help="Data type (int8: quantized Linear weights, loaded as int8 on CPU)")
+    merge_parser.add_argument("--shard-mb", type=int, default=512, help="Max size of each output shard")
 
     # doctor
     subparsers.add_parser("doctor", help="Check system health")
 
+    # bench
+    bench_parser = subparsers.add_parser("bench", help="Benchmark each pipeline stage offline and write JSON results")
+    bench_parser.add_argument("--out", default="bench_results.json", help="Where to write the JSON results")
+    bench_parser.add_argument("--resolutions", help="Comma separated WxH list (default 1280x720,1920x1080,3840x2160)")
+    bench_parser.add_argument("--repeats", type=int, default=5, help="Repetitions per stage")
+    bench_parser.add_argument("--requests", type=int, default=12, help="End-to-end requests to time")
+    bench_parser.add_argument("--max-new-tokens", type=int, default=32, help="Answer length for generation stages")
+    bench_parser.add_argument("--model-dir", help="Local checkpoint to bench instead of the tiny random model")
+    bench_parser.add_argument("--seed", type=int, default=0, help="Seed for synthetic screens and weights")
+
     args = parser.parse_args()
 
     if args.command == "run":
         run_command(args)
+    elif args.command == "ask":
+        ask_command(args)
+    elif args.command == "serve":
+        serve_command(args)
     elif args.command == "ingest":
         ingest_command(args)
+    elif args.command == "migrate-store":
+        migrate_store_command(args)
     elif args.command == "merge":
         merge_command(args)
     elif args.command == "doctor":
         doctor_command(args)
+    elif args.command == "bench":
+        bench_command(args)
 
 if __name__ == "__main__":
     main()
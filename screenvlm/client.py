@@ -0,0 +1,87 @@
+import base64
+import http.client
+import json
+import socket
+from typing import Iterator, Optional
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+
+class ScreenVLMClient:
+    """
+    Minimal client for `screenvlm serve`, over TCP loopback or a Unix socket.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8765, unix_path: Optional[str] = None,
+                 timeout: float = 300.0):
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+        self.timeout = timeout
+
+    def _connection(self):
+        if self.unix_path:
+            return _UnixHTTPConnection(self.unix_path, self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _body(self, question, image_path=None, rag=False, stream=False, timeout=None):
+        body = {"question": question, "rag": rag, "stream": stream}
+        if image_path:
+            with open(image_path, "rb") as f:
+                body["image"] = base64.b64encode(f.read()).decode("ascii")
+        if timeout is not None:
+            body["timeout"] = timeout
+        return json.dumps(body)
+
+    def health(self) -> dict:
+        conn = self._connection()
+        try:
+            conn.request("GET", "/health")
+            return json.loads(conn.getresponse().read())
+        finally:
+            conn.close()
+
+    def ask(self, question: str, image_path: Optional[str] = None, rag: bool = False,
+            timeout: Optional[float] = None) -> dict:
+        """
+        Returns {"request_id", "response", "timings"}; raises RuntimeError on HTTP errors.
+        """
+        conn = self._connection()
+        try:
+            conn.request("POST", "/ask", self._body(question, image_path, rag, False, timeout),
+                         {"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            data = json.loads(resp.read() or b"{}")
+            if resp.status != 200:
+                raise RuntimeError(f"Server returned {resp.status}: {data.get('error')}")
+            return data
+        finally:
+            conn.close()
+
+    def ask_stream(self, question: str, image_path: Optional[str] = None, rag: bool = False,
+                   timeout: Optional[float] = None) -> Iterator[dict]:
+        """
+        Yield worker events ("partial", then "success"/"error"/"cancelled") as they arrive.
+        """
+        conn = self._connection()
+        try:
+            conn.request("POST", "/ask", self._body(question, image_path, rag, True, timeout),
+                         {"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            if resp.status != 200:
+                data = json.loads(resp.read() or b"{}")
+                raise RuntimeError(f"Server returned {resp.status}: {data.get('error')}")
+            for line in resp:
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            conn.close()
@@ -13,9 +13,86 @@ DEFAULT_MODEL_ID = "HuggingFaceTB/SmolVLM2-500M-Video-Instruct"
 DEFAULTS = {
     "base_model_id": DEFAULT_MODEL_ID,
     "adapter_dir": str(DEFAULT_ADAPTER_DIR / f"vlm_qlora_{DEFAULT_MODEL_ID.split('/')[-1]}"),
+    # "auto", "cuda", "mps", "cpu", or "cpu-fast" (CPU with the performance options below)
     "device_pref": "auto",
+    # CPU performance mode: "auto" precision is bf16 on CPUs with native support, else int8
+    "cpu_perf_mode": False,
+    "cpu_precision": "auto",
+    "cpu_compile": False,
+    # 0 = torch default
+    "cpu_threads": 0,
+    "cpu_interop_threads": 0,
+    # Run a tiny generate at startup (defaults to on in CPU performance mode)
+    "warmup": None,
+    # Free the model after this many idle minutes (0 = never). "release" drops it and reloads
+    # (fast from the merged checkpoint); "cpu" parks CUDA weights in pinned host memory.
+    # In CPU performance mode only the caches are freed, the prepared (quantized/compiled) model stays
+    "idle_offload_minutes": 0,
+    "offload_mode": "release",
+    # Bring an offloaded model back as soon as the question box gets focus
+    "prewarm_on_focus": True,
+    # Vector store for RAG: "flat" (built-in, memory-mapped; migrates an existing chroma_dir
+    # on first use) or "chroma". Above ivf_min_rows chunks, flat search probes ivf_nprobe clusters
+    "vector_store": "flat",
+    "vector_dir": str(DEFAULT_CONFIG_DIR / "vectors"),
+    "ivf_min_rows": 20000,
+    "ivf_nprobe": 8,
     "chroma_dir": str(DEFAULT_CONFIG_DIR / "chroma"),
+    # `screenvlm merge` output; loaded instead of base + adapter while it matches both
+    "merged_dir": str(DEFAULT_CONFIG_DIR / "merged"),
+    "prefer_merged": True,
     "docs_dir": str(Path.home() / "screenvlm_docs"),
+    # Ingestion: parsing processes (0 = all cores but one) and chunks per embedding batch
+    "ingest_workers": 0,
+    "embed_batch_size": 64,
+    # Sentence-transformers model shared by ingestion and retrieval, and its query-vector cache
+    "embedding_model": "all-MiniLM-L6-v2",
+    "query_cache_size": 256,
+    "query_batch_window_ms": 2.0,
+    # Number of recent screenshots whose vision features are kept between questions (0 = per question only)
+    "vision_cache_size": 2,
+    # Memory for cached prompt-prefix key/values (system rules, screenshot + context); 0 = off
+    "kv_cache_mb": 512,
+    # Conversations: how many are kept, and the token budget for each one's history
+    "max_sessions": 8,
+    "session_history_tokens": 1024,
+    # Share of the screen that must change before a conversation's earlier turns are set aside
+    # (below it, e.g. a clock or the cursor moving, follow-ups keep their history)
+    "session_new_screen_fraction": 0.5,
+    # Screenshot detail: "full" (native), "fixed" (capped at resolution_max_long_edge) or "auto"
+    # (cheap 768px glance for short generic questions; faster, but can miss small text)
+    "resolution_mode": "full",
+    "resolution_max_long_edge": 1536,
+    "resolution_tiling": True,
+    # Region to look at: null, [left, top, width, height] or "active" (foreground window)
+    "resolution_crop": None,
+    # Token limit for the final answer
+    "max_new_tokens": 500,
+    # Retrieval relevance (0-1): chunks below min_score are dropped; a top score at or
+    # above pass_score answers directly, below fail_score goes to web search, in between is graded
+    "retrieval_min_score": 0.3,
+    "retrieval_pass_score": 0.75,
+    "retrieval_fail_score": 0.4,
+    # BM25 index built at ingest and fused with vector results (reciprocal rank fusion, constant rrf_k)
+    "lexical_index": True,
+    "hybrid_retrieval": True,
+    "rrf_k": 60,
+    # How grade_node decides: "logits" (one forward pass), "constrained" (JSON-only decode) or "generate"
+    "grade_mode": "logits",
+    # Watch mode: capture in the background so questions don't wait on hide/repaint
+    "watch_mode": False,
+    "watch_fps": 2.0,
+    "watch_buffer_frames": 4,
+    # Fraction of 64px screen tiles that must change before a frame counts as a new screen
+    "change_min_fraction": 0.0,
+    # Dynamic batching of concurrent requests (1 = off)
+    "batch_max_size": 1,
+    "batch_window_ms": 20,
+    # "thread" runs the model inside the UI process, "process" in a separate one
+    "worker_mode": "thread",
+    "worker_cpu_affinity": [],
+    # Append per-stage spans as JSON lines to this file ("" = metrics only, no file)
+    "trace_file": "",
 }
 
 def load_config() -> Dict[str, Any]:
@@ -50,9 +127,24 @@ def load_config() -> Dict[str, Any]:
     env_map = {
         "SCREENVLM_BASE_MODEL_ID": "base_model_id",
         "SCREENVLM_ADAPTER_DIR": "adapter_dir",
+        "SCREENVLM_MERGED_DIR": "merged_dir",
         "SCREENVLM_DEVICE": "device_pref",
+        "SCREENVLM_CPU_PRECISION": "cpu_precision",
+        "SCREENVLM_CPU_THREADS": "cpu_threads",
+        "SCREENVLM_IDLE_OFFLOAD_MINUTES": "idle_offload_minutes",
         "SCREENVLM_CHROMA_DIR": "chroma_dir",
+        "SCREENVLM_VECTOR_STORE": "vector_store",
+        "SCREENVLM_VECTOR_DIR": "vector_dir",
         "SCREENVLM_DOCS_DIR": "docs_dir",
+        "SCREENVLM_INGEST_WORKERS": "ingest_workers",
+        "SCREENVLM_VISION_CACHE_SIZE": "vision_cache_size",
+        "SCREENVLM_GRADE_MODE": "grade_mode",
+        "SCREENVLM_RESOLUTION_MODE": "resolution_mode",
+        "SCREENVLM_WATCH_MODE": "watch_mode",
+        "SCREENVLM_BATCH_MAX_SIZE": "batch_max_size",
+        "SCREENVLM_WORKER_MODE": "worker_mode",
+        "SCREENVLM_WORKER_CPU_AFFINITY": "worker_cpu_affinity",
+        "SCREENVLM_TRACE_FILE": "trace_file",
     }
 
     for env_var, config_key in env_map.items():
@@ -61,5 +153,13 @@ def load_config() -> Dict[str, Any]:
 
     return config
 
+def as_bool(value) -> bool:
+    """
+    Interpret a config value that may come from YAML (bool) or an env var (string).
+    """
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
 # Global config object
 settings = load_config()
@@ -0,0 +1,59 @@
+import math
+import os
+import sys
+from typing import Dict, Iterable, Optional
+
+
+def peak_rss_mb() -> Optional[float]:
+    """
+    Peak resident set size of this process in MiB, or None if unavailable.
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KiB, macOS reports bytes
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss) / (1024 * 1024)
+    except Exception:
+        return None
+
+
+def rss_mb() -> Optional[float]:
+    """
+    Current resident set size of this process in MiB, or None if unavailable.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    except Exception:
+        return None
+
+
+def percentiles(values: Iterable[float], qs=(50, 90, 95, 99)) -> Dict[str, Optional[float]]:
+    """
+    Linear-interpolated percentiles plus count/mean/min/max, as a JSON-friendly dict.
+    """
+    data = sorted(v for v in values if v is not None)
+    out = {"count": len(data)}
+    if not data:
+        out.update({"mean": None, "min": None, "max": None})
+        out.update({f"p{q}": None for q in qs})
+        return out
+
+    out.update({"mean": sum(data) / len(data), "min": data[0], "max": data[-1]})
+    for q in qs:
+        pos = (len(data) - 1) * q / 100.0
+        lo, hi = math.floor(pos), math.ceil(pos)
+        out[f"p{q}"] = data[lo] + (data[hi] - data[lo]) * (pos - lo)
+    return out
@@ -0,0 +1,136 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+try:
+    from langchain_core.embeddings import Embeddings
+except ImportError:
+    Embeddings = object  # Handled by caller or app startup check
+
+from ..config import settings
+
+DEFAULT_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+
+
+def normalize_query(text: str) -> str:
+    """
+    Cache key for a query. The MiniLM tokenizer is uncased, so case and
+    spacing don't change the vector; trailing "?"/"!"/"." barely do.
+    """
+    return re.sub(r"\s+", " ", text).strip().lower().rstrip("?!. ")
+
+
+class _QueryBatch:
+    def __init__(self):
+        self.texts: List[str] = []
+        self.vectors = None
+        self.error: Optional[BaseException] = None
+        self.done = threading.Event()
+
+
+class EmbeddingService(Embeddings):
+    """
+    One sentence-transformers model per process, shared by ingestion and
+    retrieval and loaded on first use rather than at worker startup.
+
+    Query vectors are kept in an LRU keyed by the normalized query text.
+    Queries that arrive within batch_window_ms of each other are embedded in
+    one forward pass: the first caller waits out the window, embeds
+    everything that joined, and hands each caller its vector.
+    """
+
+    def __init__(self, model_name: str = DEFAULT_EMBEDDING_MODEL, cache_size: int = 256,
+                 batch_window_ms: float = 2.0):
+        self.model_name = model_name
+        self.cache_size = cache_size
+        self.batch_window = batch_window_ms / 1000.0
+        self._model = None
+        self._load_lock = threading.Lock()
+        self._cache: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._batch: Optional[_QueryBatch] = None
+        self._batch_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._load_lock:
+                if self._model is None:
+                    from langchain_community.embeddings import SentenceTransformerEmbeddings
+                    started = time.perf_counter()
+                    self._model = SentenceTransformerEmbeddings(model_name=self.model_name)
+                    print(f"Embeddings: Loaded {self.model_name} in {time.perf_counter() - started:.1f}s.")
+        return self._model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.model.embed_documents(list(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        key = normalize_query(text)
+        with self._cache_lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return list(vector)
+            self.misses += 1
+
+        with self._batch_lock:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _QueryBatch()
+            index = len(batch.texts)
+            batch.texts.append(key)
+
+        if leader:
+            if self.batch_window > 0:
+                time.sleep(self.batch_window)
+            with self._batch_lock:
+                self._batch = None
+            try:
+                batch.vectors = self.model.embed_documents(batch.texts)
+            except BaseException as e:
+                batch.error = e
+            batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        vector = batch.vectors[index]
+        self._remember(key, vector)
+        return list(vector)
+
+    def _remember(self, key: str, vector: List[float]):
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = vector
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_embeddings() -> EmbeddingService:
+    """
+    The process-wide EmbeddingService.
+    """
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = EmbeddingService(
+                    model_name=settings.get("embedding_model", DEFAULT_EMBEDDING_MODEL),
+                    cache_size=int(settings.get("query_cache_size", 256)),
+                    batch_window_ms=float(settings.get("query_batch_window_ms", 2.0)),
+                )
+    return _service
@@ -1,29 +1,196 @@
 import os
+import json
+import time
 import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
 from typing import List
 from typing import Optional
 
 try:
     from langchain_community.document_loaders import (
-        DirectoryLoader, 
-        TextLoader, 
-        PyPDFLoader, 
+        TextLoader,
+        PyPDFLoader,
         UnstructuredMarkdownLoader,
         Docx2txtLoader
     )
     from langchain.text_splitter import RecursiveCharacterTextSplitter
-    from langchain_community.vectorstores import Chroma
-    from langchain_community.embeddings import SentenceTransformerEmbeddings
 except ImportError:
     print("RAG dependencies not installed. Install with `pip install .[rag]`")
     raise
 
-from ..config import settings
+from ..config import settings, as_bool
+from .store import MANIFEST_NAME, migrate_if_needed, open_store, store_exists
+from .lexical import LexicalIndex, rebuild_from_store
+
+LOADERS = {
+    ".txt": TextLoader,
+    ".md": UnstructuredMarkdownLoader,
+    ".pdf": PyPDFLoader,
+    ".docx": Docx2txtLoader,
+}
+
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+
+def file_hash(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def chunk_id(rel_path: str, content_hash: str, index: int) -> str:
+    """
+    Stable id for the index-th chunk of a file version. Re-ingesting the same
+    content gives the same ids, so chunks can be replaced or deleted by id.
+    """
+    return hashlib.blake2b(f"{rel_path}|{content_hash}|{index}".encode(), digest_size=16).hexdigest()
+
+
+def load_manifest(persist_dir: str) -> Optional[dict]:
+    """
+    The ingest manifest in persist_dir, or None if there is none or it can't be read.
+    """
+    path = os.path.join(persist_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Warning: Failed to read ingest manifest: {e}")
+        return None
+
+
+def save_manifest(persist_dir: str, manifest: dict):
+    os.makedirs(persist_dir, exist_ok=True)
+    path = os.path.join(persist_dir, MANIFEST_NAME)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+def scan_docs(docs_dir: str) -> dict:
+    """
+    {relative path: {"size", "mtime"}} for every supported file under docs_dir.
+    """
+    found = {}
+    for root, _, names in os.walk(docs_dir):
+        for name in names:
+            if Path(name).suffix.lower() not in LOADERS:
+                continue
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            found[os.path.relpath(path, docs_dir)] = {"size": stat.st_size, "mtime": stat.st_mtime}
+    return found
+
+
+def plan_changes(docs_dir: str, manifest: dict) -> tuple:
+    """
+    Compare the docs folder with the manifest. Returns (changed, removed, unchanged):
+    changed maps relative paths to their new manifest entry (without chunk ids yet),
+    removed lists paths that are gone. Files whose size and mtime match are not
+    re-hashed; files that were only touched keep their chunks.
+    """
+    known = manifest.get("files", {})
+    changed, unchanged = {}, {}
+    for rel, info in scan_docs(docs_dir).items():
+        old = known.get(rel)
+        if old and old["size"] == info["size"] and old["mtime"] == info["mtime"]:
+            unchanged[rel] = old
+            continue
+        digest = file_hash(os.path.join(docs_dir, rel))
+        if old and old["hash"] == digest:
+            unchanged[rel] = dict(old, mtime=info["mtime"])
+            continue
+        changed[rel] = dict(info, hash=digest)
+    removed = [rel for rel in known if rel not in changed and rel not in unchanged]
+    return changed, removed, unchanged
+
+
+def load_file(path: str):
+    loader_cls = LOADERS[Path(path).suffix.lower()]
+    return loader_cls(path).load()
+
+
+_splitter = None
+
+
+def _parse_file(docs_dir: str, rel: str) -> tuple:
+    """
+    Load and split one file (runs in a pool process).
+    Returns (rel, [(text, metadata), ...], error).
+    """
+    global _splitter
+    if _splitter is None:
+        _splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    try:
+        documents = load_file(os.path.join(docs_dir, rel))
+        chunks = _splitter.split_documents(documents)
+    except Exception as e:
+        return rel, [], str(e)
+    return rel, [(c.page_content, c.metadata) for c in chunks], None
+
+
+def iter_parsed(docs_dir: str, paths: List[str], workers: int):
+    """
+    Yield _parse_file results as they finish, parsing on a process pool.
+    At most 2 * workers files are in flight, so memory doesn't grow with the corpus.
+    """
+    if workers <= 1:
+        for rel in paths:
+            yield _parse_file(docs_dir, rel)
+        return
+    pending = iter(paths)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        inflight = set()
+        for rel in pending:
+            inflight.add(pool.submit(_parse_file, docs_dir, rel))
+            if len(inflight) >= 2 * workers:
+                break
+        while inflight:
+            done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+            for future in done:
+                rel = next(pending, None)
+                if rel is not None:
+                    inflight.add(pool.submit(_parse_file, docs_dir, rel))
+                yield future.result()
+
+
+def ingest_workers() -> int:
+    workers = int(settings.get("ingest_workers", 0) or 0)
+    return workers if workers > 0 else max((os.cpu_count() or 2) - 1, 1)
+
+
+def open_lexical(store, persist_dir: str) -> Optional[LexicalIndex]:
+    """
+    The BM25 index next to the store, built from the stored chunks if it is
+    missing or an earlier ingest stopped halfway. None if lexical_index is off.
+    """
+    if not as_bool(settings.get("lexical_index", True)):
+        return None
+    index = LexicalIndex.load(persist_dir)
+    if not LexicalIndex.exists(persist_dir) or not index.complete:
+        index = rebuild_from_store(store, persist_dir)
+    return index
+
 
 def ingest_docs(docs_dir: str, persist_dir: str, rebuild: bool = False):
     """
-    Ingest documents from docs_dir into ChromaDB at persist_dir.
+    Ingest documents from docs_dir into the configured vector store at persist_dir.
+    The manifest (what was ingested, and the chunk ids each file produced) is kept next to it.
+
+    Incremental: only new or changed files are loaded and embedded, chunks of
+    changed and removed files are deleted by id. rebuild starts from scratch;
+    a store with no manifest is left untouched until it is rebuilt.
+
+    Files are parsed and split on a process pool and streamed to the store
+    in embed_batch_size batches, so memory stays flat with corpus size.
     """
     if rebuild and os.path.exists(persist_dir):
         print(f"Removing existing DB at {persist_dir}")
@@ -34,56 +201,91 @@ def ingest_docs(docs_dir: str, persist_dir: str, rebuild: bool = False):
         os.makedirs(docs_dir, exist_ok=True)
         return
 
-    print(f"Loading documents from {docs_dir}...")
-    
-    documents = []
-    
-    # Text/MD
-    for ext, loader_cls in [
-        ("**/*.txt", TextLoader),
-        ("**/*.md", UnstructuredMarkdownLoader),
-    ]:
-        try:
-            loader = DirectoryLoader(docs_dir, glob=ext, loader_cls=loader_cls)
-            documents.extend(loader.load())
-        except Exception as e:
-            print(f"Error loading {ext}: {e}")
-
-    # PDF
-    try:
-        loader = DirectoryLoader(docs_dir, glob="**/*.pdf", loader_cls=PyPDFLoader)
-        documents.extend(loader.load())
-    except Exception as e:
-        print(f"Error loading PDFs: {e}")
+    if not rebuild:
+        migrate_if_needed(persist_dir)
+    manifest = load_manifest(persist_dir)
+    if manifest is None:
+        if store_exists(persist_dir):
+            # Built before there was a manifest (or it was lost): chunk ids are unknown, so
+            # ingesting would duplicate them. Deleting is left to an explicit --rebuild.
+            print(f"{persist_dir} has a vector store but no readable ingest manifest, so it can't be "
+                  f"updated in place. Run ingest with --rebuild to rebuild it from {docs_dir}.")
+            return
+        manifest = {"files": {}}
 
-    # Docx
-    try:
-        loader = DirectoryLoader(docs_dir, glob="**/*.docx", loader_cls=Docx2txtLoader)
-        documents.extend(loader.load())
-    except Exception as e:
-        print(f"Error loading Docx: {e}")
+    print(f"Scanning documents in {docs_dir}...")
+    changed, removed, unchanged = plan_changes(docs_dir, manifest)
+    print(f"{len(changed)} new or changed, {len(removed)} removed, {len(unchanged)} unchanged.")
 
-    if not documents:
-        print("No documents found.")
+    if not changed and not removed:
+        if unchanged != manifest["files"]:
+            save_manifest(persist_dir, {"files": unchanged})
+        if unchanged and as_bool(settings.get("lexical_index", True)) and not LexicalIndex.exists(persist_dir):
+            open_lexical(open_store(persist_dir), persist_dir)
+        print("Index is up to date.")
         return
 
-    print(f"Loaded {len(documents)} documents. Splitting...")
-    
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200
-    )
-    chunks = text_splitter.split_documents(documents)
-    
-    print(f"Created {len(chunks)} chunks. Embedding and persisting to {persist_dir}...")
-    
-    # Use a default embedding model
-    embeddings = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
-    
-    vectorstore = Chroma.from_documents(
-        documents=chunks,
-        embedding=embeddings,
-        persist_directory=persist_dir
-    )
+    vectorstore = open_store(persist_dir)
+    lexical = open_lexical(vectorstore, persist_dir)
+    if lexical is not None:
+        lexical.mark_incomplete()
+
+    stale = [cid for rel in list(changed) + removed for cid in manifest["files"].get(rel, {}).get("chunk_ids", [])]
+    if stale:
+        print(f"Deleting {len(stale)} outdated chunks...")
+        vectorstore.delete(ids=stale)
+        if lexical is not None:
+            lexical.delete(stale)
+
+    batch_size = max(int(settings.get("embed_batch_size", 64) or 64), 1)
+    workers = min(ingest_workers(), max(len(changed), 1))
+    print(f"Parsing with {workers} processes, embedding in batches of {batch_size}...")
+
+    files = dict(unchanged)
+    texts, metadatas, ids = [], [], []
+    # Files whose chunks are all in the current batch; recorded once it is written
+    finished = []
+    added = 0
+    started = time.perf_counter()
+
+    def flush():
+        nonlocal added
+        if texts:
+            vectorstore.add_texts(texts, metadatas=metadatas, ids=ids)
+            if lexical is not None:
+                lexical.add(ids, texts)
+            added += len(texts)
+            texts.clear()
+            metadatas.clear()
+            ids.clear()
+        if finished:
+            files.update(finished)
+            finished.clear()
+            # Saved as we go, so an interrupted run doesn't redo finished files
+            save_manifest(persist_dir, {"files": files})
+
+    for done, (rel, chunks, error) in enumerate(iter_parsed(docs_dir, sorted(changed), workers), start=1):
+        if error:
+            print(f"Error loading {rel}: {error}")
+            continue
+        entry = changed[rel]
+        chunk_ids = [chunk_id(rel, entry["hash"], i) for i in range(len(chunks))]
+        for cid, (text, metadata) in zip(chunk_ids, chunks):
+            texts.append(text)
+            metadatas.append(metadata)
+            ids.append(cid)
+            if len(texts) >= batch_size:
+                flush()
+        finished.append((rel, dict(entry, chunk_ids=chunk_ids)))
+        if done % 50 == 0 or done == len(changed):
+            elapsed = max(time.perf_counter() - started, 1e-6)
+            print(f"  {done}/{len(changed)} files, {added + len(texts)} chunks "
+                  f"({done / elapsed:.1f} files/s, {added / elapsed:.1f} chunks/s embedded)")
+
+    flush()
     vectorstore.persist()
-    print("Ingestion complete.")
+    if lexical is not None:
+        lexical.save()
+    save_manifest(persist_dir, {"files": files})
+    elapsed = time.perf_counter() - started
+    print(f"Ingestion complete: {added} chunks added, {len(stale)} removed in {elapsed:.1f}s.")
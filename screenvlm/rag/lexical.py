@@ -0,0 +1,398 @@
+import os
+import re
+import shutil
+import json
+import math
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+LEXICAL_DIR = "lexical"
+INDEX_META = "segments.json"
+
+# Identifiers keep their inner "_-./:" (ERR_CONN_RESET, v1.2.3, 0x80070005); their parts are indexed too
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:[_\-./:][a-z0-9]+)*")
+PART_RE = re.compile(r"[_\-./:]")
+# Case is only looked at in queries, to spot identifiers such as HRESULT or getUserName
+RAW_TOKEN_RE = re.compile(r"[A-Za-z0-9]+(?:[_\-./:][A-Za-z0-9]+)*")
+
+STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below
+between both but by can could did do does doing down during each few for from further had has have
+having he her here hers him his how i if in into is it its itself just me more most my no nor not
+now of off on once only or other our out over own same she should so some such than that the their
+them then there these they this those through to too under until up very was we were what when where
+which while who whom why will with would you your yours screen see show shows showing tell mean means
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for token in TOKEN_RE.findall(text.lower()):
+        if token not in STOPWORDS:
+            tokens.append(token)
+        if PART_RE.search(token):
+            tokens.extend(part for part in PART_RE.split(token) if part and part not in STOPWORDS)
+    return tokens
+
+
+def identifier_terms(text: str) -> set:
+    """
+    Query tokens that look like identifiers (error codes, versions, symbol
+    names): at least three characters, with a digit, an inner separator, or
+    capitals after the first letter. Lower-cased, like the index terms.
+    """
+    found = set()
+    for token in RAW_TOKEN_RE.findall(text):
+        if len(token) < 3:
+            continue
+        if (any(c.isdigit() for c in token) or PART_RE.search(token)
+                or any(c.isupper() for c in token[1:])):
+            found.add(token.lower())
+    return found
+
+
+
+class _Segment:
+    """
+    One immutable on-disk batch of documents:
+
+        <name>.terms.json   vocabulary, sorted; a term's position is its id
+        <name>.offsets.npy  postings of term t are docs/tfs[offsets[t]:offsets[t + 1]]
+        <name>.docs.npy     int32 document numbers within the segment
+        <name>.tfs.npy      uint16 term frequencies
+        <name>.lengths.npy  int32 document lengths in tokens
+        <name>.ids.json     chunk id of each document number
+    """
+
+    ARRAYS = ("offsets", "docs", "tfs", "lengths")
+
+    def __init__(self, path: str, name: str, gen: int, tombstones: Dict[str, int]):
+        self.name = name
+        self.gen = gen
+        base = os.path.join(path, name)
+        with open(base + ".ids.json", "r") as f:
+            self.ids: List[str] = json.load(f)
+        with open(base + ".terms.json", "r", encoding="utf-8") as f:
+            self.terms = {term: i for i, term in enumerate(json.load(f))}
+        for array in self.ARRAYS:
+            setattr(self, array, np.load(f"{base}.{array}.npy", mmap_mode="r"))
+        # A tombstone written at generation g hides copies of that id in older segments
+        self.alive = np.fromiter((tombstones.get(i, -1) <= gen for i in self.ids), dtype=bool, count=len(self.ids))
+
+    def postings(self, term: str):
+        t = self.terms.get(term)
+        if t is None:
+            return None
+        start, end = int(self.offsets[t]), int(self.offsets[t + 1])
+        return np.asarray(self.docs[start:end]), np.asarray(self.tfs[start:end], dtype=np.float32)
+
+    @staticmethod
+    def write(path: str, name: str, ids: List[str], lengths, vocab: List[str],
+              term_idx: np.ndarray, doc_idx: np.ndarray, tfs: np.ndarray):
+        """
+        Write postings given as parallel (term index into vocab, doc, tf) arrays.
+        Sorting and offsets are vectorized, so the cost is the size of the
+        postings, not a Python loop over the vocabulary.
+        """
+        order_terms = np.argsort(np.asarray(vocab, dtype=object), kind="stable") if vocab else np.zeros(0, np.int64)
+        rank = np.empty(len(vocab), dtype=np.int64)
+        rank[order_terms] = np.arange(len(vocab))
+        t = rank[term_idx] if len(term_idx) else np.zeros(0, dtype=np.int64)
+        order = np.lexsort((doc_idx, t))
+        t, doc_idx, tfs = t[order], doc_idx[order], tfs[order]
+        used, t = np.unique(t, return_inverse=True)
+        offsets = np.zeros(len(used) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(t, minlength=len(used)))
+
+        base = os.path.join(path, name)
+        np.save(base + ".offsets.npy", offsets)
+        np.save(base + ".docs.npy", doc_idx.astype(np.int32))
+        np.save(base + ".tfs.npy", np.minimum(tfs, 65535).astype(np.uint16))
+        np.save(base + ".lengths.npy", np.asarray(lengths, dtype=np.int32))
+        with open(base + ".terms.json", "w", encoding="utf-8") as f:
+            json.dump([vocab[i] for i in order_terms[used]], f, ensure_ascii=False)
+        with open(base + ".ids.json", "w") as f:
+            json.dump(ids, f)
+
+    def remove_files(self, path: str):
+        for suffix in [f".{array}.npy" for array in self.ARRAYS] + [".terms.json", ".ids.json"]:
+            try:
+                os.remove(os.path.join(path, self.name + suffix))
+            except OSError:
+                pass
+
+
+class LexicalIndex:
+    """
+    BM25 inverted index over chunk texts, stored in <store dir>/lexical as
+    immutable segments plus segments.json (segment list, tombstones for
+    deleted or replaced chunk ids, and whether the index is complete).
+
+    Adds are buffered and written as a new segment every FLUSH_EVERY chunks
+    and on save(), so an incremental ingest only writes what it added.
+    save() merges all segments into one once there are more than
+    MAX_SEGMENTS, or tombstones cover a quarter of the documents; merging
+    never happens in the middle of an ingest.
+
+    Queries memory-map the arrays and only touch the postings of their own
+    terms, in every segment.
+    """
+
+    FLUSH_EVERY = 20000
+    MAX_SEGMENTS = 8
+
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.complete = True
+        # Loaded on first use; writers mostly never need them
+        self._loaded: Optional[List[_Segment]] = None
+        self._ids: Optional[set] = None
+        self._segment_meta: List[dict] = []
+        self._tombstones: Dict[str, int] = {}
+        self._next_gen = 0
+        # Pending adds, written by flush()
+        self._added: Dict[str, Counter] = {}
+
+    @staticmethod
+    def exists(store_dir: str) -> bool:
+        return os.path.exists(LexicalIndex.meta_path(store_dir))
+
+    @staticmethod
+    def meta_path(store_dir: str) -> str:
+        return os.path.join(store_dir, LEXICAL_DIR, INDEX_META)
+
+    @classmethod
+    def load(cls, store_dir: str, **kwargs) -> "LexicalIndex":
+        index = cls(os.path.join(store_dir, LEXICAL_DIR), **kwargs)
+        if not os.path.exists(index._file(INDEX_META)):
+            return index
+        with open(index._file(INDEX_META), "r") as f:
+            meta = json.load(f)
+        index.complete = meta.get("complete", False)
+        index._tombstones = meta.get("tombstones", {})
+        index._next_gen = meta.get("next_gen", 0)
+        index._segment_meta = meta.get("segments", [])
+        return index
+
+    @property
+    def _segments(self) -> List[_Segment]:
+        if self._loaded is None:
+            self._loaded = [_Segment(self.path, seg["name"], seg["gen"], self._tombstones)
+                            for seg in self._segment_meta]
+        return self._loaded
+
+    def _known_ids(self) -> set:
+        """
+        Every chunk id in a written segment, so tombstones are only recorded where they hide something.
+        """
+        if self._ids is None:
+            self._ids = set()
+            for seg in self._segment_meta:
+                with open(self._file(seg["name"] + ".ids.json"), "r") as f:
+                    self._ids.update(json.load(f))
+        return self._ids
+
+    def __len__(self):
+        return sum(int(seg.alive.sum()) for seg in self._segments)
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _write_meta(self, complete: bool):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self._file(INDEX_META + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"segments": self._segment_meta, "tombstones": self._tombstones,
+                       "next_gen": self._next_gen, "complete": complete}, f)
+        os.replace(tmp, self._file(INDEX_META))
+        self.complete = complete
+
+    def add(self, ids: Iterable[str], texts: Iterable[str]):
+        for chunk_id, text in zip(ids, texts):
+            self._added[chunk_id] = Counter(tokenize(text))
+        if len(self._added) >= self.FLUSH_EVERY:
+            self.flush()
+
+    def delete(self, ids: Iterable[str]):
+        known = self._known_ids()
+        for chunk_id in ids:
+            self._added.pop(chunk_id, None)
+            if chunk_id in known:
+                self._tombstones[chunk_id] = self._next_gen
+
+    def mark_incomplete(self):
+        """
+        Record on disk that changes are under way, so an interrupted ingest
+        leads to a rebuild instead of an index that silently misses chunks.
+        """
+        if os.path.exists(self._file(INDEX_META)):
+            self._write_meta(complete=False)
+
+    def flush(self):
+        """
+        Write pending adds as a new segment. Re-added ids hide their older copies.
+        """
+        if not self._added:
+            return
+        gen = self._next_gen
+        self._next_gen += 1
+        ids, lengths, vocab = [], [], {}
+        term_idx, doc_idx, tfs = [], [], []
+        for doc, (chunk_id, counts) in enumerate(self._added.items()):
+            ids.append(chunk_id)
+            lengths.append(sum(counts.values()))
+            if chunk_id in self._known_ids():
+                self._tombstones[chunk_id] = gen
+            for term, tf in counts.items():
+                term_idx.append(vocab.setdefault(term, len(vocab)))
+                doc_idx.append(doc)
+                tfs.append(tf)
+        name = f"seg{gen:06d}"
+        os.makedirs(self.path, exist_ok=True)
+        _Segment.write(self.path, name, ids, lengths, list(vocab),
+                       np.asarray(term_idx, dtype=np.int64), np.asarray(doc_idx, dtype=np.int64),
+                       np.asarray(tfs, dtype=np.int64))
+        self._segment_meta.append({"name": name, "gen": gen, "docs": len(ids), "tokens": int(sum(lengths))})
+        self._known_ids().update(ids)
+        self._added = {}
+        self._loaded = None
+        self._write_meta(complete=False)
+
+    def save(self):
+        """
+        Flush pending changes, merge segments if they have piled up, and mark
+        the index complete.
+        """
+        self.flush()
+        total = sum(seg["docs"] for seg in self._segment_meta)
+        # Each tombstone hides (at least) one document; no need to load the segments to decide
+        dead = len(self._tombstones)
+        if len(self._segments) > self.MAX_SEGMENTS or (dead and dead * 4 >= total):
+            self._merge()
+        self._write_meta(complete=True)
+
+    def _merge(self):
+        """
+        Rewrite all live documents as one segment, with vectorized array work.
+        """
+        old = self._segments
+        vocab: Dict[str, int] = {}
+        ids, lengths, term_parts, doc_parts, tf_parts = [], [], [], [], []
+        for seg in old:
+            keep = np.flatnonzero(seg.alive)
+            renumber = np.full(len(seg.ids), -1, dtype=np.int64)
+            renumber[keep] = np.arange(len(ids), len(ids) + len(keep))
+            ids.extend(seg.ids[i] for i in keep)
+            lengths.extend(np.asarray(seg.lengths)[keep].tolist())
+            seg_terms = sorted(seg.terms, key=seg.terms.get)
+            local_to_global = np.asarray([vocab.setdefault(term, len(vocab)) for term in seg_terms], dtype=np.int64)
+            counts = np.diff(np.asarray(seg.offsets))
+            terms = np.repeat(local_to_global, counts)
+            docs = renumber[np.asarray(seg.docs, dtype=np.int64)]
+            alive = docs >= 0
+            term_parts.append(terms[alive])
+            doc_parts.append(docs[alive])
+            tf_parts.append(np.asarray(seg.tfs, dtype=np.int64)[alive])
+
+        gen = self._next_gen
+        self._next_gen += 1
+        name = f"seg{gen:06d}"
+        _Segment.write(self.path, name, ids, lengths, list(vocab),
+                       np.concatenate(term_parts) if term_parts else np.zeros(0, dtype=np.int64),
+                       np.concatenate(doc_parts) if doc_parts else np.zeros(0, dtype=np.int64),
+                       np.concatenate(tf_parts) if tf_parts else np.zeros(0, dtype=np.int64))
+        # Every tombstone has been applied
+        self._tombstones = {}
+        self._segment_meta = [{"name": name, "gen": gen, "docs": len(ids), "tokens": int(sum(lengths))}]
+        self._ids = set(ids)
+        self._loaded = None
+        self._write_meta(complete=False)
+        for seg in old:
+            seg.remove_files(self.path)
+
+    def search(self, query: str, k: int = 10, max_df: float = 0.2,
+               selective_df: float = 0.05) -> List[Tuple[str, float, bool]]:
+        """
+        Best k (chunk id, BM25 score, matched an identifier) for query, highest first.
+
+        Terms in more than max_df of the chunks add nothing and are skipped.
+        A chunk only counts as a hit if it contains at least one selective
+        query term (in at most selective_df of the chunks, or an identifier),
+        so a question that shares only everyday words with a chunk doesn't
+        match it.
+        """
+        segments = [seg for seg in self._segments if len(seg.ids)]
+        if not segments:
+            return []
+        identifiers = identifier_terms(query)
+        terms = list(dict.fromkeys(tokenize(query)))
+        # Corpus statistics over all segments (tombstoned copies are few until the next merge)
+        n = sum(len(seg.ids) for seg in segments)
+        avgdl = max(sum(m["tokens"] for m in self._segment_meta) / max(n, 1), 1.0)
+        postings = [[seg.postings(term) for seg in segments] for term in terms]
+        df = [sum(len(p[0]) for p in per_seg if p is not None) for per_seg in postings]
+
+        hits = []
+        for s, seg in enumerate(segments):
+            acc = np.zeros(len(seg.ids), dtype=np.float32)
+            selective = np.zeros(len(seg.ids), dtype=bool)
+            matched_identifier = np.zeros(len(seg.ids), dtype=bool)
+            for term, term_df, per_seg in zip(terms, df, postings):
+                found = per_seg[s]
+                if found is None or not term_df:
+                    continue
+                if term not in identifiers and term_df > max(max_df * n, 1):
+                    continue
+                docs, tfs = found
+                idf = math.log(1.0 + (n - term_df + 0.5) / (term_df + 0.5))
+                norm = self.k1 * (1.0 - self.b + self.b * seg.lengths[docs] / avgdl)
+                acc[docs] += idf * tfs * (self.k1 + 1.0) / (tfs + norm)
+                if term in identifiers:
+                    matched_identifier[docs] = True
+                    selective[docs] = True
+                elif term_df <= max(selective_df * n, 1):
+                    selective[docs] = True
+            docs = np.flatnonzero(selective & (acc > 0) & seg.alive)
+            if len(docs) > k:
+                docs = docs[np.argpartition(-acc[docs], k - 1)[:k]]
+            hits.extend((seg.ids[d], float(acc[d]), bool(matched_identifier[d])) for d in docs)
+        hits.sort(key=lambda hit: hit[1], reverse=True)
+        return hits[:k]
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """
+    Fuse ranked lists of keys: each key scores sum(1 / (k + rank)) over the
+    lists it appears in (rank from 1). Returns (key, score), best first.
+    """
+    fused: Dict[str, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            fused[key] += 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+def rebuild_from_store(store, store_dir: str, batch: int = 1000) -> Optional[LexicalIndex]:
+    """
+    Build the index from the chunks already in a vector store (stores
+    ingested before the index existed, or after an interrupted ingest).
+    """
+    path = os.path.join(store_dir, LEXICAL_DIR)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    index = LexicalIndex(path)
+    ids, texts = [], []
+    for chunk_id, text in store.iter_chunks():
+        ids.append(chunk_id)
+        texts.append(text)
+        if len(ids) >= batch:
+            index.add(ids, texts)
+            ids, texts = [], []
+    index.add(ids, texts)
+    index.save()
+    print(f"Lexical index: Built from {len(index)} stored chunks.")
+    return index
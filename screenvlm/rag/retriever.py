@@ -1,51 +1,107 @@
 from typing import List, Dict, Any
 import os
 
-try:
-    from langchain_community.vectorstores import Chroma
-    from langchain_community.embeddings import SentenceTransformerEmbeddings
-except ImportError:
-    pass # Handled by caller or app startup check
-
-from ..config import settings
+from ..config import settings, as_bool
+from .lexical import LexicalIndex, reciprocal_rank_fusion
+from .store import default_store_dir, migrate_if_needed, open_store, store_exists
 
 class Retriever:
-    def __init__(self, persist_dir: str = None):
+    def __init__(self, persist_dir: str = None, min_score: float = None):
         if persist_dir is None:
-            persist_dir = settings["chroma_dir"]
+            persist_dir = default_store_dir()
+        if min_score is None:
+            min_score = float(settings.get("retrieval_min_score", 0.0))
             
         self.persist_dir = persist_dir
+        self.min_score = min_score
         self.vectorstore = None
+        # BM25 results are fused in with reciprocal rank fusion when the index exists
+        self.hybrid = as_bool(settings.get("hybrid_retrieval", True))
+        self.rrf_k = int(settings.get("rrf_k", 60))
+        self._lexical = None
+        self._lexical_mtime = None
         
-        if os.path.exists(persist_dir):
+        migrate_if_needed(persist_dir)
+        if store_exists(persist_dir):
             try:
-                if 'SentenceTransformerEmbeddings' not in globals():
-                     raise ImportError("langchain_community not installed")
-                     
-                embeddings = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
-                self.vectorstore = Chroma(
-                    persist_directory=persist_dir, 
-                    embedding_function=embeddings
-                )
+                # The embedding model itself loads on the first query
+                self.vectorstore = open_store(persist_dir)
             except Exception as e:
-                print(f"Failed to initialize Chroma: {e}")
+                print(f"Failed to open vector store: {e}")
+
+    def _lexical_index(self):
+        """
+        The BM25 index, reloaded when an ingest has rewritten it.
+        """
+        path = LexicalIndex.meta_path(self.persist_dir)
+        if not self.hybrid or not os.path.exists(path):
+            return None
+        mtime = os.path.getmtime(path)
+        if mtime != self._lexical_mtime:
+            try:
+                index = LexicalIndex.load(self.persist_dir)
+            except Exception as e:
+                print(f"Failed to load lexical index: {e}")
+                return None
+            # A half-written index (ingest running or interrupted) is skipped until it is complete
+            self._lexical = index if index.complete else None
+            self._lexical_mtime = mtime
+        return self._lexical
     
     def retrieve(self, query: str, k: int = 4) -> List[Dict[str, Any]]:
         """
-        Retrieve chunks relevant to query.
-        Returns list of dicts with 'text', 'source', 'chunk_id' (optional).
+        Retrieve chunks relevant to query, best first.
+        Returns list of dicts with 'text', 'source', 'chunk_id' (optional) and
+        'score' (vector relevance in [0, 1]). Chunks scoring below min_score are dropped.
+
+        With the lexical index, vector and BM25 rankings are fused with
+        reciprocal rank fusion. BM25 hits only join the fusion if they also
+        passed min_score on the vector side, or matched an identifier-like
+        query term (error code, version, symbol name) exactly; the latter get
+        'score' None and 'exact_match' True.
         """
         if not self.vectorstore:
             return []
-            
-        results = self.vectorstore.similarity_search(query, k=k)
-        
+
+        lexical = self._lexical_index()
+        if lexical is None:
+            results = self.vectorstore.search(query, k=k)
+            return self._to_chunks([(text, metadata, score, False) for _, text, metadata, score in results
+                                    if score >= self.min_score])
+
+        depth = max(k * 3, 10)
+        results = self.vectorstore.search(query, k=depth)
+        found = {(cid or text): (text, metadata, score) for cid, text, metadata, score in results}
+        vector_ranking = [cid or text for cid, text, _, score in results if score >= self.min_score]
+        passed = set(vector_ranking)
+        exact = set()
+        lexical_ranking = []
+        for cid, _, identifier in lexical.search(query, k=depth):
+            if cid in passed:
+                lexical_ranking.append(cid)
+            elif identifier:
+                lexical_ranking.append(cid)
+                exact.add(cid)
+
+        fused = [key for key, _ in reciprocal_rank_fusion([vector_ranking, lexical_ranking], k=self.rrf_k)[:k]]
+        missing = [key for key in fused if key not in found]
+        if missing:
+            for cid, (text, metadata) in self.vectorstore.get(missing).items():
+                found[cid] = (text, metadata, None)
+        return self._to_chunks([(found[key][0], found[key][1], found[key][2] if key in passed else None, key in exact)
+                                for key in fused if key in found])
+
+    def _to_chunks(self, results) -> List[Dict[str, Any]]:
         chunks = []
-        for i, doc in enumerate(results):
-            chunks.append({
-                "text": doc.page_content,
-                "source": doc.metadata.get("source", "unknown"),
-                "chunk_id": i + 1
-            })
+        for i, (text, metadata, score, exact_match) in enumerate(results):
+            chunk = {
+                "text": text,
+                "source": metadata.get("source", "unknown"),
+                "chunk_id": i + 1,
+                "score": float(score) if score is not None else None,
+            }
+            if exact_match:
+                chunk["exact_match"] = True
+            chunks.append(chunk)
             
         return chunks
@@ -0,0 +1,505 @@
+import os
+import json
+import math
+import shutil
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from ..config import settings
+
+# (chunk id, text, metadata, relevance in [0, 1]); the id may be None with older Chroma wrappers
+SearchResult = Tuple[Optional[str], str, Dict[str, Any], float]
+
+FLAT_META = "store.json"
+FLAT_VECTORS = "vectors.f32"
+FLAT_CHUNKS = "chunks.jsonl"
+FLAT_IVF = "ivf.npz"
+# Kept next to the store by ingest_docs; carried over by migrate_from_chroma
+MANIFEST_NAME = "ingest_manifest.json"
+# Left in a Chroma directory once it has been migrated, so it is never migrated again automatically
+MIGRATED_MARKER = "migrated_to_flat.json"
+
+
+def relevance_from_cosine(cos):
+    """
+    Relevance on the scale LangChain's Chroma wrapper reports for normalized
+    embeddings (1 - squared L2 / sqrt(2)), so the retrieval_*_score
+    thresholds mean the same thing with either backend.
+    """
+    return 1.0 - (2.0 - 2.0 * cos) / math.sqrt(2)
+
+
+def _line_id(line: str) -> str:
+    """
+    The id of a chunks.jsonl line, without parsing the text that follows it.
+    """
+    prefix = '{"id": "'
+    if line.startswith(prefix):
+        end = line.find('"', len(prefix))
+        if end > 0 and "\\" not in line[len(prefix):end]:
+            return line[len(prefix):end]
+    return json.loads(line)["id"]
+
+
+class VectorStore:
+    """
+    What Retriever and ingest_docs need from a vector store. Texts are
+    embedded with the embedding passed to the store.
+    """
+
+    def add_texts(self, texts: List[str], metadatas: List[dict], ids: List[str]):
+        raise NotImplementedError
+
+    def delete(self, ids: List[str]):
+        raise NotImplementedError
+
+    def search(self, query: str, k: int = 4) -> List[SearchResult]:
+        raise NotImplementedError
+
+    def get(self, ids: List[str]) -> Dict[str, Tuple[str, Dict[str, Any]]]:
+        """
+        {id: (text, metadata)} for the ids that are in the store.
+        """
+        raise NotImplementedError
+
+    def iter_chunks(self):
+        """
+        Yield (id, text) for every chunk.
+        """
+        raise NotImplementedError
+
+    def persist(self):
+        pass
+
+
+class ChromaStore(VectorStore):
+    """
+    LangChain's Chroma wrapper (the original backend).
+    """
+
+    def __init__(self, path: str, embedding):
+        from langchain_community.vectorstores import Chroma
+        self.path = path
+        self._db = Chroma(persist_directory=path, embedding_function=embedding)
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, "chroma.sqlite3"))
+
+    def add_texts(self, texts, metadatas, ids):
+        self._db.add_texts(texts, metadatas=metadatas, ids=ids)
+
+    def delete(self, ids):
+        self._db.delete(ids=ids)
+
+    def search(self, query, k=4):
+        results = self._db.similarity_search_with_relevance_scores(query, k=k)
+        return [(getattr(doc, "id", None), doc.page_content, doc.metadata, float(score)) for doc, score in results]
+
+    def get(self, ids):
+        found = self._db.get(ids=list(ids), include=["documents", "metadatas"])
+        return {i: (text, meta or {}) for i, text, meta in zip(found["ids"], found["documents"], found["metadatas"])}
+
+    def iter_chunks(self, page_size: int = 1000):
+        offset = 0
+        while True:
+            page = self._db.get(include=["documents"], limit=page_size, offset=offset)
+            if not page["ids"]:
+                return
+            yield from zip(page["ids"], page["documents"])
+            offset += len(page["ids"])
+
+    def persist(self):
+        self._db.persist()
+
+
+class FlatStore(VectorStore):
+    """
+    Single-user local store: normalized float32 embeddings in a memory-mapped
+    matrix (vectors.f32), one JSON line per chunk in chunks.jsonl, counts and
+    deletions in store.json.
+
+    Small corpora are searched exactly with one matrix-vector product. Once
+    there are ivf_min_rows rows, build_index() clusters them (spherical
+    k-means) and a query only scores the ivf_nprobe nearest clusters plus
+    rows added since the index was built.
+
+    Writes append to both files, so ingest memory doesn't grow with the
+    corpus. Deleted rows are masked until persist() compacts them away.
+    """
+
+    def __init__(self, path: str, embedding, ivf_min_rows: int = 20000, nprobe: int = 8):
+        self.path = path
+        self.embedding = embedding
+        self.ivf_min_rows = ivf_min_rows
+        self.nprobe = nprobe
+        self._lock = threading.Lock()
+        self._meta_mtime = None
+        self._reload()
+
+    def _reload(self):
+        meta = {}
+        if os.path.exists(self._file(FLAT_META)):
+            self._meta_mtime = os.path.getmtime(self._file(FLAT_META))
+            with open(self._file(FLAT_META), "r") as f:
+                meta = json.load(f)
+        self.dim: Optional[int] = meta.get("dim")
+        self.rows: int = meta.get("rows", 0)
+        self.deleted = set(meta.get("deleted", []))
+        self._matrix = None
+        self._offsets = None
+        self._ivf = None
+        self._ids = None
+        self._truncated = False
+        self._load_ivf()
+
+    def _refresh(self):
+        """
+        Pick up writes made by another process (e.g. `screenvlm ingest` while the app runs).
+        """
+        path = self._file(FLAT_META)
+        if os.path.exists(path) and os.path.getmtime(path) != self._meta_mtime:
+            self._reload()
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, FLAT_META))
+
+    def __len__(self):
+        return self.rows - len(self.deleted)
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _save_meta(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self._file(FLAT_META) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"dim": self.dim, "rows": self.rows, "deleted": sorted(self.deleted)}, f)
+        os.replace(tmp, self._file(FLAT_META))
+        self._meta_mtime = os.path.getmtime(self._file(FLAT_META))
+
+    def _truncate_to_rows(self):
+        """
+        Drop anything past the recorded row count (left by an interrupted write).
+        """
+        if self.dim and os.path.exists(self._file(FLAT_VECTORS)):
+            size = self.rows * self.dim * 4
+            if os.path.getsize(self._file(FLAT_VECTORS)) > size:
+                with open(self._file(FLAT_VECTORS), "r+b") as f:
+                    f.truncate(size)
+        if os.path.exists(self._file(FLAT_CHUNKS)):
+            offsets = self._line_offsets()
+            with open(self._file(FLAT_CHUNKS), "r+b") as f:
+                f.truncate(int(offsets[-1]))
+        self._truncated = True
+
+    # Reading
+
+    def _vectors(self) -> np.ndarray:
+        if self._matrix is None:
+            if not self.rows:
+                return np.zeros((0, self.dim or 0), dtype=np.float32)
+            self._matrix = np.memmap(self._file(FLAT_VECTORS), dtype=np.float32, mode="r",
+                                     shape=(self.rows, self.dim))
+        return self._matrix
+
+    def _line_offsets(self) -> np.ndarray:
+        """
+        Byte offset of each chunk line (rows + 1 entries), from one pass over the file.
+        """
+        if self._offsets is None:
+            offsets = [0]
+            if os.path.exists(self._file(FLAT_CHUNKS)):
+                with open(self._file(FLAT_CHUNKS), "rb") as f:
+                    for line in f:
+                        if len(offsets) > self.rows:
+                            break
+                        offsets.append(offsets[-1] + len(line))
+            self._offsets = np.asarray(offsets, dtype=np.int64)
+        return self._offsets
+
+    def _read_rows(self, rows) -> List[dict]:
+        offsets = self._line_offsets()
+        items = []
+        with open(self._file(FLAT_CHUNKS), "rb") as f:
+            for row in rows:
+                f.seek(int(offsets[row]))
+                items.append(json.loads(f.read(int(offsets[row + 1] - offsets[row]))))
+        return items
+
+    def _row_ids(self) -> Dict[str, int]:
+        if self._ids is None:
+            self._ids = {}
+            if os.path.exists(self._file(FLAT_CHUNKS)):
+                with open(self._file(FLAT_CHUNKS), "r", encoding="utf-8") as f:
+                    for row, line in enumerate(f):
+                        if row >= self.rows:
+                            break
+                        self._ids[_line_id(line)] = row
+        return self._ids
+
+    def get(self, ids):
+        with self._lock:
+            self._refresh()
+            row_ids = self._row_ids()
+            rows = [row_ids[i] for i in ids if i in row_ids and row_ids[i] not in self.deleted]
+            items = self._read_rows(rows)
+        return {item["id"]: (item["text"], item["metadata"]) for item in items}
+
+    def iter_chunks(self):
+        if not os.path.exists(self._file(FLAT_CHUNKS)):
+            return
+        with open(self._file(FLAT_CHUNKS), "r", encoding="utf-8") as f:
+            for row, line in enumerate(f):
+                if row >= self.rows:
+                    break
+                if row not in self.deleted:
+                    item = json.loads(line)
+                    yield item["id"], item["text"]
+
+    def _normalize(self, vectors) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def search(self, query, k=4):
+        with self._lock:
+            self._refresh()
+        if not len(self):
+            return []
+        q = self._normalize(self.embedding.embed_query(query))
+        with self._lock:
+            matrix = self._vectors()
+            candidates = self._candidates(q)
+            if candidates is None:
+                scores = matrix @ q
+                rows = np.arange(self.rows)
+            else:
+                scores = matrix[candidates] @ q
+                rows = candidates
+            if self.deleted:
+                alive = ~np.isin(rows, np.fromiter(self.deleted, dtype=np.int64))
+                scores, rows = scores[alive], rows[alive]
+            if not len(rows):
+                return []
+            k = min(k, len(rows))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            items = self._read_rows(rows[top])
+        return [(item["id"], item["text"], item["metadata"], float(relevance_from_cosine(scores[i])))
+                for item, i in zip(items, top)]
+
+    # IVF
+
+    def _load_ivf(self):
+        if not os.path.exists(self._file(FLAT_IVF)):
+            return
+        with np.load(self._file(FLAT_IVF)) as data:
+            self._ivf = {name: data[name] for name in ("centroids", "order", "offsets", "rows")}
+
+    def _candidates(self, q) -> Optional[np.ndarray]:
+        """
+        Rows to score for q: members of the nprobe closest clusters plus rows
+        the index doesn't cover yet. None means score everything.
+        """
+        if self._ivf is None:
+            return None
+        indexed = int(self._ivf["rows"])
+        if indexed > self.rows:
+            return None
+        centroids, order, offsets = self._ivf["centroids"], self._ivf["order"], self._ivf["offsets"]
+        nprobe = min(self.nprobe, len(centroids))
+        probe = np.argpartition(-(centroids @ q), nprobe - 1)[:nprobe]
+        parts = [order[offsets[c]:offsets[c + 1]] for c in probe]
+        parts.append(np.arange(indexed, self.rows))
+        return np.sort(np.concatenate(parts))
+
+    def build_index(self, iterations: int = 10, sample: int = 50000, seed: int = 0):
+        """
+        Cluster the rows for IVF search, or drop the index if the store is
+        below ivf_min_rows.
+        """
+        with self._lock:
+            if self.rows < self.ivf_min_rows:
+                self._ivf = None
+                if os.path.exists(self._file(FLAT_IVF)):
+                    os.remove(self._file(FLAT_IVF))
+                return
+            matrix = self._vectors()
+            nlist = max(int(math.sqrt(self.rows)), 1)
+            rng = np.random.default_rng(seed)
+            picked = np.sort(rng.choice(self.rows, size=min(sample, self.rows), replace=False))
+            train = np.asarray(matrix[picked])
+            centroids = train[rng.choice(len(train), size=nlist, replace=False)]
+            for _ in range(iterations):
+                assign = np.argmax(train @ centroids.T, axis=1)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assign, train)
+                empty = np.bincount(assign, minlength=nlist) == 0
+                sums[empty] = centroids[empty]
+                centroids = self._normalize(sums)
+
+            assign = np.empty(self.rows, dtype=np.int32)
+            for start in range(0, self.rows, 65536):
+                block = np.asarray(matrix[start:start + 65536])
+                assign[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+            order = np.argsort(assign, kind="stable").astype(np.int64)
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))]).astype(np.int64)
+            self._ivf = {"centroids": centroids, "order": order, "offsets": offsets,
+                         "rows": np.asarray(self.rows)}
+            np.savez(self._file(FLAT_IVF), **self._ivf)
+        print(f"FlatStore: Indexed {self.rows} rows into {nlist} clusters.")
+
+    # Writing
+
+    def add_texts(self, texts, metadatas, ids):
+        vectors = self._normalize(self.embedding.embed_documents(list(texts)))
+        self.add_vectors(vectors, texts, metadatas, ids)
+
+    def add_vectors(self, vectors, texts, metadatas, ids):
+        vectors = self._normalize(vectors)
+        with self._lock:
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Embedding size {vectors.shape[1]} doesn't match the store ({self.dim})")
+            os.makedirs(self.path, exist_ok=True)
+            if not self._truncated:
+                self._truncate_to_rows()
+            existing = self._row_ids()
+            # Re-adding an id replaces it
+            self.deleted.update(existing[i] for i in ids if i in existing)
+            with open(self._file(FLAT_VECTORS), "ab") as f:
+                f.write(vectors.astype(np.float32).tobytes())
+            lines = [json.dumps({"id": i, "text": t, "metadata": m or {}}, ensure_ascii=False) + "\n"
+                     for i, t, m in zip(ids, texts, metadatas or [{}] * len(ids))]
+            with open(self._file(FLAT_CHUNKS), "a", encoding="utf-8") as f:
+                f.writelines(lines)
+            for offset, cid in enumerate(ids):
+                existing[cid] = self.rows + offset
+            self.rows += len(ids)
+            self._matrix = None
+            self._offsets = None
+            self._save_meta()
+
+    def delete(self, ids):
+        with self._lock:
+            row_ids = self._row_ids()
+            self.deleted.update(row_ids.pop(i) for i in ids if i in row_ids)
+            self._save_meta()
+
+    def persist(self):
+        """
+        Compact away deleted rows once they are a quarter of the store, and
+        refresh the IVF index.
+        """
+        if self.deleted and len(self.deleted) * 4 >= self.rows:
+            self._compact()
+        self.build_index()
+
+    def _compact(self):
+        with self._lock:
+            keep = np.setdiff1d(np.arange(self.rows), np.fromiter(self.deleted, dtype=np.int64))
+            matrix = self._vectors()
+            tmp_vectors = self._file(FLAT_VECTORS) + ".tmp"
+            tmp_chunks = self._file(FLAT_CHUNKS) + ".tmp"
+            offsets = self._line_offsets()
+            with open(tmp_vectors, "wb") as vf, open(tmp_chunks, "wb") as cf, \
+                    open(self._file(FLAT_CHUNKS), "rb") as src:
+                for start in range(0, len(keep), 65536):
+                    rows = keep[start:start + 65536]
+                    vf.write(np.asarray(matrix[rows], dtype=np.float32).tobytes())
+                    for row in rows:
+                        src.seek(int(offsets[row]))
+                        cf.write(src.read(int(offsets[row + 1] - offsets[row])))
+            self._matrix = None
+            del matrix
+            os.replace(tmp_vectors, self._file(FLAT_VECTORS))
+            os.replace(tmp_chunks, self._file(FLAT_CHUNKS))
+            removed = self.rows - len(keep)
+            self.rows = len(keep)
+            self.deleted = set()
+            self._offsets = None
+            self._ids = None
+            self._ivf = None
+            self._save_meta()
+        print(f"FlatStore: Compacted away {removed} deleted rows.")
+
+
+def default_store_dir(backend: Optional[str] = None) -> str:
+    backend = backend or settings.get("vector_store", "flat")
+    return settings["chroma_dir"] if backend == "chroma" else settings["vector_dir"]
+
+
+def store_exists(path: str, backend: Optional[str] = None) -> bool:
+    backend = backend or settings.get("vector_store", "flat")
+    return ChromaStore.exists(path) if backend == "chroma" else FlatStore.exists(path)
+
+
+def open_store(path: Optional[str] = None, embedding=None, backend: Optional[str] = None) -> VectorStore:
+    """
+    The configured vector store ("flat" or "chroma") at path.
+    """
+    backend = backend or settings.get("vector_store", "flat")
+    path = path or default_store_dir(backend)
+    if embedding is None:
+        from .embeddings import get_embeddings
+        embedding = get_embeddings()
+    if backend == "chroma":
+        return ChromaStore(path, embedding)
+    if backend != "flat":
+        raise ValueError(f"Unknown vector_store: {backend}")
+    return FlatStore(path, embedding, ivf_min_rows=int(settings.get("ivf_min_rows", 20000)),
+                     nprobe=int(settings.get("ivf_nprobe", 8)))
+
+
+def migrate_from_chroma(chroma_dir: str, out_dir: str, page_size: int = 1000) -> int:
+    """
+    Copy the embeddings, texts and metadata of a Chroma store into a
+    FlatStore at out_dir, page by page, along with the ingest manifest so
+    later ingests stay incremental. Returns the number of chunks copied.
+    """
+    import chromadb
+
+    client = chromadb.PersistentClient(path=chroma_dir)
+    # LangChain's default collection name
+    collection = client.get_collection("langchain")
+    store = FlatStore(out_dir, embedding=None)
+    copied = 0
+    while True:
+        page = collection.get(include=["embeddings", "documents", "metadatas"],
+                              limit=page_size, offset=copied)
+        if not page["ids"]:
+            break
+        store.add_vectors(np.asarray(page["embeddings"], dtype=np.float32), page["documents"],
+                          page["metadatas"], page["ids"])
+        copied += len(page["ids"])
+    store.persist()
+    manifest = os.path.join(chroma_dir, MANIFEST_NAME)
+    if os.path.exists(manifest):
+        shutil.copy2(manifest, os.path.join(out_dir, MANIFEST_NAME))
+    with open(os.path.join(chroma_dir, MIGRATED_MARKER), "w") as f:
+        json.dump({"out_dir": os.path.abspath(out_dir), "chunks": copied}, f)
+    print(f"Migrated {copied} chunks from {chroma_dir} to {out_dir}.")
+    return copied
+
+
+def migrate_if_needed(path: str, backend: Optional[str] = None):
+    """
+    First use of the flat backend with an existing Chroma store: migrate it.
+    A Chroma store that was migrated once is left alone, so deleting the flat
+    store (or `ingest --rebuild`) starts from scratch instead of restoring it.
+    """
+    backend = backend or settings.get("vector_store", "flat")
+    chroma_dir = settings["chroma_dir"]
+    if backend != "flat" or FlatStore.exists(path) or not ChromaStore.exists(chroma_dir):
+        return
+    if os.path.exists(os.path.join(chroma_dir, MIGRATED_MARKER)):
+        return
+    try:
+        migrate_from_chroma(chroma_dir, path)
+    except Exception as e:
+        print(f"Failed to migrate Chroma store at {chroma_dir}: {e}")
@@ -0,0 +1,351 @@
+import asyncio
+import base64
+import io
+import json
+import threading
+import time
+from typing import Dict, Optional
+
+from .config import settings
+
+MAX_BODY = 64 * 1024 * 1024
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable",
+           504: "Gateway Timeout"}
+
+
+class InferenceServer:
+    """
+    Local HTTP API in front of one model worker.
+
+    Requests wait in a bounded asyncio queue; when it is full new requests
+    are rejected with 503 straight away instead of piling up. At most
+    max_inflight requests are handed to the worker at a time, and each one
+    has a timeout after which it is cancelled in the worker.
+
+    Endpoints:
+        GET  /health  -> {"loaded": bool, "queued": int, "inflight": int}
+        GET  /metrics -> {stage: {"count", "mean", "p50", "p95", "p99", ...}}
+        POST /ask     -> {"question": str, "rag": bool, "image": base64 PNG/JPEG (optional),
+                          "image_path": str (optional), "stream": bool, "timeout": float,
+                          "session_id": str (optional), "crop": [left, top, width, height] (optional),
+                          "capture": bool (optional)}
+    Without an image the server captures the screen, except for follow-ups
+    in a session that already has a screenshot: those keep asking about it
+    unless "capture": true asks for a fresh one. With "stream": true the
+    answer comes back as chunked NDJSON events. Questions sharing a
+    session_id are follow-ups in one conversation.
+    """
+
+    def __init__(self, worker, max_queue: int = 8, max_inflight: int = 1, timeout: float = 120.0):
+        self.worker = worker
+        self.timeout = timeout
+        self.max_inflight = max(int(max_inflight), 1)
+        self._jobs: Optional[asyncio.Queue] = None
+        self._max_queue = max(int(max_queue), 1)
+        self._inflight: Dict[str, asyncio.Queue] = {}
+        self._loop = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8765, unix_path: Optional[str] = None):
+        self._loop = asyncio.get_running_loop()
+        self._jobs = asyncio.Queue(maxsize=self._max_queue)
+        for _ in range(self.max_inflight):
+            asyncio.create_task(self._dispatch())
+        threading.Thread(target=self._pump_results, daemon=True).start()
+
+        if unix_path:
+            server = await asyncio.start_unix_server(self._handle, path=unix_path)
+            print(f"Serving on unix:{unix_path}")
+        else:
+            server = await asyncio.start_server(self._handle, host, port)
+            print(f"Serving on http://{host}:{port}")
+        return server
+
+    def _pump_results(self):
+        """
+        Runs on a daemon thread: moves worker output events onto the event loop.
+        """
+        while True:
+            result = self.worker.get_result(block=True)
+            if result is not None:
+                self._loop.call_soon_threadsafe(self._route, result)
+
+    def _route(self, result):
+        events = self._inflight.get(result.get("request_id"))
+        if events is not None:
+            events.put_nowait(result)
+        elif result.get("status") == "error" and not result.get("request_id"):
+            print(f"Server: worker error: {result.get('error')}")
+
+    async def _dispatch(self):
+        # One dispatcher per in-flight slot: holds a job until its terminal event arrives
+        while True:
+            job = await self._jobs.get()
+            if job["abandoned"]:
+                continue
+            events = asyncio.Queue()
+            request_id = self.worker.submit_task(job["image"], job["question"], rag_enabled=job["rag"],
+                                                 session_id=job["session_id"], crop=job["crop"])
+            self._inflight[request_id] = events
+            job["started"].set_result((request_id, events))
+            try:
+                await job["done"]
+            finally:
+                self._inflight.pop(request_id, None)
+
+    async def _load_image(self, body):
+        if body.get("image"):
+            from PIL import Image
+            data = base64.b64decode(body["image"])
+            return Image.open(io.BytesIO(data)).convert("RGB")
+        if body.get("image_path"):
+            from PIL import Image
+            return Image.open(body["image_path"]).convert("RGB")
+        if body.get("session_id") and not body.get("capture"):
+            # Follow-up: the worker reuses the session's screenshot, or answers
+            # "no_screenshot" and _ask captures one after all
+            return None
+        from .capture import capture_frame
+        return await self._loop.run_in_executor(None, capture_frame, body.get("monitor"))
+
+    async def _wait(self, awaitable, timeout: float, hangup):
+        """
+        Await awaitable for up to timeout seconds, watching the hangup task
+        (a pending read on the request stream). Raises asyncio.TimeoutError,
+        or ConnectionResetError if the client closed the connection first.
+        """
+        task = asyncio.ensure_future(awaitable)
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                watch = {task}
+                if not hangup.done():
+                    watch.add(hangup)
+                done, _ = await asyncio.wait(watch, timeout=max(deadline - time.monotonic(), 0.001),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if task in done:
+                    return task.result()
+                if hangup in done:
+                    # EOF (or a reset) means the client is gone; stray bytes are just ignored
+                    if hangup.exception() is not None or hangup.result() == b"":
+                        raise ConnectionResetError("client disconnected")
+                    continue
+                raise asyncio.TimeoutError()
+        finally:
+            # Only cancel what was created here; job futures belong to the dispatcher
+            if task is not awaitable and not task.done():
+                task.cancel()
+
+    def _enqueue(self, body, question: str, image) -> dict:
+        job = {
+            "question": question,
+            "image": image,
+            "rag": bool(body.get("rag", False)),
+            "session_id": body.get("session_id"),
+            "crop": body.get("crop"),
+            "abandoned": False,
+            "started": self._loop.create_future(),
+            "done": self._loop.create_future(),
+        }
+        try:
+            self._jobs.put_nowait(job)
+        except asyncio.QueueFull:
+            raise HTTPError(503, "Server busy, try again later")
+        return job
+
+    async def _ask(self, body, reader, writer):
+        question = body.get("question")
+        if not question or not isinstance(question, str):
+            raise HTTPError(400, "'question' is required")
+        timeout = float(body.get("timeout", self.timeout))
+        try:
+            image = await self._load_image(body)
+        except Exception as e:
+            raise HTTPError(400, f"Could not load image: {e}")
+        job = self._enqueue(body, question, image)
+
+        deadline = time.monotonic() + timeout
+        request_id = None
+        stream = bool(body.get("stream", False))
+        chunked = False
+        # Nothing more is expected on the request stream, so a finished read means the client hung up
+        hangup = asyncio.ensure_future(reader.read(1))
+        try:
+            while True:
+                try:
+                    request_id, events = await self._wait(job["started"], max(deadline - time.monotonic(), 0.001),
+                                                          hangup)
+                except asyncio.TimeoutError:
+                    job["abandoned"] = True
+                    raise HTTPError(504, "Timed out waiting in queue")
+
+                if stream and not chunked:
+                    await self._start_chunked(writer)
+                    chunked = True
+                while True:
+                    remaining = deadline - time.monotonic()
+                    try:
+                        event = await self._wait(events.get(), max(remaining, 0.001), hangup)
+                    except asyncio.TimeoutError:
+                        self.worker.cancel(request_id)
+                        if stream:
+                            await self._write_chunk(writer, {"status": "error", "request_id": request_id,
+                                                             "error": "timeout"})
+                            await self._end_chunked(writer)
+                            return None
+                        raise HTTPError(504, "Timed out generating answer")
+
+                    if event.get("code") == "no_screenshot" and job["image"] is None:
+                        break
+                    if stream:
+                        await self._write_chunk(writer, event)
+                    if event.get("status") in ("success", "error", "cancelled"):
+                        break
+
+                if event.get("code") != "no_screenshot" or job["image"] is not None:
+                    break
+                # The worker doesn't hold this session's screen (new, evicted or restarted): capture and ask again
+                job["done"].set_result(None)
+                try:
+                    image = await self._load_image(dict(body, capture=True))
+                except Exception as e:
+                    if stream:
+                        await self._write_chunk(writer, {"status": "error", "request_id": request_id,
+                                                         "error": f"Could not capture screen: {e}"})
+                        await self._end_chunked(writer)
+                        return None
+                    raise HTTPError(500, f"Could not capture screen: {e}")
+                job = self._enqueue(body, question, image)
+                request_id = None
+
+            if stream:
+                await self._end_chunked(writer)
+                return None
+            if event["status"] != "success":
+                raise HTTPError(500, event.get("error") or event["status"])
+            return {"request_id": request_id, "response": event["response"], "timings": event.get("timings")}
+        except (ConnectionError, asyncio.CancelledError):
+            # client went away, don't keep generating for nobody
+            if request_id:
+                self.worker.cancel(request_id)
+            else:
+                job["abandoned"] = True
+            raise
+        finally:
+            hangup.cancel()
+            if not job["done"].done():
+                job["done"].set_result(None)
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            length = int(headers.get("content-length", 0))
+            if length > MAX_BODY:
+                raise HTTPError(413, "Request body too large")
+            raw = await reader.readexactly(length) if length else b""
+
+            if path == "/health":
+                if method != "GET":
+                    raise HTTPError(405, "Use GET")
+                await self._respond(writer, 200, {
+                    "loaded": self.worker.is_loaded(),
+                    "queued": self._jobs.qsize(),
+                    "inflight": len(self._inflight),
+                })
+            elif path == "/metrics":
+                if method != "GET":
+                    raise HTTPError(405, "Use GET")
+                snapshot = await self._loop.run_in_executor(None, self.worker.metrics)
+                await self._respond(writer, 200, snapshot)
+            elif path == "/ask":
+                if method != "POST":
+                    raise HTTPError(405, "Use POST")
+                try:
+                    body = json.loads(raw or b"{}")
+                except ValueError:
+                    raise HTTPError(400, "Body must be JSON")
+                result = await self._ask(body, reader, writer)
+                if result is not None:
+                    await self._respond(writer, 200, result)
+            else:
+                raise HTTPError(404, f"No route for {path}")
+        except HTTPError as e:
+            await self._respond(writer, e.status, {"error": e.message})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            print(f"Server: request failed: {e}")
+            try:
+                await self._respond(writer, 500, {"error": str(e)})
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status: int, payload):
+        data = json.dumps(payload).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + data
+        )
+        await writer.drain()
+
+    async def _start_chunked(self, writer):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+                     b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+
+    async def _write_chunk(self, writer, event):
+        data = (json.dumps(event) + "\n").encode()
+        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        await writer.drain()
+
+    async def _end_chunked(self, writer):
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+def serve(host: str = "127.0.0.1", port: int = 8765, unix_path: Optional[str] = None,
+          max_queue: int = 8, timeout: float = 120.0):
+    """
+    Load the model once and serve questions until interrupted.
+    """
+    from .vlm.process_worker import create_worker
+
+    worker = create_worker()
+    worker.start()
+    max_inflight = max(int(settings.get("batch_max_size", 1)), 1)
+    server = InferenceServer(worker, max_queue=max_queue, max_inflight=max_inflight, timeout=timeout)
+
+    async def main():
+        srv = await server.start(host, port, unix_path)
+        async with srv:
+            await srv.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("Shutting down.")
+    finally:
+        worker.stop()
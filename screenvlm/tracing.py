@@ -0,0 +1,100 @@
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Optional
+
+from .config import settings
+from .perf import percentiles, rss_mb
+
+
+class Tracer:
+    """
+    Records timed spans for each request.
+
+    Every span is appended to a JSONL trace file (if one is configured) and
+    kept in a bounded per-name window for snapshot(), which reports
+    p50/p95/p99 durations per stage.
+    """
+
+    def __init__(self, path: Optional[str] = None, window: int = 1000):
+        self.path = path or None
+        self._window = window
+        self._durations = defaultdict(lambda: deque(maxlen=self._window))
+        self._lock = threading.Lock()
+        self._file = None
+        self._listeners = []
+
+    def _write(self, record: dict):
+        if not self.path:
+            return
+        line = json.dumps(record, default=str)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", buffering=1)
+            self._file.write(line + "\n")
+
+    def record(self, name: str, duration: float, request_id: Optional[str] = None, **attrs):
+        """
+        Record a span that was timed elsewhere (e.g. queue wait).
+        """
+        with self._lock:
+            self._durations[name].append(duration)
+        record = {"span": name, "request_id": request_id, "ts": time.time(), "duration_s": duration}
+        record.update(attrs)
+        self._write(record)
+        for listener in list(self._listeners):
+            listener(record)
+
+    def subscribe(self, listener):
+        """
+        Call listener(record) for every span recorded from now on.
+        """
+        self._listeners.append(listener)
+
+    def merge(self, name: str, duration: float):
+        """
+        Count a span recorded (and written to the trace file) in another process
+        towards this one's snapshot.
+        """
+        with self._lock:
+            self._durations[name].append(duration)
+
+    @contextmanager
+    def span(self, name: str, request_id: Optional[str] = None, **attrs):
+        """
+        Time a block. The yielded dict can be filled with extra attributes
+        (token counts, image size, ...) before the block ends.
+        """
+        rss_before = rss_mb()
+        start = time.perf_counter()
+        error = None
+        try:
+            yield attrs
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            rss_after = rss_mb()
+            if rss_before is not None and rss_after is not None:
+                attrs["rss_mb"] = round(rss_after, 1)
+                attrs["rss_delta_mb"] = round(rss_after - rss_before, 1)
+            if error:
+                attrs["error"] = error
+            self.record(name, duration, request_id, **attrs)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            windows = {name: list(values) for name, values in self._durations.items()}
+        return {name: percentiles(values, qs=(50, 95, 99)) for name, values in windows.items()}
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+tracer = Tracer(settings.get("trace_file"))
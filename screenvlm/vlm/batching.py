@@ -0,0 +1,75 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, List
+
+
+class GenerateBatcher:
+    """
+    Collects generate calls made concurrently by several graph runs and
+    executes them together on one thread.
+
+    The first call opens a collection window of `window` seconds; everything
+    that arrives before it closes (up to max_size calls) is grouped by its
+    group key and each group is passed to run_batch as one list. Callers
+    block until their own result is ready.
+    """
+
+    def __init__(self, run_batch: Callable[[List[Any]], List[Any]], max_size: int = 4, window: float = 0.02):
+        self.run_batch = run_batch
+        self.max_size = max(int(max_size), 1)
+        self.window = max(float(window), 0.0)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        self.batches = 0
+        self.calls = 0
+
+    def submit(self, call: Any, group: Hashable = None) -> Any:
+        future = Future()
+        self._queue.put((group, call, future))
+        return future.result()
+
+    def stop(self):
+        self._queue.put(None)
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # keep the stop sentinel for the main loop
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _loop(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+
+            groups = {}
+            for group, call, future in self._collect(first):
+                groups.setdefault(group, []).append((call, future))
+
+            for items in groups.values():
+                self.batches += 1
+                self.calls += len(items)
+                try:
+                    results = self.run_batch([call for call, _ in items])
+                except Exception as e:
+                    for _, future in items:
+                        future.set_exception(e)
+                    continue
+                for (_, future), result in zip(items, results):
+                    future.set_result(result)
@@ -0,0 +1,94 @@
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Optional
+
+
+def image_key(image) -> str:
+    """
+    Content hash of a PIL image or capture Frame, used to key cached vision inputs.
+    Frames tagged by a ChangeDetector reuse their fingerprint, which is already
+    a full-resolution hash of the buffer (or, with min_change_fraction set,
+    the key of the screen it was judged unchanged from).
+    """
+    fingerprint = getattr(image, "fingerprint", None)
+    if fingerprint:
+        return fingerprint
+
+    h = hashlib.blake2b(digest_size=16)
+    array = getattr(image, "array", None)
+    if array is not None:
+        # capture.Frame: hash the raw buffer in place, no PIL conversion
+        h.update(f"frame:{array.shape}".encode())
+        h.update(array.data if array.flags.c_contiguous else array.tobytes())
+    else:
+        h.update(f"{image.mode}:{image.size[0]}x{image.size[1]}".encode())
+        h.update(image.tobytes())
+    return h.hexdigest()
+
+
+class VisionFeatureCache:
+    """
+    Holds preprocessed image inputs (pixel_values, image token expansion) and
+    projected image features per image key.
+
+    Entries used by an in-flight request are pinned with acquire()/release()
+    and never evicted. Once released, up to max_entries are kept around in LRU
+    order so repeat questions about the same screen skip the vision encoder.
+    max_entries=0 means the cache only lives for the duration of a request.
+    """
+
+    def __init__(self, max_entries: int = 0):
+        self.max_entries = max(0, int(max_entries))
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._pinned = Counter()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, key: str):
+        with self._lock:
+            self._pinned[key] += 1
+
+    def release(self, key: str):
+        with self._lock:
+            self._pinned[key] -= 1
+            if self._pinned[key] <= 0:
+                del self._pinned[key]
+            self._evict()
+
+    def get(self, key: Optional[str]) -> Optional[Dict[str, Any]]:
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: Optional[str], entry: Dict[str, Any]):
+        if key is None:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                if key not in self._pinned:
+                    del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self):
+        # Oldest unpinned entries go first; pinned ones don't count toward the limit
+        unpinned = [k for k in self._entries if k not in self._pinned]
+        excess = len(unpinned) - self.max_entries
+        for key in unpinned[:max(0, excess)]:
+            del self._entries[key]
@@ -0,0 +1,105 @@
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Sequence
+
+import numpy as np
+import torch
+
+
+def prefix_key(token_ids: Sequence[int], image_key: Optional[str] = None) -> str:
+    """
+    Key for a prompt prefix. Image tokens are the same ids for every
+    screenshot, so prefixes that contain them also carry the image key.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.asarray(token_ids, dtype=np.int64).tobytes())
+    if image_key:
+        h.update(b"|" + image_key.encode())
+    return h.hexdigest()
+
+
+def cache_nbytes(cache) -> int:
+    """
+    Bytes held by the key/value tensors of a transformers Cache.
+    """
+    layers = getattr(cache, "layers", None)
+    if layers is not None:
+        tensors = [t for layer in layers for t in (getattr(layer, "keys", None), getattr(layer, "values", None))]
+    else:
+        tensors = list(getattr(cache, "key_cache", [])) + list(getattr(cache, "value_cache", []))
+    return sum(t.numel() * t.element_size() for t in tensors if torch.is_tensor(t))
+
+
+class PrefixKVCache:
+    """
+    Past key/values for prompt prefixes that repeat across generate calls:
+    the static system rules, and the system + context + screenshot part of a
+    prompt so follow-up questions about the same screen only prefill the
+    new question tokens.
+
+    Entries are stored and handed out as copies, because generate() extends
+    the cache it is given in place. Least recently used entries are evicted
+    once the total size goes over max_mb.
+    """
+
+    def __init__(self, max_mb: float = 512):
+        self.max_bytes = int(max(float(max_mb), 0) * 1024 * 1024)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            cache = item[0]
+        return copy.deepcopy(cache)
+
+    def put(self, key: str, cache, copy_cache: bool = True):
+        """
+        Store cache under key. Pass copy_cache=False to hand over a cache the
+        caller won't touch again.
+        """
+        size = cache_nbytes(cache)
+        if not self.enabled or size > self.max_bytes:
+            return
+        stored = copy.deepcopy(cache) if copy_cache else cache
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (stored, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+
+    def discard(self, key: str):
+        with self._lock:
+            item = self._entries.pop(key, None)
+            if item is not None:
+                self._bytes -= item[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
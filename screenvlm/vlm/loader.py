@@ -1,38 +1,164 @@
+import json
+import time
+from datetime import datetime, timezone
+from typing import Optional
 import torch
 from transformers import AutoProcessor, AutoModelForVision2Seq, AutoModelForImageTextToText
 from peft import PeftModel
-from ..config import settings
+from ..config import settings, as_bool
+from ..perf import peak_rss_mb
+from .merge import DTYPES
 import os
 
-def load_model_and_processor():
+def cpu_perf_enabled() -> bool:
     """
-    Load base model, apply adapter if available, and return model + processor.
+    CPU performance mode: device_pref "cpu-fast", or cpu_perf_mode in the config.
+    """
+    return settings["device_pref"] == "cpu-fast" or as_bool(settings.get("cpu_perf_mode", False))
+
+def bf16_supported() -> bool:
+    """
+    Whether this CPU has native bf16 matmuls (AVX512-BF16 / AMX).
+    """
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        return False
+
+def configure_cpu_threads():
+    threads = int(settings.get("cpu_threads", 0) or 0)
+    interop = int(settings.get("cpu_interop_threads", 0) or 0)
+    if threads > 0:
+        torch.set_num_threads(threads)
+    if interop > 0:
+        try:
+            torch.set_interop_threads(interop)
+        except RuntimeError as e:
+            # Only allowed before the first inter-op parallel work
+            print(f"Could not set inter-op threads: {e}")
+    print(f"CPU threads: {torch.get_num_threads()} intra-op, {torch.get_num_interop_threads()} inter-op.")
+
+def optimize_for_cpu(model):
+    """
+    Apply the cpu_precision / cpu_compile settings to a loaded model.
+
+    cpu_precision: "int8" (dynamic int8 quantization of Linear layers),
+    "bf16", "fp32", or "auto" (bf16 if the CPU supports it natively, else int8).
+    Any PEFT adapter is merged first so no LoRA layers run per token.
+    """
+    if isinstance(model, PeftModel):
+        print("Merging adapter into the base weights...")
+        model = model.merge_and_unload()
+    model.eval()
+
+    precision = str(settings.get("cpu_precision", "auto")).lower()
+    if any(isinstance(m, torch.ao.nn.quantized.dynamic.Linear) for m in model.modules()):
+        # int8 merged checkpoint, already quantized
+        precision = "int8"
+    if precision == "auto":
+        precision = "bf16" if bf16_supported() else "int8"
+    if precision == "bf16" and not bf16_supported():
+        print("This CPU has no native bf16 support, bf16 will be emulated and slow.")
+
+    if precision == "bf16":
+        model = model.to(torch.bfloat16)
+    elif precision == "int8":
+        model = model.float()
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    print(f"CPU precision: {precision}.")
+
+    if as_bool(settings.get("cpu_compile", False)):
+        try:
+            # Sequence length and tile count vary per question, so keep shapes dynamic
+            model.forward = torch.compile(model.forward, dynamic=True)
+            print("Model forward compiled with torch.compile.")
+        except Exception as e:
+            print(f"torch.compile unavailable ({e}), running eagerly.")
+    return model
+
+def warm_up(model, processor, device):
+    """
+    Run one tiny generate so the first real question doesn't pay for
+    compilation, kernel selection and allocator growth.
+    """
+    from PIL import Image
+    from .prompt import format_chat_messages
+
+    start = time.perf_counter()
+    prompt = processor.apply_chat_template(format_chat_messages("Describe the screen."), add_generation_prompt=True)
+    inputs = processor(text=prompt, images=[Image.new("RGB", (512, 512))], return_tensors="pt")
+    dtype = next(p.dtype for p in model.parameters() if torch.is_floating_point(p))
+    inputs = {k: v.to(device).to(dtype) if torch.is_floating_point(v) else v.to(device) for k, v in inputs.items()}
+    try:
+        with torch.inference_mode():
+            model.generate(**inputs, max_new_tokens=2)
+        print(f"Warm-up done in {time.perf_counter() - start:.1f}s.")
+    except Exception as e:
+        print(f"Warm-up failed: {e}")
+
+MERGE_METADATA = "screenvlm_merge.json"
+
+def _adapter_files(adapter_dir: str) -> Optional[dict]:
+    """
+    Size and mtime of the adapter's files, so a retrained adapter makes an old merge stale.
+    """
+    if not os.path.isdir(adapter_dir):
+        return None
+    files = {}
+    for name in sorted(os.listdir(adapter_dir)):
+        if name.startswith("adapter_"):
+            st = os.stat(os.path.join(adapter_dir, name))
+            files[name] = [st.st_size, int(st.st_mtime)]
+    return files
+
+def write_merge_metadata(out_dir: str, dtype: str):
+    meta = {
+        "base_model_id": settings["base_model_id"],
+        "adapter_dir": os.path.abspath(settings["adapter_dir"]),
+        "adapter_files": _adapter_files(settings["adapter_dir"]),
+        "dtype": dtype,
+        "created": datetime.now(timezone.utc).isoformat(),
+    }
+    with open(os.path.join(out_dir, MERGE_METADATA), "w") as f:
+        json.dump(meta, f, indent=2)
+
+def find_merged_model() -> Optional[str]:
+    """
+    The merged_dir checkpoint if it was merged from the configured base model
+    and the adapter as it is on disk now, else None.
+    """
+    merged_dir = settings.get("merged_dir")
+    if not merged_dir:
+        return None
+    meta_path = os.path.join(merged_dir, MERGE_METADATA)
+    if not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring merged model at {merged_dir}: unreadable metadata ({e}).")
+        return None
+
+    if meta.get("base_model_id") != settings["base_model_id"]:
+        print(f"Ignoring merged model at {merged_dir}: merged from {meta.get('base_model_id')}.")
+        return None
+    if meta.get("adapter_files") != _adapter_files(settings["adapter_dir"]):
+        print(f"Ignoring merged model at {merged_dir}: the adapter changed since it was merged. "
+              f"Run `screenvlm merge` again.")
+        return None
+    if not any(name.endswith(".safetensors") for name in os.listdir(merged_dir)):
+        return None
+    return merged_dir
+
+def _load_base_with_adapter(base_model_id: str, adapter_dir: str, torch_dtype, device: str):
+    """
+    Base model from the hub cache with the LoRA adapter applied at runtime.
     """
-    base_model_id = settings["base_model_id"]
-    adapter_dir = settings["adapter_dir"]
-    device_pref = settings["device_pref"]
-    
-    # Determine device
-    if device_pref == "auto":
-        if torch.cuda.is_available():
-            device = "cuda"
-        elif torch.backends.mps.is_available():
-            device = "mps"
-        else:
-            device = "cpu"
-    else:
-        device = device_pref
-        
-    print(f"Loading model {base_model_id} on {device}...")
-    
     # Load processor
     processor = AutoProcessor.from_pretrained(base_model_id)
     
     # Load base model
-    # Note: For real usage, user might want 4bit/8bit loading via bitsandbytes
-    # Here we keep it simple with float16 if cuda/mps, else float32
-    torch_dtype = torch.float16 if device in ["cuda", "mps"] else torch.float32
-    
     try:
         model = AutoModelForImageTextToText.from_pretrained(
             base_model_id,
@@ -64,56 +190,162 @@ def load_model_and_processor():
             print(f"Error loading adapter: {e}")
     else:
         print(f"Adapter not found at {adapter_dir}, running base model only.")
+
+    return model, processor
+
+def _load_merged(merged_dir: str, torch_dtype, device: str):
+    """
+    Load a `screenvlm merge` output. safetensors shards are memory-mapped and
+    low_cpu_mem_usage skips the random init, so weights are materialised
+    straight from the mapped files; there are no LoRA layers to inject.
+    """
+    processor = AutoProcessor.from_pretrained(merged_dir, local_files_only=True)
+    with open(os.path.join(merged_dir, MERGE_METADATA)) as f:
+        if json.load(f).get("dtype") == "int8":
+            from .merge import load_int8_checkpoint
+            print("Merged model is int8-quantized.")
+            model = load_int8_checkpoint(merged_dir, device, torch_dtype)
+            return model.to(device), processor
+    model = AutoModelForImageTextToText.from_pretrained(
+        merged_dir,
+        torch_dtype=torch_dtype,
+        local_files_only=True,
+        use_safetensors=True,
+        low_cpu_mem_usage=True,
+        device_map=device if device == "cuda" else None,
+    )
+    if device != "cuda":
+        model.to(device)
+    return model, processor
+
+def load_model_and_processor():
+    """
+    Load the model and return model + processor + device.
+    Prefers an up-to-date `screenvlm merge` output in merged_dir; otherwise
+    loads the base model and applies the adapter if available.
+    """
+    base_model_id = settings["base_model_id"]
+    adapter_dir = settings["adapter_dir"]
+    device_pref = settings["device_pref"]
+    
+    # Determine device
+    perf_mode = cpu_perf_enabled()
+    if device_pref == "cpu-fast":
+        device = "cpu"
+    elif device_pref == "auto":
+        if torch.cuda.is_available():
+            device = "cuda"
+        elif torch.backends.mps.is_available():
+            device = "mps"
+        else:
+            device = "cpu"
+    else:
+        device = device_pref
+        
+    # Note: For real usage, user might want 4bit/8bit loading via bitsandbytes
+    # Here we keep it simple with float16 if cuda/mps, else float32
+    torch_dtype = torch.float16 if device in ["cuda", "mps"] else torch.float32
+
+    started = time.perf_counter()
+    merged_dir = find_merged_model() if as_bool(settings.get("prefer_merged", True)) else None
+    if merged_dir:
+        print(f"Loading merged model {merged_dir} on {device}...")
+        model, processor = _load_merged(merged_dir, torch_dtype, device)
+        source = "merged"
+    else:
+        print(f"Loading model {base_model_id} on {device}...")
+        model, processor = _load_base_with_adapter(base_model_id, adapter_dir, torch_dtype, device)
+        source = "base + adapter"
+    load_seconds = time.perf_counter() - started
+    print(f"Model weights loaded in {load_seconds:.1f}s ({source}).")
+
+    if device == "cpu" and perf_mode:
+        configure_cpu_threads()
+        model = optimize_for_cpu(model)
+    warmup = settings.get("warmup")
+    if as_bool(perf_mode if warmup is None else warmup):
+        warm_up(model, processor, device)
         
     return model, processor, device
 
-def merge_adapter(out_dir: str, dtype: str = "fp16"):
+def _merge_in_memory(base_model_id: str, adapter_dir: str, out_dir: str, dtype: str):
+    """
+    Load base model + adapter through PEFT, merge and save. Needs the whole
+    model in memory; used for adapters the streaming merge can't handle.
+    """
+    # Load base model on CPU
+    torch_dtype = DTYPES[dtype]
+
+    print("Loading base model...")
+    try:
+        model = AutoModelForImageTextToText.from_pretrained(
+            base_model_id,
+            torch_dtype=torch_dtype,
+            device_map="cpu" 
+        )
+    except Exception as e:
+        print(f"AutoModelForVision2Seq failed ({e}), trying specific classes...")
+        try:
+            from transformers import SmolVLMForConditionalGeneration
+            model = SmolVLMForConditionalGeneration.from_pretrained(
+                base_model_id,
+                torch_dtype=torch_dtype,
+                device_map="cpu"
+            )
+        except ImportError:
+            raise e
+
+    print("Loading adapter...")
+    model = PeftModel.from_pretrained(model, adapter_dir)
+
+    print("Merging...")
+    model = model.merge_and_unload()
+
+    print(f"Saving to {out_dir}...")
+    model.save_pretrained(out_dir, safe_serialization=True)
+
+def merge_adapter(out_dir: str, dtype: str = "fp16", shard_mb: int = 512):
     """
     Merge adapter into base model and save to out_dir.
+    dtype "int8" writes an int8-quantized checkpoint the loader can use directly.
     """
+    from transformers import AutoConfig, GenerationConfig
+    from .merge import streaming_merge
+
     base_model_id = settings["base_model_id"]
     adapter_dir = settings["adapter_dir"]
     
     print(f"Merging adapter {adapter_dir} into {base_model_id}...")
+    # Until this merge completes, out_dir must not look like a valid merged model
+    meta_path = os.path.join(out_dir, MERGE_METADATA)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
     
     try:
-        # Load base model (CPU to avoid OOM during merge usually, or GPU if enough)
-        # Using CPU for safety
-        torch_dtype = torch.float16 if dtype == "fp16" else (torch.bfloat16 if dtype == "bf16" else torch.float32)
-        
-        print("Loading base model...")
         try:
-            model = AutoModelForImageTextToText.from_pretrained(
-                base_model_id,
-                torch_dtype=torch_dtype,
-                device_map="cpu" 
-            )
-        except Exception as e:
-            print(f"AutoModelForVision2Seq failed ({e}), trying specific classes...")
+            summary = streaming_merge(base_model_id, adapter_dir, out_dir, dtype, shard_mb)
+            print(f"Merged {summary['merged_modules']} modules into {summary['shards']} shard(s), "
+                  f"{summary['size_mb']:.0f} MiB.")
+            config = AutoConfig.from_pretrained(base_model_id)
+            config.torch_dtype = "float16" if dtype == "int8" else str(DTYPES[dtype]).replace("torch.", "")
+            config.save_pretrained(out_dir)
             try:
-                from transformers import SmolVLMForConditionalGeneration
-                model = SmolVLMForConditionalGeneration.from_pretrained(
-                    base_model_id,
-                    torch_dtype=torch_dtype,
-                    device_map="cpu"
-                )
-            except ImportError:
-                raise e
-        
-        print("Loading adapter...")
-        model = PeftModel.from_pretrained(model, adapter_dir)
-        
-        print("Merging...")
-        model = model.merge_and_unload()
-        
-        print(f"Saving to {out_dir}...")
-        model.save_pretrained(out_dir)
-        
+                GenerationConfig.from_pretrained(base_model_id).save_pretrained(out_dir)
+            except OSError:
+                pass
+        except NotImplementedError as e:
+            if dtype == "int8":
+                raise
+            print(f"Streaming merge not possible ({e}), merging in memory instead.")
+            _merge_in_memory(base_model_id, adapter_dir, out_dir, dtype)
+
         print("Saving processor...")
         processor = AutoProcessor.from_pretrained(base_model_id)
         processor.save_pretrained(out_dir)
+        write_merge_metadata(out_dir, dtype)
         
-        print("Merge complete.")
+        peak = peak_rss_mb()
+        print(f"Merge complete. Peak RSS {peak:.0f} MiB." if peak is not None else "Merge complete.")
         
     except Exception as e:
         print(f"Merge failed: {e}")
@@ -0,0 +1,321 @@
+import json
+import os
+import re
+from typing import Dict, Optional
+
+import torch
+
+from ..perf import peak_rss_mb
+
+DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": torch.float32}
+
+# 2-D weights that are not Linear layers and stay in floating point in int8 exports
+INT8_SKIP = re.compile(r"(embed|embedding|norm|lm_head)", re.IGNORECASE)
+
+CHECKPOINT_FILES = ["*.safetensors", "*.safetensors.index.json", "*.json", "*.txt", "*.model", "*.jinja"]
+
+
+def _base_checkpoint_dir(base_model_id: str) -> str:
+    if os.path.isdir(base_model_id):
+        return base_model_id
+    from huggingface_hub import snapshot_download
+    return snapshot_download(base_model_id, allow_patterns=CHECKPOINT_FILES)
+
+
+def _shard_files(checkpoint_dir: str):
+    index = os.path.join(checkpoint_dir, "model.safetensors.index.json")
+    if os.path.exists(index):
+        with open(index) as f:
+            return sorted(set(json.load(f)["weight_map"].values()))
+    single = os.path.join(checkpoint_dir, "model.safetensors")
+    if os.path.exists(single):
+        return ["model.safetensors"]
+    raise FileNotFoundError(f"No safetensors weights in {checkpoint_dir}")
+
+
+def _load_adapter(adapter_dir: str):
+    with open(os.path.join(adapter_dir, "adapter_config.json")) as f:
+        config = json.load(f)
+    if config.get("peft_type", "LORA") != "LORA":
+        raise NotImplementedError(f"streaming merge supports LoRA/DoRA adapters, not {config.get('peft_type')}")
+
+    weights_path = os.path.join(adapter_dir, "adapter_model.safetensors")
+    if os.path.exists(weights_path):
+        from safetensors.torch import load_file
+        state = load_file(weights_path)
+    else:
+        state = torch.load(os.path.join(adapter_dir, "adapter_model.bin"), map_location="cpu", weights_only=True)
+
+    # module path -> {"A", "B", "magnitude"}; everything else replaces a base tensor outright
+    modules: Dict[str, dict] = {}
+    replacements: Dict[str, torch.Tensor] = {}
+    for key, tensor in state.items():
+        name = key[len("base_model.model."):] if key.startswith("base_model.model.") else key
+        if "lora_embedding_" in name:
+            raise NotImplementedError("streaming merge does not handle LoRA on embeddings")
+        if re.search(r"\.lora_B(\.[^.]+)?\.bias$", name):
+            raise NotImplementedError("streaming merge does not handle LoRA biases (lora_bias=True)")
+        match = re.match(r"(.+)\.(lora_A|lora_B|lora_magnitude_vector)(\.weight)?$", name)
+        if match:
+            part = {"lora_A": "A", "lora_B": "B", "lora_magnitude_vector": "magnitude"}[match.group(2)]
+            modules.setdefault(match.group(1), {})[part] = tensor
+        else:
+            # modules_to_save copies
+            replacements[name.replace(".modules_to_save", "").replace(".original_module", "")] = tensor
+    return config, modules, replacements
+
+
+def _pattern_value(patterns: dict, module: str, default):
+    for pattern, value in (patterns or {}).items():
+        if re.search(rf"(^|\.){pattern}$", module) or module.endswith(pattern):
+            return value
+    return default
+
+
+def _scaling(config: dict, module: str) -> float:
+    r = _pattern_value(config.get("rank_pattern"), module, config["r"])
+    alpha = _pattern_value(config.get("alpha_pattern"), module, config.get("lora_alpha", r))
+    return alpha / (r ** 0.5) if config.get("use_rslora") else alpha / r
+
+
+def _resolve(module: str, base_names) -> Optional[str]:
+    """
+    Checkpoint tensor name for an adapter module's weight. Adapters trained
+    on a differently wrapped model may differ in their leading prefix.
+    """
+    key = module + ".weight"
+    if key in base_names:
+        return key
+    parts = module.split(".")
+    for i in range(1, len(parts)):
+        suffix = ".".join(parts[i:]) + ".weight"
+        candidates = [n for n in base_names if n == suffix or n.endswith("." + suffix)]
+        if len(candidates) == 1:
+            return candidates[0]
+    return None
+
+
+def merged_weight(weight: torch.Tensor, lora: dict, scaling: float, fan_in_fan_out: bool = False) -> torch.Tensor:
+    """
+    W + scaling * B @ A, and for DoRA rescale each output row to the learned magnitude.
+    """
+    if weight.ndim != 2:
+        raise NotImplementedError("streaming merge only handles LoRA on Linear layers")
+    w = weight.to(torch.float32)
+    delta = (lora["B"].to(torch.float32) @ lora["A"].to(torch.float32)) * scaling
+    if fan_in_fan_out:
+        delta = delta.T
+    merged = w + delta
+    if "magnitude" in lora:
+        rows = merged.T if fan_in_fan_out else merged
+        norm = rows.norm(p=2, dim=1, keepdim=True)
+        rows = rows * (lora["magnitude"].to(torch.float32).view(-1, 1) / norm)
+        merged = rows.T if fan_in_fan_out else rows
+    return merged
+
+
+def quantize_int8(weight: torch.Tensor):
+    """
+    Symmetric per-output-channel int8: returns (int8 weight, float32 scale per row).
+    """
+    w = weight.to(torch.float32)
+    scale = w.abs().amax(dim=1).clamp(min=1e-8) / 127.0
+    q = torch.round(w / scale[:, None]).clamp(-127, 127).to(torch.int8)
+    return q, scale
+
+
+class _ShardWriter:
+    def __init__(self, out_dir: str, max_bytes: int):
+        self.out_dir = out_dir
+        self.max_bytes = max_bytes
+        self.pending: Dict[str, torch.Tensor] = {}
+        self.pending_bytes = 0
+        self.files = []
+        self.weight_map = {}
+        self.total_bytes = 0
+
+    def add(self, name: str, tensor: torch.Tensor):
+        tensor = tensor.contiguous()
+        size = tensor.numel() * tensor.element_size()
+        if self.pending and self.pending_bytes + size > self.max_bytes:
+            self.flush()
+        self.pending[name] = tensor
+        self.pending_bytes += size
+
+    def flush(self):
+        if not self.pending:
+            return
+        from safetensors.torch import save_file
+        filename = f"model-{len(self.files) + 1:05d}.safetensors"
+        save_file(self.pending, os.path.join(self.out_dir, filename), metadata={"format": "pt"})
+        for name in self.pending:
+            self.weight_map[name] = filename
+        self.files.append(filename)
+        self.total_bytes += self.pending_bytes
+        self.pending = {}
+        self.pending_bytes = 0
+
+    def finish(self):
+        self.flush()
+        # final names: model-00001-of-0000N.safetensors, like save_pretrained
+        count = len(self.files)
+        renames = {}
+        for i, filename in enumerate(self.files, 1):
+            final = f"model-{i:05d}-of-{count:05d}.safetensors"
+            os.replace(os.path.join(self.out_dir, filename), os.path.join(self.out_dir, final))
+            renames[filename] = final
+        # Weights left by an earlier export to out_dir (other shard count, or a single
+        # model.safetensors) would otherwise be picked up next to the new index
+        for name in os.listdir(self.out_dir):
+            if re.fullmatch(r"model.*\.safetensors", name) and name not in renames.values():
+                os.remove(os.path.join(self.out_dir, name))
+        index = {
+            "metadata": {"total_size": self.total_bytes},
+            "weight_map": {name: renames[f] for name, f in sorted(self.weight_map.items())},
+        }
+        with open(os.path.join(self.out_dir, "model.safetensors.index.json"), "w") as f:
+            json.dump(index, f, indent=2)
+
+
+def streaming_merge(base_model_id: str, adapter_dir: str, out_dir: str, dtype: str = "fp16",
+                    shard_mb: int = 512) -> dict:
+    """
+    Merge a LoRA/DoRA adapter into the base checkpoint one tensor at a time.
+
+    Base shards are memory-mapped, each tensor is merged (if the adapter
+    touches it), cast to dtype and appended to an output shard that is
+    written once it reaches shard_mb. With dtype "int8", Linear weights are
+    stored as per-channel int8 plus a "<name>_scale" tensor and the rest as
+    fp16; the loader turns those into dynamically quantized Linear layers.
+
+    Raises NotImplementedError for adapters this path can't merge.
+    Returns a summary with the peak RSS.
+    """
+    from safetensors import safe_open
+
+    quantize = dtype == "int8"
+    out_dtype = torch.float16 if quantize else DTYPES[dtype]
+    config, modules, replacements = _load_adapter(adapter_dir)
+    fan_in_fan_out = bool(config.get("fan_in_fan_out"))
+
+    checkpoint_dir = _base_checkpoint_dir(base_model_id)
+    shards = _shard_files(checkpoint_dir)
+    base_names = set()
+    for shard in shards:
+        with safe_open(os.path.join(checkpoint_dir, shard), framework="pt") as f:
+            base_names.update(f.keys())
+
+    targets = {}
+    for module, lora in modules.items():
+        if "A" not in lora or "B" not in lora:
+            raise NotImplementedError(f"incomplete LoRA weights for {module}")
+        name = _resolve(module, base_names)
+        if name is None:
+            raise NotImplementedError(f"no base weight found for adapter module {module}")
+        targets[name] = (module, lora)
+    replaced = {}
+    for name, tensor in replacements.items():
+        resolved = name if name in base_names else None
+        if resolved is None and name.endswith(".weight"):
+            resolved = _resolve(name[:-len(".weight")], base_names)
+        if resolved is None:
+            print(f"Merge: skipping adapter tensor {name} (no matching base tensor)")
+            continue
+        replaced[resolved] = tensor
+
+    os.makedirs(out_dir, exist_ok=True)
+    writer = _ShardWriter(out_dir, int(shard_mb) * 1024 * 1024)
+    merged_count = quantized_count = 0
+    for shard in shards:
+        print(f"Merge: {shard}...")
+        with safe_open(os.path.join(checkpoint_dir, shard), framework="pt") as f:
+            for name in f.keys():
+                tensor = replaced.get(name)
+                if tensor is None:
+                    tensor = f.get_tensor(name)
+                if name in targets:
+                    module, lora = targets[name]
+                    tensor = merged_weight(tensor, lora, _scaling(config, module), fan_in_fan_out)
+                    merged_count += 1
+
+                if quantize and tensor.ndim == 2 and name.endswith(".weight") and not INT8_SKIP.search(name):
+                    q, scale = quantize_int8(tensor)
+                    writer.add(name, q)
+                    writer.add(name + "_scale", scale)
+                    quantized_count += 1
+                elif torch.is_floating_point(tensor):
+                    writer.add(name, tensor.to(out_dtype))
+                else:
+                    writer.add(name, tensor)
+                del tensor
+    if merged_count != len(targets):
+        # Before finish(), so no index pointing at the incomplete shards is written
+        raise RuntimeError(f"merged {merged_count} of {len(targets)} adapter modules")
+    writer.finish()
+
+    return {
+        "merged_modules": merged_count,
+        "quantized_weights": quantized_count,
+        "shards": len(writer.files),
+        "size_mb": writer.total_bytes / (1024 * 1024),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def load_int8_checkpoint(model_dir: str, device: str = "cpu", torch_dtype=torch.float32):
+    """
+    Build the model from an int8 export. On CPU, int8 Linear weights become
+    dynamically quantized Linear layers directly (no float copy is kept);
+    elsewhere they are dequantized to torch_dtype.
+    """
+    from safetensors import safe_open
+    from transformers import AutoConfig, AutoModelForImageTextToText
+    from transformers.modeling_utils import no_init_weights
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicLinear
+
+    config = AutoConfig.from_pretrained(model_dir, local_files_only=True)
+    with no_init_weights():
+        model = AutoModelForImageTextToText.from_config(config, torch_dtype=torch_dtype)
+    modules = dict(model.named_modules())
+    params = dict(model.named_parameters())
+    quantized_on_cpu = device == "cpu"
+
+    for shard in _shard_files(model_dir):
+        with safe_open(os.path.join(model_dir, shard), framework="pt") as f:
+            names = set(f.keys())
+            for name in names:
+                if name.endswith("_scale") and name[:-len("_scale")] in names:
+                    continue
+                tensor = f.get_tensor(name)
+                scale = f.get_tensor(name + "_scale") if name + "_scale" in names else None
+                module_name = name.rsplit(".", 1)[0]
+                module = modules.get(module_name)
+
+                if scale is not None and quantized_on_cpu and isinstance(module, torch.nn.Linear):
+                    qweight = torch._make_per_channel_quantized_tensor(
+                        tensor, scale.to(torch.float64), torch.zeros_like(scale, dtype=torch.int64), 0)
+                    qlinear = DynamicLinear(module.in_features, module.out_features, bias_=module.bias is not None,
+                                            dtype=torch.qint8)
+                    bias = module.bias.detach().float() if module.bias is not None else None
+                    qlinear.set_weight_bias(qweight, bias)
+                    parent_name, _, child = module_name.rpartition(".")
+                    setattr(modules[parent_name] if parent_name else model, child, qlinear)
+                    modules[module_name] = qlinear
+                    continue
+                if scale is not None:
+                    tensor = tensor.to(torch.float32) * scale[:, None]
+
+                target = params.get(name)
+                if target is None:
+                    print(f"Loader: unexpected tensor {name} in {shard}, skipped")
+                    continue
+                with torch.no_grad():
+                    target.copy_(tensor.to(target.dtype))
+
+    # Bias tensors may come after their weight was already swapped into a quantized layer
+    for name, module in modules.items():
+        if isinstance(module, DynamicLinear) and params.get(name + ".bias") is not None:
+            weight, _ = module._weight_bias()
+            module.set_weight_bias(weight, params[name + ".bias"].detach().float())
+    model.tie_weights()
+    return model.eval()
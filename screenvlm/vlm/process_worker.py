@@ -0,0 +1,334 @@
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+import uuid
+from multiprocessing import shared_memory
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+from ..config import settings
+from ..tracing import tracer
+
+TERMINAL = ("success", "error", "cancelled")
+
+
+def _pin_cpus(cores):
+    if not cores:
+        return
+    try:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+        else:
+            import psutil
+            psutil.Process().cpu_affinity(cores)
+        print(f"Model process: pinned to cores {cores}")
+    except Exception as e:
+        print(f"Model process: could not pin to cores {cores}: {e}")
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13: attaching registers the segment with the resource
+        # tracker, which would unlink it under the parent's feet
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        except Exception:
+            pass
+        return shm
+
+
+def _read_image(payload):
+    """
+    Copy the screenshot out of shared memory and rebuild a Frame or PIL image.
+    """
+    shm = _attach(payload["shm"])
+    try:
+        view = np.ndarray(payload["shape"], dtype=payload["dtype"], buffer=shm.buf)
+        array = view.copy()
+        del view
+    finally:
+        shm.close()
+
+    if payload["kind"] == "frame":
+        from ..capture.session import Frame
+        frame = Frame(array, payload["monitor"], payload["left"], payload["top"])
+        frame.fingerprint = payload.get("fingerprint")
+        return frame
+    return Image.fromarray(array, payload["mode"])
+
+
+def _child_main(commands, events, cores):
+    """
+    Entry point of the model process: runs a regular VLMWorker and relays
+    commands and output events over the two queues.
+    """
+    _pin_cpus(cores)
+    from .worker import VLMWorker
+
+    worker = VLMWorker()
+    worker.start()
+
+    def forward():
+        while True:
+            events.put(worker.get_result(block=True))
+
+    threading.Thread(target=forward, daemon=True).start()
+
+    def announce_loaded():
+        while not worker.is_loaded():
+            if not worker._thread.is_alive():
+                return
+            time.sleep(0.1)
+        events.put({"status": "loaded"})
+
+    threading.Thread(target=announce_loaded, daemon=True).start()
+
+    while True:
+        command = commands.get()
+        kind = command[0]
+        if kind == "submit":
+            payload = command[1]
+            try:
+                image = _read_image(payload) if payload.get("shm") else None
+            except Exception as e:
+                events.put({"status": "error", "request_id": payload["request_id"],
+                            "error": f"Failed to read shared image: {e}"})
+                continue
+            worker.submit_task(image, payload["question"], rag_enabled=payload["rag_enabled"],
+                               supersede=payload.get("supersede", False),
+                               request_id=payload["request_id"], session_id=payload.get("session_id"),
+                               crop=payload.get("crop"))
+        elif kind == "cancel":
+            worker.cancel(command[1])
+        elif kind == "reset_session":
+            worker.reset_session(command[1])
+        elif kind == "prewarm":
+            worker.prewarm()
+        elif kind == "span":
+            tracer.merge(command[1], command[2])
+        elif kind == "metrics":
+            events.put({"status": "metrics", "snapshot": worker.metrics()})
+        elif kind == "stop":
+            break
+
+
+class ProcessVLMWorker:
+    """
+    Same contract as VLMWorker (start / is_loaded / submit_task / cancel /
+    get_result) but the model runs in a separate process, so tokenization,
+    preprocessing and generation don't hold the GUI process's GIL.
+
+    Screenshots are handed over through shared memory rather than pickled.
+    If the model process dies, in-flight requests get an error event and the
+    process is started again.
+    """
+
+    def __init__(self, cpu_affinity=None, max_restarts: int = 3):
+        self._ctx = mp.get_context("spawn")
+        if isinstance(cpu_affinity, str):
+            # from an env var, e.g. "0,1,2,3"
+            cpu_affinity = [c for c in cpu_affinity.split(",") if c.strip()]
+        self._cores = [int(c) for c in (cpu_affinity or [])]
+        self._max_restarts = max_restarts
+        self._restarts = 0
+        self._output_queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._process = None
+        self._commands = None
+        self._events = None
+        self._loaded = False
+        self._stopping = False
+        # request_id -> SharedMemory owned by this side until the request finishes
+        self._segments = {}
+        # every request sent to the model process without a terminal event yet
+        # (follow-ups without an image have no segment)
+        self._inflight = set()
+        self._metrics_replies = queue.Queue()
+
+    def start(self):
+        self._spawn()
+        # Spans timed on this side (screen capture) belong in the model process's metrics too
+        tracer.subscribe(self._forward_span)
+        threading.Thread(target=self._event_loop, daemon=True).start()
+        threading.Thread(target=self._watchdog, daemon=True).start()
+
+    def _spawn(self):
+        self._commands = self._ctx.Queue()
+        self._events = self._ctx.Queue()
+        self._loaded = False
+        self._process = self._ctx.Process(
+            target=_child_main, args=(self._commands, self._events, self._cores), daemon=True
+        )
+        self._process.start()
+        print(f"Worker: Model process started (pid {self._process.pid}).")
+
+    def restart(self):
+        """
+        Kill the model process and start a fresh one. In-flight requests fail.
+        """
+        with self._lock:
+            if self._process is not None and self._process.is_alive():
+                self._process.terminate()
+                self._process.join(timeout=5)
+            self._fail_inflight("Model process restarted")
+            self._spawn()
+
+    def stop(self):
+        self._stopping = True
+        if self._process is not None and self._process.is_alive():
+            self._commands.put(("stop",))
+            self._process.join(timeout=5)
+            if self._process.is_alive():
+                self._process.terminate()
+        with self._lock:
+            for request_id in list(self._segments):
+                self._release(request_id)
+
+    def is_loaded(self):
+        return self._loaded
+
+    def submit_task(self, image, question: str, rag_enabled: bool = False, supersede: bool = False,
+                    session_id: Optional[str] = None, crop=None) -> str:
+        request_id = uuid.uuid4().hex[:12]
+        payload = {
+            "request_id": request_id,
+            "question": question,
+            "rag_enabled": rag_enabled,
+            "supersede": supersede,
+            "session_id": session_id,
+            "crop": crop,
+        }
+        if image is None:
+            # follow-up about the session's screenshot, which the model process already has
+            with self._lock:
+                self._inflight.add(request_id)
+                self._commands.put(("submit", payload))
+            return request_id
+
+        array = getattr(image, "array", None)
+        if array is not None:
+            payload.update({"kind": "frame", "monitor": image.monitor, "left": image.left, "top": image.top,
+                            "fingerprint": image.fingerprint})
+        else:
+            if image.mode not in ("RGB", "RGBA", "L"):
+                image = image.convert("RGB")
+            array = np.asarray(image)
+            payload.update({"kind": "pil", "mode": image.mode})
+
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+        payload.update({
+            "shm": shm.name,
+            "shape": array.shape,
+            "dtype": array.dtype.str,
+        })
+        with self._lock:
+            self._segments[request_id] = shm
+            self._inflight.add(request_id)
+            self._commands.put(("submit", payload))
+        return request_id
+
+    def cancel(self, request_id: Optional[str] = None) -> bool:
+        self._commands.put(("cancel", request_id))
+        return True
+
+    def reset_session(self, session_id: str):
+        self._commands.put(("reset_session", session_id))
+
+    def prewarm(self):
+        self._commands.put(("prewarm",))
+
+    def get_result(self, block=False):
+        try:
+            return self._output_queue.get(block=block)
+        except queue.Empty:
+            return None
+
+    def metrics(self, timeout: float = 2.0) -> dict:
+        """
+        Per-stage latency percentiles, as measured inside the model process
+        (plus the spans forwarded from this one, e.g. capture).
+        """
+        if self._process is None or not self._process.is_alive():
+            return {}
+        self._commands.put(("metrics",))
+        try:
+            return self._metrics_replies.get(timeout=timeout)
+        except queue.Empty:
+            return {}
+
+    def _forward_span(self, record):
+        if self._process is not None and self._process.is_alive():
+            self._commands.put(("span", record["span"], record["duration_s"]))
+
+    def _release(self, request_id):
+        shm = self._segments.pop(request_id, None)
+        if shm is not None:
+            shm.close()
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _fail_inflight(self, reason):
+        for request_id in self._inflight | set(self._segments):
+            self._release(request_id)
+            self._output_queue.put({"status": "error", "request_id": request_id, "error": reason})
+        self._inflight.clear()
+
+    def _event_loop(self):
+        while not self._stopping:
+            try:
+                event = self._events.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                # queue torn down by a restart, the watchdog will swap it
+                time.sleep(0.1)
+                continue
+
+            if event.get("status") == "loaded":
+                self._loaded = True
+                continue
+            if event.get("status") == "metrics":
+                self._metrics_replies.put(event["snapshot"])
+                continue
+            if event.get("status") in TERMINAL and event.get("request_id"):
+                with self._lock:
+                    self._inflight.discard(event["request_id"])
+                    self._release(event["request_id"])
+            self._output_queue.put(event)
+
+    def _watchdog(self):
+        while not self._stopping:
+            time.sleep(1.0)
+            process = self._process
+            if process is None or process.is_alive() or self._stopping:
+                continue
+            print(f"Worker: Model process exited with code {process.exitcode}.")
+            with self._lock:
+                self._fail_inflight(f"Model process died (exit code {process.exitcode})")
+                if self._restarts >= self._max_restarts:
+                    self._output_queue.put({"status": "error", "error": "Model process keeps dying, not restarting."})
+                    self._process = None
+                    return
+                self._restarts += 1
+                self._spawn()
+
+
+def create_worker():
+    """
+    Build the worker selected by the worker_mode setting ("thread" or "process").
+    """
+    if str(settings.get("worker_mode", "thread")).lower() == "process":
+        return ProcessVLMWorker(cpu_affinity=settings.get("worker_cpu_affinity") or None)
+    from .worker import VLMWorker
+    return VLMWorker()
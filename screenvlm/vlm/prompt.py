@@ -23,7 +23,13 @@ def build_prompt(question: str, rag_context: List[Dict[str, Any]] = None) -> str
     full_text = f"{system_instruction}\n{context_str}\nUser: {question}\nAssistant:"
     return full_text
 
-def format_chat_messages(question: str, rag_context=None):
+def format_chat_messages(question: str, rag_context=None, history=None, summary=None):
+    """
+    Chat messages for one answer. history is a list of earlier (question,
+    answer) turns about the same screenshot; the image goes with the first
+    user turn so the prompt prefix stays the same as the conversation grows.
+    summary is a short note about turns that were trimmed from history.
+    """
     system_text = (
         "You are a helpful assistant answering questions about the user's screen.\n"
         "Rules:\n"
@@ -46,11 +52,17 @@ def format_chat_messages(question: str, rag_context=None):
                 )
             system_text += "\nRetrieved context:\n" + "\n".join(ctx_lines)
 
-    return [
-        {"role": "system", "content": [{"type": "text", "text": system_text}]},
-        {"role": "user", "content": [
-            {"type": "image"},
-            {"type": "text", "text": question}
-        ]},
-    ]
+    if summary:
+        system_text += "\n" + summary + "\n"
+
+    messages = [{"role": "system", "content": [{"type": "text", "text": system_text}]}]
+    turns = list(history or []) + [(question, None)]
+    for i, (q, a) in enumerate(turns):
+        content = [{"type": "text", "text": q}]
+        if i == 0:
+            content.insert(0, {"type": "image"})
+        messages.append({"role": "user", "content": content})
+        if a is not None:
+            messages.append({"role": "assistant", "content": [{"type": "text", "text": a}]})
+    return messages
 
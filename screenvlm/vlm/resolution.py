@@ -0,0 +1,155 @@
+import math
+import re
+from typing import Optional, Sequence
+
+import numpy as np
+from PIL import Image
+
+from ..config import settings, as_bool
+
+# Questions that need to read small things on screen get full detail in auto mode
+DETAIL_WORDS = {
+    "read", "text", "say", "says", "written", "write", "number", "numbers", "code", "error", "line",
+    "word", "words", "small", "exact", "exactly", "table", "column", "row", "value", "values",
+    "name", "detail", "details", "quote", "spell", "count", "list", "link", "url", "date",
+}
+
+GLANCE_LONG_EDGE = 768
+
+
+class ResolutionPolicy:
+    """
+    Decides how much of a screenshot the model sees, before the processor
+    runs: an optional crop, a cap on the long edge, and whether the
+    processor splits the image into tiles (each tile costs a full block of
+    visual tokens).
+
+    mode:
+        "full"  - native resolution, processor defaults (the default)
+        "fixed" - always max_long_edge / tiling
+        "auto"  - short, generic questions get one low-resolution tile;
+                  long or reading-type questions get the "fixed" settings
+    """
+
+    def __init__(self, mode: str = "full", max_long_edge: int = 1536, tiling: bool = True,
+                 crop: Optional[Sequence[int]] = None, short_question_words: int = 8):
+        self.mode = mode
+        self.max_long_edge = int(max_long_edge) if max_long_edge else None
+        self.tiling = tiling
+        self.crop = tuple(int(v) for v in crop) if crop else None
+        self.short_question_words = short_question_words
+
+    @classmethod
+    def from_settings(cls) -> "ResolutionPolicy":
+        crop = settings.get("resolution_crop")
+        return cls(
+            mode=str(settings.get("resolution_mode", "full")).lower(),
+            max_long_edge=int(settings.get("resolution_max_long_edge", 1536) or 0),
+            tiling=as_bool(settings.get("resolution_tiling", True)),
+            # "active" is resolved at capture time by the caller, not here
+            crop=crop if isinstance(crop, (list, tuple)) else None,
+        )
+
+    def plan(self, question: str, crop: Optional[Sequence[int]] = None) -> dict:
+        """
+        Settings for one question: {"max_long_edge", "tiling", "crop"}.
+        crop is (left, top, width, height) in screen pixels and overrides the configured one.
+        """
+        crop = tuple(int(v) for v in crop) if crop else self.crop
+        if self.mode == "full":
+            return {"max_long_edge": None, "tiling": None, "crop": crop}
+        if self.mode == "auto":
+            words = re.findall(r"[a-z0-9']+", question.lower())
+            if len(words) <= self.short_question_words and not DETAIL_WORDS.intersection(words):
+                edge = min(GLANCE_LONG_EDGE, self.max_long_edge or GLANCE_LONG_EDGE)
+                return {"max_long_edge": edge, "tiling": False, "crop": crop}
+        return {"max_long_edge": self.max_long_edge, "tiling": self.tiling, "crop": crop}
+
+
+def plan_tag(plan: Optional[dict]) -> str:
+    """
+    Short string identifying a plan, appended to image cache keys.
+    """
+    if not plan:
+        return ""
+    crop = ",".join(str(v) for v in plan["crop"]) if plan.get("crop") else "-"
+    return f"{plan.get('max_long_edge') or 'native'}/{plan.get('tiling')}/{crop}"
+
+
+def processor_kwargs(plan: Optional[dict], image_processor=None) -> dict:
+    """
+    Extra processor arguments for a plan. The Idefics3/SmolVLM processor
+    resizes to its own longest_edge (upscaling small images), so the cap has
+    to be passed on, rounded up to whole vision-encoder tiles.
+    """
+    if not plan:
+        return {}
+    kwargs = {}
+    if plan.get("tiling") is not None:
+        kwargs["do_image_splitting"] = bool(plan["tiling"])
+    edge = plan.get("max_long_edge")
+    if edge:
+        tile = (getattr(image_processor, "max_image_size", None) or {}).get("longest_edge")
+        if tile:
+            edge = max(tile, math.ceil(edge / tile) * tile)
+        kwargs["size"] = {"longest_edge": edge}
+    return kwargs
+
+
+def _box_reduce(array: np.ndarray, factor: int) -> np.ndarray:
+    """
+    Integer-factor box filter over a (H, W, C) uint8 array, vectorized in NumPy.
+    """
+    h = array.shape[0] // factor * factor
+    w = array.shape[1] // factor * factor
+    blocks = array[:h, :w, :3].reshape(h // factor, factor, w // factor, factor, 3)
+    summed = blocks.sum(axis=(1, 3), dtype=np.uint32)
+    return (summed // (factor * factor)).astype(np.uint8)
+
+
+def apply_plan(image, plan: Optional[dict]) -> Image.Image:
+    """
+    Crop and shrink a capture.Frame or PIL image according to plan and
+    return a PIL RGB image. Frames are cropped and box-reduced on the raw
+    BGRA buffer, so the full-resolution frame is never converted.
+    """
+    plan = plan or {}
+    crop = plan.get("crop")
+    edge = plan.get("max_long_edge")
+
+    if hasattr(image, "array"):
+        array = image.array
+        if crop:
+            left, top, width, height = crop
+            # Clamped to the frame; a crop that misses it (e.g. a window on another monitor) is ignored
+            x0 = max(left - image.left, 0)
+            y0 = max(top - image.top, 0)
+            x1 = min(left - image.left + width, array.shape[1])
+            y1 = min(top - image.top + height, array.shape[0])
+            if x1 > x0 and y1 > y0:
+                array = array[y0:y1, x0:x1]
+        factor = int(max(array.shape[0], array.shape[1]) // edge) if edge else 1
+        factor = min(factor, 16)
+        if factor >= 2:
+            reduced = _box_reduce(array, factor)
+            pil = Image.frombuffer("RGB", (reduced.shape[1], reduced.shape[0]), reduced, "raw", "BGR", 0, 1)
+        else:
+            array = np.ascontiguousarray(array)
+            pil = Image.frombuffer("RGB", (array.shape[1], array.shape[0]), array, "raw", "BGRX", 0, 1)
+    else:
+        pil = image if image.mode == "RGB" else image.convert("RGB")
+        if crop:
+            left, top, width, height = crop
+            # Clamped to the image, so nothing outside it is padded in
+            box = (max(left, 0), max(top, 0), min(left + width, pil.width), min(top + height, pil.height))
+            if box[2] > box[0] and box[3] > box[1]:
+                pil = pil.crop(box)
+        factor = min(int(max(pil.size) // edge) if edge else 1, 16)
+        if factor >= 2:
+            pil = pil.reduce(factor)
+
+    if edge and max(pil.size) > edge:
+        scale = edge / max(pil.size)
+        pil = pil.resize((max(round(pil.width * scale), 1), max(round(pil.height * scale), 1)),
+                         Image.BILINEAR, reducing_gap=2.0)
+    return pil
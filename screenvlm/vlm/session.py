@@ -0,0 +1,93 @@
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+# Screens are compared on every 4th pixel, in 64px tiles
+SAMPLE_STEP = 4
+SAMPLE_TILE = 64 // SAMPLE_STEP
+
+
+def screen_sample(image) -> np.ndarray:
+    """
+    Downsampled copy of a capture.Frame or PIL image for change_fraction.
+    """
+    from ..capture.fingerprint import downsample
+    array = getattr(image, "array", None)
+    if array is None:
+        array = np.asarray(image.convert("RGB"))
+    return downsample(array, SAMPLE_STEP)
+
+
+class Session:
+    """
+    One conversation: the screenshot being discussed, the question/answer
+    turns so far, and the token ids behind the key/values the model kept
+    after the last answer (the cache itself lives in the worker's
+    PrefixKVCache under kv_key, so it counts toward the same memory limit).
+
+    History is trimmed oldest-first to a token budget, and set aside when
+    the conversation moves to a substantially different screen; those
+    questions are kept as a one-line note so the model still knows what
+    came up.
+    """
+
+    def __init__(self, session_id: str, max_history_tokens: int = 1024):
+        self.id = session_id
+        self.max_history_tokens = max_history_tokens
+        self.turns: List[Tuple[str, str]] = []
+        self.earlier: List[str] = []
+        self.image = None
+        self.image_key: Optional[str] = None
+        # downsampled copy of the screenshot, to tell a different screen from small changes
+        self.sample = None
+        # token ids covered by the cached key/values, and the screenshot they were computed for
+        self.past_ids: Optional[List[int]] = None
+        self.past_image_key: Optional[str] = None
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    @property
+    def kv_key(self) -> str:
+        return f"session:{self.id}"
+
+    def summary(self) -> Optional[str]:
+        if not self.earlier:
+            return None
+        return "Earlier in this conversation the user asked: " + "; ".join(self.earlier)
+
+    def add_turn(self, question: str, answer: str, count_tokens: Callable[[str], int]):
+        self.turns.append((question, answer))
+        self.last_used = time.monotonic()
+        self.trim(count_tokens)
+
+    def is_new_screen(self, sample: np.ndarray, threshold: float) -> bool:
+        """
+        Whether sample (from screen_sample) differs from the session's screenshot
+        in at least threshold of its tiles.
+        """
+        from ..capture.fingerprint import change_fraction
+        return self.sample is not None and change_fraction(self.sample, sample, SAMPLE_TILE) >= threshold
+
+    def new_screen(self):
+        """
+        The conversation moved on to another screenshot: answers about the
+        old one would mislead the model, so its questions become the note.
+        """
+        self.earlier.extend(q if len(q) <= 80 else q[:77] + "..." for q, _ in self.turns)
+        self.earlier = self.earlier[-5:]
+        self.turns = []
+
+    def trim(self, count_tokens: Callable[[str], int]):
+        """
+        Drop the oldest turns until the rest fit in max_history_tokens.
+        The latest turn is always kept.
+        """
+        sizes = [count_tokens(q) + count_tokens(a) for q, a in self.turns]
+        while len(self.turns) > 1 and sum(sizes) > self.max_history_tokens:
+            question, _ = self.turns.pop(0)
+            sizes.pop(0)
+            self.earlier.append(question if len(question) <= 80 else question[:77] + "...")
+        # the note is only a reminder, keep the last few
+        self.earlier = self.earlier[-5:]
@@ -0,0 +1,115 @@
+import time
+from typing import Callable, Optional
+
+from transformers import TextStreamer
+from transformers.generation.streamers import BaseStreamer
+
+
+class CallbackStreamer(TextStreamer):
+    """
+    TextStreamer that hands decoded text to a callback instead of printing it,
+    and records time-to-first-token / time-to-last-token.
+
+    Times are measured from `started` (a time.perf_counter() value), which
+    callers set to when the request was submitted.
+    """
+
+    def __init__(self, tokenizer, callback: Callable[[str], None], started: Optional[float] = None):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self._callback = callback
+        self.started = started if started is not None else time.perf_counter()
+        self.first_token_at = None
+        self.last_token_at = None
+        self.tokens = 0
+
+    def put(self, value):
+        if self.skip_prompt and self.next_tokens_are_prompt:
+            super().put(value)
+            return
+        now = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        self.last_token_at = now
+        self.tokens += value.numel()
+        super().put(value)
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text:
+            self._callback(text)
+
+    def timings(self) -> dict:
+        if self.first_token_at is None:
+            return {"ttft": None, "ttlt": None, "tokens": 0, "tokens_per_s": None}
+        decode_time = self.last_token_at - self.first_token_at
+        return {
+            "ttft": self.first_token_at - self.started,
+            "ttlt": self.last_token_at - self.started,
+            "tokens": self.tokens,
+            "tokens_per_s": (self.tokens - 1) / decode_time if decode_time > 0 else None,
+        }
+
+
+class BatchStreamer(BaseStreamer):
+    """
+    Fans a batched generate() stream out to one streamer per row.
+    Rows without a streamer are ignored, and a row stops receiving tokens
+    once it has produced one of stop_ids (the rest is padding).
+    """
+
+    def __init__(self, streamers, stop_ids=()):
+        self.streamers = list(streamers)
+        self.stop_ids = set(stop_ids)
+        self._done = [s is None for s in self.streamers]
+        self._prompt = True
+
+    def put(self, value):
+        if self._prompt:
+            # input_ids (batch, seq): let each row streamer skip its prompt
+            self._prompt = False
+            for streamer, row in zip(self.streamers, value):
+                if streamer is not None:
+                    streamer.put(row)
+            return
+
+        for i, streamer in enumerate(self.streamers):
+            if self._done[i]:
+                continue
+            token = value[i:i + 1]
+            streamer.put(token)
+            if int(token[0]) in self.stop_ids:
+                self._done[i] = True
+
+    def end(self):
+        for streamer in self.streamers:
+            if streamer is not None:
+                streamer.end()
+
+
+class StepTimer(BaseStreamer):
+    """
+    Wraps another streamer (or none) and records when generate() produced
+    its first and last new token, to split a call into prefill and decode.
+    """
+
+    def __init__(self, inner=None):
+        self.inner = inner
+        self.first_token_at = None
+        self.last_token_at = None
+        self.steps = 0
+        self._prompt = True
+
+    def put(self, value):
+        if self._prompt:
+            self._prompt = False
+        else:
+            now = time.perf_counter()
+            if self.first_token_at is None:
+                self.first_token_at = now
+            self.last_token_at = now
+            self.steps += 1
+        if self.inner is not None:
+            self.inner.put(value)
+
+    def end(self):
+        if self.inner is not None:
+            self.inner.end()
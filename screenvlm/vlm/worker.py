@@ -1,14 +1,29 @@
+import gc
 import threading
 import queue
+import inspect
 import time
 import json
 import re
-from typing import Optional, Literal
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Literal, List
 from pydantic import BaseModel, Field
 from PIL import Image
-from .loader import load_model_and_processor
+from .loader import cpu_perf_enabled, load_model_and_processor
 from .prompt import format_chat_messages
+from .cache import VisionFeatureCache, image_key
+from .kv_cache import PrefixKVCache, prefix_key
+from .session import Session, screen_sample
+from .resolution import ResolutionPolicy, apply_plan, plan_tag, processor_kwargs
+from .streaming import CallbackStreamer, BatchStreamer, StepTimer
+from .batching import GenerateBatcher
 import torch
+from transformers import DynamicCache, StoppingCriteria, StoppingCriteriaList
+from ..config import settings
+from ..perf import rss_mb
+from ..tracing import tracer
 from ..rag.retriever import Retriever
 from ..agent_graph import build_graph
 from ddgs import DDGS
@@ -16,8 +31,48 @@ from ddgs import DDGS
 class GradeOutput(BaseModel):
     grade: Literal["lacking", "pass"] = Field(description="The grade of the context relevance. STRICTLY 'lacking' or 'pass'.")
 
+GRADE_LABELS = ("pass", "lacking")
+# The grading prompt is answered up to the grade value, so only the label is left to decide
+GRADE_PREFIX = ' {"grade": "'
+
+class RequestCancelled(Exception):
+    pass
+
+class NoScreenshot(ValueError):
+    """
+    A follow-up without an image for a session that holds no screenshot
+    (never had one, or was evicted). Reported with code "no_screenshot".
+    """
+
+class CancelCriteria(StoppingCriteria):
+    """
+    Stops a generate() row at the next decode step once that request's cancel event is set.
+    One event per batch row.
+    """
+    def __init__(self, events):
+        self._events = list(events)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        flags = [event.is_set() for event in self._events]
+        return torch.tensor(flags, dtype=torch.bool, device=input_ids.device)
+
 class VLMWorker:
-    def __init__(self):
+    def __init__(self, loader=None, retriever=None, web_search=None):
+        """
+        loader, retriever and web_search default to the real model loader,
+        the Chroma retriever and DDGS; the benchmark swaps in local stand-ins.
+        """
+        self._loader = loader or load_model_and_processor
+        self._web_search = web_search or self._ddgs_search
+        self._retriever_override = retriever
+        self._max_new_tokens = int(settings.get("max_new_tokens", 500))
+        # "logits": one prefill, compare next-token scores of the labels
+        # "constrained": decode limited to the GradeOutput JSON
+        # "generate": free-form answer, regex-parsed
+        self._grade_mode = str(settings.get("grade_mode", "logits")).lower()
+        # Mode the last grading actually used (after any fallback)
+        self.grade_mode_used = None
+        self._grade_tokens = None
         self._model = None
         self._processor = None
         self._device = None
@@ -26,21 +81,134 @@ class VLMWorker:
         self._stop_event = threading.Event()
         self._thread = threading.Thread(target=self._run_loop, daemon=True)
         self._loaded = False
+        self.load_seconds = None
         self.retriever = None
         self.app = None
+        self._vision_cache = VisionFeatureCache(int(settings.get("vision_cache_size", 0)))
+        self._vision_encoder_supported = True
+        self._resolution = ResolutionPolicy.from_settings()
+        self._kv_cache = PrefixKVCache(float(settings.get("kv_cache_mb", 512)))
+        self._static_ids = None
+        self._logits_kwargs = None
+        # session_id -> Session, least recently used first
+        self._sessions = OrderedDict()
+        self._sessions_lock = threading.Lock()
+        self._max_sessions = max(int(settings.get("max_sessions", 8)), 1)
+        self._history_tokens = int(settings.get("session_history_tokens", 1024))
+        self._new_screen_fraction = float(settings.get("session_new_screen_fraction", 0.5))
+        # request_id -> cancel event, for queued and in-flight requests
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        # request_id -> per-request context (cancel event, timings) for running graphs
+        self._requests = {}
+
+        # Batching: several graph runs at once, their generate calls share one model.generate
+        self._batch_max_size = max(int(settings.get("batch_max_size", 1)), 1)
+        self._batch_window = float(settings.get("batch_window_ms", 20)) / 1000.0
+        self._batcher = None
+        self._executor = None
+
+        # Idle offload: free the model after idle_offload_minutes without questions (0 = never)
+        self._idle_after = float(settings.get("idle_offload_minutes", 0) or 0) * 60.0
+        self._offload_mode = str(settings.get("offload_mode", "release")).lower()
+        # None, "cpu" (weights parked in pinned host memory), "caches" (only caches freed) or "released"
+        self._offloaded = None
+        self._last_active = time.monotonic()
 
     def start(self):
         self._thread.start()
 
+    def stop(self):
+        self._stop_event.set()
+
     def is_loaded(self):
         return self._loaded
 
-    def submit_task(self, image: Image.Image, question: str, rag_enabled: bool = False):
+    def is_offloaded(self) -> bool:
+        return self._offloaded is not None
+
+    def prewarm(self):
+        """
+        Bring an offloaded model back now (e.g. when the user focuses the
+        input box) so the next question doesn't wait for it.
+        """
+        self._last_active = time.monotonic()
+        if self._offloaded is not None:
+            self._input_queue.put({"kind": "prewarm"})
+
+    def submit_task(self, image: Optional[Image.Image], question: str, rag_enabled: bool = False,
+                    supersede: bool = False, request_id: Optional[str] = None,
+                    session_id: Optional[str] = None, crop=None) -> str:
+        """
+        Queue a question. image can be a PIL image or a capture.Frame.
+        With supersede=True every queued or running request is cancelled first.
+        With a session_id the question is a follow-up in that conversation;
+        image may then be None to keep asking about the session's screenshot.
+        crop is an optional (left, top, width, height) region to look at.
+        Returns the request id used on all output events for this question.
+        """
+        if supersede:
+            self.cancel()
+
+        request_id = request_id or uuid.uuid4().hex[:12]
+        with self._pending_lock:
+            self._pending[request_id] = threading.Event()
         self._input_queue.put({
+            "request_id": request_id,
             "image": image, 
             "question": question, 
-            "rag_enabled": rag_enabled
+            "rag_enabled": rag_enabled,
+            "session_id": session_id,
+            "crop": crop,
+            "submitted_at": time.perf_counter(),
         })
+        return request_id
+
+    def reset_session(self, session_id: str):
+        """
+        Forget a conversation (a "new chat"), including its cached key/values.
+        """
+        with self._sessions_lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._kv_cache.discard(session.kv_key)
+
+    def _session_for(self, session_id: Optional[str]) -> Optional[Session]:
+        if session_id is None:
+            return None
+        with self._sessions_lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = Session(session_id, self._history_tokens)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self._max_sessions:
+                _, evicted = self._sessions.popitem(last=False)
+                self._kv_cache.discard(evicted.kv_key)
+        return session
+
+    def _count_tokens(self, text: str) -> int:
+        return len(self._processor.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def cancel(self, request_id: Optional[str] = None) -> bool:
+        """
+        Cancel one request (or all of them if request_id is None).
+        A running generate() stops within one decode step; queued requests are dropped when dequeued.
+        """
+        with self._pending_lock:
+            if request_id is None:
+                events = list(self._pending.values())
+            else:
+                events = [self._pending[request_id]] if request_id in self._pending else []
+        for event in events:
+            event.set()
+        return bool(events)
+
+    def _request_for(self, state):
+        return self._requests.get(state.get("request_id"))
+
+    def _check_cancelled(self, request):
+        if request is not None and request["cancel"].is_set():
+            raise RequestCancelled(request["id"])
 
     def get_result(self, block=False):
         try:
@@ -48,42 +216,438 @@ class VLMWorker:
         except queue.Empty:
             return None
 
-    def _generate(self, prompt: str, image: Image.Image) -> str:
-        inputs = self._processor(text=prompt, images=[image], return_tensors="pt")
-        
-        # Moving k,v values to device
-        model_dtype = self._model.dtype
-        new_inputs = {}
-        for k, v in inputs.items():
-            v = v.to(self._device)
-            if torch.is_floating_point(v):
-                v = v.to(model_dtype)
-            new_inputs[k] = v
-        
-        generated_ids = self._model.generate(**new_inputs, max_new_tokens=500)
-        
+    def metrics(self) -> dict:
+        """
+        p50/p95/p99 duration per traced stage over recent requests.
+        """
+        return tracer.snapshot()
+
+    def _image_token_id(self):
+        token = getattr(self._processor, "image_token", "<image>")
+        token = getattr(token, "content", token)
+        return self._processor.tokenizer.convert_tokens_to_ids(token)
+
+    def _to_device(self, v):
+        v = v.to(self._device)
+        if torch.is_floating_point(v):
+            v = v.to(self._model.dtype)
+        return v
+
+    def _image_features(self, entry, request_id: Optional[str] = None):
+        """
+        Run the vision encoder + connector once per cached image.
+        Returns None if this transformers/model version doesn't expose get_image_features.
+        """
+        if "image_hidden_states" in entry:
+            return entry["image_hidden_states"]
+        if not self._vision_encoder_supported:
+            return None
+
+        model = self._model
+        if hasattr(model, "get_base_model"):  # PeftModel
+            model = model.get_base_model()
+        encoder = getattr(model, "get_image_features", None)
+        if encoder is None:
+            encoder = getattr(getattr(model, "model", None), "get_image_features", None)
+
+        try:
+            if encoder is None:
+                raise AttributeError("get_image_features not available")
+            with tracer.span("vision_encode", request_id, images=int(entry["pixel_values"].shape[1])), \
+                    torch.inference_mode():
+                features = encoder(entry["pixel_values"], entry.get("pixel_attention_mask"))
+            if not torch.is_tensor(features):
+                raise TypeError(f"unexpected image feature type {type(features).__name__}")
+        except Exception as e:
+            print(f"Worker: Image feature caching disabled ({e}), caching pixel_values only.")
+            self._vision_encoder_supported = False
+            return None
+
+        entry["image_hidden_states"] = features
+        return features
+
+    def _splice_image_tokens(self, prompt: str, entry):
+        """
+        Tokenize prompt text only and splice in the cached image token expansion,
+        so the processor doesn't have to preprocess the image again.
+        """
+        expansion = entry.get("image_tokens")
+        if expansion is None:
+            return None
+        raw = self._processor.tokenizer(prompt)["input_ids"]
+        image_id = self._image_token_id()
+        if raw.count(image_id) != 1:
+            return None
+        i = raw.index(image_id)
+        return raw[:i] + expansion + raw[i + 1:]
+
+    def _build_vision_entry(self, prompt: str, image: Image.Image, request_id: Optional[str] = None,
+                            resolution: Optional[dict] = None):
+        with tracer.span("preprocess", request_id) as span:
+            # Crop/shrink first; a capture.Frame is only converted to PIL here
+            image = apply_plan(image, resolution)
+            span["width"], span["height"] = image.size
+            inputs = self._processor(text=prompt, images=[image], return_tensors="pt",
+                                     **processor_kwargs(resolution, getattr(self._processor, "image_processor", None)))
+            span["tiles"] = int(inputs["pixel_values"].shape[1])
+        input_ids = inputs["input_ids"][0].tolist()
+
+        entry = {"pixel_values": self._to_device(inputs["pixel_values"])}
+        if "pixel_attention_mask" in inputs:
+            entry["pixel_attention_mask"] = self._to_device(inputs["pixel_attention_mask"])
+
+        # Work out which tokens the processor expanded <image> into, so later
+        # prompts for the same image can be tokenized without the processor
+        raw = self._processor.tokenizer(prompt)["input_ids"]
+        image_id = self._image_token_id()
+        if raw.count(image_id) == 1:
+            i = raw.index(image_id)
+            extra = len(input_ids) - len(raw)
+            tail = raw[i + 1:]
+            if input_ids[:i] == raw[:i] and input_ids[len(input_ids) - len(tail):] == tail:
+                entry["image_tokens"] = input_ids[i:i + extra + 1]
+
+        return entry, input_ids
+
+    def _prepare_inputs(self, prompt: str, image: Image.Image, key: Optional[str] = None,
+                        request_id: Optional[str] = None, resolution: Optional[dict] = None):
+        """
+        Build model.generate kwargs, reusing cached image preprocessing and
+        vision features for the same image key.
+        """
+        entry = self._vision_cache.get(key)
+        input_ids = self._splice_image_tokens(prompt, entry) if entry else None
+        if input_ids is None:
+            entry, input_ids = self._build_vision_entry(prompt, image, request_id, resolution)
+            self._vision_cache.put(key, entry)
+
+        ids = torch.tensor([input_ids], device=self._device)
+        new_inputs = {"input_ids": ids, "attention_mask": torch.ones_like(ids)}
+
+        features = self._image_features(entry, request_id)
+        if features is not None:
+            new_inputs["image_hidden_states"] = features
+        else:
+            new_inputs["pixel_values"] = entry["pixel_values"]
+            if "pixel_attention_mask" in entry:
+                new_inputs["pixel_attention_mask"] = entry["pixel_attention_mask"]
+        return new_inputs
+
+    def _stop_ids(self):
+        tokenizer = self._processor.tokenizer
+        stop_ids = {tokenizer.eos_token_id, tokenizer.pad_token_id}
+        eos = getattr(self._model.generation_config, "eos_token_id", None)
+        stop_ids.update(eos if isinstance(eos, list) else [eos])
+        stop_ids.discard(None)
+        return stop_ids
+
+    def _grade_token_ids(self):
+        """
+        Token ids for each grade label: the first token after GRADE_PREFIX (for
+        logit scoring) and the full GradeOutput JSON (for constrained decoding).
+        """
+        if self._grade_tokens is None:
+            tokenizer = self._processor.tokenizer
+            first, full = {}, {}
+            for label in GRADE_LABELS:
+                first[label] = tokenizer(label, add_special_tokens=False)["input_ids"][0]
+                full[label] = tokenizer(json.dumps({"grade": label}), add_special_tokens=False)["input_ids"]
+            if len(set(first.values())) != len(first):
+                raise ValueError("Grade labels share their first token, can't score them from logits")
+            self._grade_tokens = {"first": first, "full": full}
+        return self._grade_tokens
+
+    def _allowed_tokens(self, sequences, prompt_len: int):
+        """
+        prefix_allowed_tokens_fn that only lets generate() spell out one of
+        `sequences` (a token trie walked from the prompt end), then stop.
+        """
+        stop_ids = list(self._stop_ids())
+
+        def allowed(batch_id, input_ids):
+            done = input_ids[prompt_len:].tolist()
+            n = len(done)
+            options = {seq[n] for seq in sequences if len(seq) > n and seq[:n] == done}
+            return list(options) or stop_ids
+        return allowed
+
+    def _static_prefix_len(self, ids, image_start: int) -> int:
+        """
+        Length of the part of ids that is the same for every answer prompt:
+        the chat header and system rules, before any context or image.
+        """
+        if self._static_ids is None:
+            reference = self._processor.apply_chat_template(format_chat_messages(""), add_generation_prompt=True)
+            self._static_ids = self._processor.tokenizer(reference)["input_ids"]
+        n = 0
+        limit = min(len(self._static_ids), image_start)
+        while n < limit and ids[n] == self._static_ids[n]:
+            n += 1
+        # the last shared token may still merge differently with what follows it
+        return max(n - 1, 0)
+
+    def _prefill(self, ids, past=None, features=None, **pixel_inputs):
+        """
+        Run the model over ids, extending past (or a new DynamicCache), and
+        return the cache. With features, image tokens are replaced by the
+        projected image features here rather than inside the model, which
+        only merges images on a fresh cache in some transformers versions.
+        """
+        if self._logits_kwargs is None:
+            base = self._model.get_base_model() if hasattr(self._model, "get_base_model") else self._model
+            params = inspect.signature(base.forward).parameters
+            name = next((n for n in ("logits_to_keep", "num_logits_to_keep") if n in params), None)
+            self._logits_kwargs = {name: 1} if name else {}
+
+        cache = past if past is not None else DynamicCache()
+        ids_t = torch.tensor([ids], device=self._device)
+        mask = torch.ones((1, cache.get_seq_length() + len(ids)), dtype=torch.long, device=self._device)
+        with tracer.span("prefix_prefill", tokens=len(ids), cached=cache.get_seq_length()), torch.inference_mode():
+            if features is not None:
+                embeds = self._model.get_input_embeddings()(ids_t)
+                image_mask = ids_t == self._image_token_id()
+                embeds[image_mask] = features.reshape(-1, embeds.shape[-1]).to(embeds.dtype)
+                self._model(inputs_embeds=embeds, attention_mask=mask, past_key_values=cache, use_cache=True,
+                            **self._logits_kwargs)
+            else:
+                self._model(input_ids=ids_t, attention_mask=mask, past_key_values=cache, use_cache=True,
+                            **self._logits_kwargs, **pixel_inputs)
+        return cache
+
+    def _reuse_prefix(self, row, key: Optional[str]):
+        """
+        Past key/values covering everything up to and including the screenshot
+        for a single-row call, from the prefix cache or prefilled (and stored)
+        on a miss. Returns (cache, cached_len), or (None, 0) if the prompt has
+        nothing worth caching.
+        """
+        ids = row["input_ids"][0].tolist()
+        image_id = self._image_token_id()
+        if key is None or image_id not in ids:
+            return None, 0
+        image_start = ids.index(image_id)
+        image_end = len(ids) - ids[::-1].index(image_id)
+        if image_end >= len(ids):
+            return None, 0
+
+        image_prefix = prefix_key(ids[:image_end], key)
+        past = self._kv_cache.get(image_prefix)
+        if past is not None:
+            return past, image_end
+
+        features = row.get("image_hidden_states")
+        pixel_inputs = {k: row[k] for k in ("pixel_values", "pixel_attention_mask") if k in row}
+        static_end = self._static_prefix_len(ids, image_start) if features is not None else 0
+        past, start = None, 0
+        if static_end >= 16:
+            static_prefix = prefix_key(ids[:static_end])
+            past = self._kv_cache.get(static_prefix)
+            if past is None:
+                past = self._prefill(ids[:static_end])
+                self._kv_cache.put(static_prefix, past)
+            start = static_end
+
+        past = self._prefill(ids[start:image_end], past, features, **({} if features is not None else pixel_inputs))
+        self._kv_cache.put(image_prefix, past)
+        return past, image_end
+
+    def _reuse_session(self, session: Session, row, key: Optional[str]):
+        """
+        Key/values kept from the session's previous answer, cropped to the part
+        this prompt shares with it (the history up to the new question).
+        Returns (None, 0) unless that shared part covers the whole screenshot.
+        """
+        past_ids = session.past_ids
+        if not past_ids or key is None or session.past_image_key != key:
+            return None, 0
+        ids = row["input_ids"][0].tolist()
+        image_id = self._image_token_id()
+        if image_id not in ids:
+            return None, 0
+        image_end = len(ids) - ids[::-1].index(image_id)
+
+        n = 0
+        limit = min(len(ids) - 1, len(past_ids))
+        while n < limit and ids[n] == past_ids[n]:
+            n += 1
+        if n < image_end:
+            return None, 0
+        past = self._kv_cache.get(session.kv_key)
+        if past is None:
+            return None, 0
+        past.crop(n)
+        return past, n
+
+    def _collate(self, batch):
+        """
+        Left-pad a list of single-row generate inputs into one batch.
+        """
+        if len(batch) == 1:
+            return batch[0]
+
+        tokenizer = self._processor.tokenizer
+        pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        max_len = max(b["input_ids"].shape[1] for b in batch)
+        input_ids = torch.full((len(batch), max_len), pad_id, dtype=torch.long, device=self._device)
+        attention_mask = torch.zeros((len(batch), max_len), dtype=torch.long, device=self._device)
+        for i, b in enumerate(batch):
+            length = b["input_ids"].shape[1]
+            input_ids[i, max_len - length:] = b["input_ids"][0]
+            attention_mask[i, max_len - length:] = b["attention_mask"][0]
+        out = {"input_ids": input_ids, "attention_mask": attention_mask}
+
+        if all("image_hidden_states" in b for b in batch):
+            # The model fills image tokens row by row, so features concatenate in row order
+            out["image_hidden_states"] = torch.cat([b["image_hidden_states"] for b in batch], dim=0)
+        elif all("pixel_values" in b for b in batch):
+            # Pad the per-row image count with all-zero images, which the model drops
+            max_imgs = max(b["pixel_values"].shape[1] for b in batch)
+            values, masks = [], []
+            for b in batch:
+                pv = b["pixel_values"]
+                pad = max_imgs - pv.shape[1]
+                values.append(torch.cat([pv, pv.new_zeros((1, pad) + pv.shape[2:])], dim=1) if pad else pv)
+                if "pixel_attention_mask" in b:
+                    pm = b["pixel_attention_mask"]
+                    masks.append(torch.cat([pm, pm.new_zeros((1, pad) + pm.shape[2:])], dim=1) if pad else pm)
+            out["pixel_values"] = torch.cat(values, dim=0)
+            if len(masks) == len(batch):
+                out["pixel_attention_mask"] = torch.cat(masks, dim=0)
+        else:
+            raise ValueError("Cannot batch rows with cached features and rows with pixel_values")
+        return out
+
+    def _generate_batch(self, calls):
+        """
+        Run one model.generate for a list of calls and return their decoded texts
+        (or per-label logits for score calls). Falls back to one call at a time if the rows can't be collated.
+        """
+        request_ids = [c["request"]["id"] if c["request"] else None for c in calls]
+        inputs = [self._prepare_inputs(c["prompt"], c["image"], c["key"], request_id, c.get("resolution"))
+                  for c, request_id in zip(calls, request_ids)]
+        try:
+            batch = self._collate(inputs)
+        except ValueError as e:
+            print(f"Worker: {e}, running {len(calls)} calls one by one.")
+            return [self._generate_batch([c])[0] for c in calls]
+
+        events = [c["request"]["cancel"] if c["request"] else threading.Event() for c in calls]
+        stopping = StoppingCriteriaList([CancelCriteria(events)])
+
+        streamer = None
+        if len(calls) == 1:
+            streamer = calls[0]["streamer"]
+        elif any(c["streamer"] for c in calls):
+            streamer = BatchStreamer([c["streamer"] for c in calls], self._stop_ids())
+
+        rss_before = rss_mb()
+        started = time.perf_counter()
+
+        input_len = batch["input_ids"].shape[1]
+        options = {}
+        cached_len = 0
+        session = calls[0].get("session") if len(calls) == 1 else None
+        if len(calls) == 1 and self._kv_cache.enabled:
+            past = None
+            if session is not None:
+                past, cached_len = self._reuse_session(session, batch, calls[0]["key"])
+            if past is None:
+                past, cached_len = self._reuse_prefix(batch, calls[0]["key"])
+            if past is not None:
+                # The images are already in the cache, only the prompt tail is prefilled
+                batch = {"input_ids": batch["input_ids"], "attention_mask": batch["attention_mask"]}
+                options["past_key_values"] = past
+
+        scored = calls[0].get("score_ids")
+        if scored:
+            # Only the logits after the prompt are needed, i.e. a single prefill. Raw logits,
+            # not scores: those have been through the processors (repetition penalty etc.)
+            options.update(output_logits=True, return_dict_in_generate=True)
+        elif calls[0].get("allowed"):
+            options["prefix_allowed_tokens_fn"] = self._allowed_tokens(calls[0]["allowed"], input_len)
+        if session is not None and self._kv_cache.enabled:
+            # keep the key/values of prompt + answer for the next turn
+            options.update(return_dict_in_generate=True)
+
+        timer = StepTimer(streamer)
+        output = self._model.generate(**batch, max_new_tokens=calls[0]["max_new_tokens"],
+                                      streamer=timer, stopping_criteria=stopping, **options)
+        finished = time.perf_counter()
+        rss_after = rss_mb()
+
+        first = timer.first_token_at or finished
+        memory = {}
+        if rss_before is not None and rss_after is not None:
+            memory = {"rss_mb": round(rss_after, 1), "rss_delta_mb": round(rss_after - rss_before, 1)}
+        for row, request_id in zip(inputs, request_ids):
+            tracer.record("prefill", first - started, request_id, batch_size=len(calls),
+                          input_tokens=int(row["input_ids"].shape[1]), cached_tokens=cached_len, **memory)
+            tracer.record("decode", finished - first, request_id, batch_size=len(calls),
+                          new_tokens=timer.steps)
+
+        if scored:
+            logits = output.logits[0].float()
+            return [{label: float(row[token_id]) for label, token_id in scored.items()} for row in logits]
+
+        sequences = getattr(output, "sequences", output)
+        past = getattr(output, "past_key_values", None)
+        if session is not None and past is not None:
+            with session.lock:
+                session.past_ids = sequences[0, :past.get_seq_length()].tolist()
+                session.past_image_key = calls[0]["key"]
+            self._kv_cache.put(session.kv_key, past, copy_cache=False)
+
         #trim the inputs since model sometimes repeat the prompt
-        if "input_ids" in new_inputs:
-            input_len = new_inputs["input_ids"].shape[1]
-            generated_ids = generated_ids[:, input_len:]
+        generated_ids = sequences[:, input_len:]
+        return self._processor.batch_decode(generated_ids, skip_special_tokens=True)
 
-        generated_texts = self._processor.batch_decode(generated_ids, skip_special_tokens=True)
-        return generated_texts[0]
+    def _generate(self, prompt: str, image: Image.Image, key: Optional[str] = None, streamer=None,
+                  request=None, max_new_tokens: int = 500, **extra):
+        """
+        Run one generate call, batched with concurrent requests when batching is on.
+        extra: score_ids (label -> token id, returns next-token logits per label
+        instead of text), allowed (token sequences the output is limited to),
+        session (a Session whose cached key/values to reuse and update) or
+        resolution (the ResolutionPolicy plan the image is preprocessed with).
+        """
+        self._check_cancelled(request)
+        call = {
+            "prompt": prompt,
+            "image": image,
+            "key": key,
+            "streamer": streamer,
+            "request": request,
+            "max_new_tokens": max_new_tokens,
+            **extra,
+        }
+        if self._batcher is not None:
+            mode = "score" if extra.get("score_ids") else "constrained" if extra.get("allowed") else "generate"
+            response = self._batcher.submit(call, group=(mode, max_new_tokens))
+        else:
+            response = self._generate_batch([call])[0]
+        self._check_cancelled(request)
+        return response
 
     ###Node definitions for agent_graph.py###
 
     def retrieve_node(self, state):
         print(f"Worker: Retrieving context for '{state['question']}'...")
+        self._check_cancelled(self._request_for(state))
         if not self.retriever:
             print("Worker: Retriever not initialized.")
             return {"context": []}
             
         chunks = self.retriever.retrieve(state["question"])
-        print(f"Worker: Found {len(chunks)} chunks.")
+        scores = [c["score"] for c in chunks if c.get("score") is not None]
+        if scores:
+            print(f"Worker: Found {len(chunks)} chunks (top score {max(scores):.2f}).")
+        else:
+            print(f"Worker: Found {len(chunks)} chunks.")
         return {"context": chunks}
 
     def grade_node(self, state):
         print("Worker: Grading context...")
+        self._check_cancelled(self._request_for(state))
         context = state.get("context", [])
         if not context:
             return {"grade": "lacking"}
@@ -116,7 +680,32 @@ Example: {{"grade": "pass"}} or {{"grade": "lacking"}}
             }
         ]
         prompt = self._processor.apply_chat_template(messages, add_generation_prompt=True)
-        response = self._generate(prompt, image)
+        request = self._request_for(state)
+        key = state.get("image_key")
+        resolution = state.get("resolution")
+
+        mode = self._grade_mode
+        if mode in ("logits", "constrained"):
+            try:
+                tokens = self._grade_token_ids()
+            except ValueError as e:
+                print(f"Worker: {e}, falling back to generated grading.")
+                mode = "generate"
+        self.grade_mode_used = mode
+
+        if mode == "logits":
+            scores = self._generate(prompt + GRADE_PREFIX, image, key, request=request,
+                                    max_new_tokens=1, score_ids=tokens["first"], resolution=resolution)
+            grade = max(scores, key=scores.get)
+            print(f"Worker: Grade logits {scores} -> {grade}")
+            return {"grade": grade}
+
+        if mode == "constrained":
+            sequences = list(tokens["full"].values())
+            response = self._generate(prompt, image, key, request=request, resolution=resolution,
+                                      max_new_tokens=max(len(s) for s in sequences) + 1, allowed=sequences)
+        else:
+            response = self._generate(prompt, image, key, request=request, resolution=resolution)
         
         print(f"Worker: Grade response raw: {response}")
         
@@ -148,11 +737,15 @@ Example: {{"grade": "pass"}} or {{"grade": "lacking"}}
 
         return {"grade": grade}
 
+    def _ddgs_search(self, question: str) -> List[dict]:
+        return list(DDGS().text(question, max_results=3))
+
     def web_search_node(self, state):
         print("Worker: Searching web...")
+        self._check_cancelled(self._request_for(state))
         question = state["question"]
         try:
-            results = list(DDGS().text(question, max_results=3))
+            results = self._web_search(question)
             
             # format results
             formatted = ""
@@ -167,6 +760,7 @@ Example: {{"grade": "pass"}} or {{"grade": "lacking"}}
 
     def generate_node(self, state):
         print("Worker: Generating final answer...")
+        self._check_cancelled(self._request_for(state))
         question = state["question"]
         image = state["image"]
         context = state.get("context", [])
@@ -180,64 +774,234 @@ Example: {{"grade": "pass"}} or {{"grade": "lacking"}}
         if web_results:
             ctx_text += "Web Search Results:\n" + web_results + "\n\n"
         
-        messages = format_chat_messages(question, ctx_text if ctx_text else None)
+        session = self._sessions.get(state.get("session_id")) if state.get("session_id") else None
+        history, summary = (list(session.turns), session.summary()) if session else (None, None)
+        messages = format_chat_messages(question, ctx_text if ctx_text else None, history=history, summary=summary)
         prompt = self._processor.apply_chat_template(messages, add_generation_prompt=True)
         
-        response = self._generate(prompt, image)
+        # Stream the final answer to the output queue as it decodes
+        request = self._request_for(state)
+        if request is None:
+            return {"final_response": self._generate(prompt, image, state.get("image_key"),
+                                                     max_new_tokens=self._max_new_tokens, session=session,
+                                                     resolution=state.get("resolution"))}
+        streamer = CallbackStreamer(
+            self._processor.tokenizer,
+            lambda text: self._output_queue.put({"status": "partial", "request_id": request["id"], "text": text}),
+            started=request["submitted_at"],
+        )
+        response = self._generate(prompt, image, state.get("image_key"), streamer=streamer, request=request,
+                                  max_new_tokens=self._max_new_tokens, session=session,
+                                  resolution=state.get("resolution"))
+        request["timings"] = streamer.timings()
         return {"final_response": response}
 
+    def _finish_request(self, request_id: str):
+        with self._pending_lock:
+            self._pending.pop(request_id, None)
+
     def _run_loop(self):
         print("Worker: Initializing model...")
+        started = time.perf_counter()
         
         try:
-            self._model, self._processor, self._device = load_model_and_processor()
+            self._model, self._processor, self._device = self._loader()
         except Exception as e:
             print(f"Worker: Failed to load: {e}")
             import traceback
             traceback.print_exc()
+            self._output_queue.put({"status": "error", "error": f"Failed to load model: {e}"})
             return
         
         try:
-            self.retriever = Retriever()
+            self.retriever = self._retriever_override or Retriever()
             self.app = build_graph(self)
             self._loaded = True
-            print("Worker: Model loaded & Graph built.")
+            self.load_seconds = time.perf_counter() - started
+            tracer.record("startup", self.load_seconds)
+            print(f"Worker: Model loaded & Graph built in {self.load_seconds:.1f}s.")
         except Exception as e:
             print(f"Worker: Failed to load: {e}")
             import traceback
             traceback.print_exc()
+            self._output_queue.put({"status": "error", "error": f"Failed to load: {e}"})
             return
 
+        if self._batch_max_size > 1:
+            print(f"Worker: Batching up to {self._batch_max_size} requests.")
+            self._batcher = GenerateBatcher(self._generate_batch, self._batch_max_size, self._batch_window)
+            self._executor = ThreadPoolExecutor(max_workers=self._batch_max_size)
+
         while not self._stop_event.is_set():
             try:
                 task = self._input_queue.get(timeout=0.5)
             except queue.Empty:
+                self._maybe_offload()
                 continue
 
-            try:
-                print("Worker: Processing task...")
-                # Invoke graph
-                inputs = {
-                    "question": task["question"],
-                    "image": task["image"],
-                    "rag_enabled": task.get("rag_enabled", False),
-                    "context": [],
-                     "grade": "",
-                     "web_results": "",
-                     "final_response": ""
-                }
-                
+            self._last_active = time.monotonic()
+            if self._offloaded is not None:
+                try:
+                    self._rehydrate()
+                except Exception as e:
+                    print(f"Worker: Failed to reload model: {e}")
+                    if task.get("request_id"):
+                        self._finish_request(task["request_id"])
+                        self._output_queue.put({"status": "error", "request_id": task["request_id"],
+                                                "error": f"Failed to reload model: {e}"})
+                    continue
+            if task.get("kind") == "prewarm":
+                continue
+
+            if self._executor is not None:
+                # Graph runs proceed concurrently; their generate calls meet in the batcher
+                self._executor.submit(self._process_task, task)
+            else:
+                self._process_task(task)
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._batcher.stop()
+
+    def _maybe_offload(self):
+        if not self._idle_after or self._offloaded is not None or self._model is None:
+            return
+        if self._pending or self._requests:
+            return
+        if time.monotonic() - self._last_active < self._idle_after:
+            return
+        self._offload()
+
+    def _offload(self):
+        """
+        Free model memory. On CUDA with offload_mode "cpu" the weights move to
+        pinned host memory, which copies back quickly; otherwise the model is
+        dropped and reloaded by the loader (fast from a memory-mapped merged
+        checkpoint). In CPU performance mode the model is kept: reloading would
+        redo quantization, torch.compile and warm-up on the next question.
+        Cached image features and KV caches go either way.
+        """
+        with tracer.span("offload", mode=self._offload_mode, device=self._device):
+            self._vision_cache.clear()
+            self._kv_cache.clear()
+            if self._offload_mode == "cpu" and str(self._device).startswith("cuda"):
+                self._model.to("cpu")
+                for param in self._model.parameters():
+                    param.data = param.data.pin_memory()
+                self._offloaded = "cpu"
+            elif self._device == "cpu" and cpu_perf_enabled():
+                self._offloaded = "caches"
+            else:
+                self._model = None
+                self._offloaded = "released"
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        print(f"Worker: Idle for {self._idle_after / 60:.0f} min, model offloaded ({self._offloaded}).")
+
+    def _rehydrate(self):
+        start = time.perf_counter()
+        with tracer.span("rehydrate", mode=self._offloaded):
+            if self._offloaded == "cpu":
+                self._model.to(self._device, non_blocking=True)
+            elif self._offloaded == "released":
+                self._model, self._processor, self._device = self._loader()
+            self._offloaded = None
+        self._last_active = time.monotonic()
+        print(f"Worker: Model restored in {time.perf_counter() - start:.1f}s.")
+
+    def _process_task(self, task):
+        request_id = task["request_id"]
+        with self._pending_lock:
+            cancel_event = self._pending.get(request_id) or threading.Event()
+        if cancel_event.is_set():
+            # Superseded or cancelled while still queued
+            print(f"Worker: Skipping cancelled request {request_id}.")
+            self._finish_request(request_id)
+            self._output_queue.put({"status": "cancelled", "request_id": request_id})
+            return
+
+        key = None
+        request = {
+            "id": request_id,
+            "cancel": cancel_event,
+            "submitted_at": task.get("submitted_at", time.perf_counter()),
+        }
+        tracer.record("queue_wait", time.perf_counter() - request["submitted_at"], request_id)
+        self._requests[request_id] = request
+        try:
+            print(f"Worker: Processing task {request_id}...")
+            session = self._session_for(task.get("session_id"))
+            image = task["image"]
+            if image is None:
+                if session is None or session.image is None:
+                    raise NoScreenshot("No screenshot given and no earlier screenshot in this session")
+                image = session.image
+            resolution = self._resolution.plan(task["question"], task.get("crop"))
+            # The same screenshot preprocessed differently is a different cache entry
+            content_key = image_key(image)
+            key = content_key + "|" + plan_tag(resolution)
+            sample = None
+            if session is not None and not (session.image_key or "").startswith(content_key + "|"):
+                # Small changes (clock, cursor) keep the history; only the cached key/values
+                # are tied to the exact screenshot
+                sample = screen_sample(image)
+                with session.lock:
+                    if session.is_new_screen(sample, self._new_screen_fraction):
+                        session.new_screen()
+            self._vision_cache.acquire(key)
+            # Invoke graph
+            inputs = {
+                "request_id": request_id,
+                "session_id": session.id if session else None,
+                "question": task["question"],
+                "image": image,
+                "image_key": key,
+                "resolution": resolution,
+                "rag_enabled": task.get("rag_enabled", False),
+                "context": [],
+                 "grade": "",
+                 "web_results": "",
+                 "final_response": ""
+            }
+            
+            with tracer.span("request", request_id, rag_enabled=inputs["rag_enabled"]):
                 result = self.app.invoke(inputs)
-                
-                response_text = result.get("final_response", "")
-                if not response_text and "grade" in result:
-                     response_text = f"Error: No final response generates. Grade: {result['grade']}"
-                
-                self._output_queue.put({"status": "success", "response": response_text})
+            
+            response_text = result.get("final_response", "")
+            if not response_text and "grade" in result:
+                 response_text = f"Error: No final response generates. Grade: {result['grade']}"
+            
+            if session is not None:
+                with session.lock:
+                    session.image, session.image_key = image, key
+                    if sample is not None:
+                        session.sample = sample
+                    session.add_turn(task["question"], response_text, self._count_tokens)
+
+            timings = request.get("timings")
+            self._output_queue.put({"status": "success", "request_id": request_id,
+                                    "response": response_text, "timings": timings})
+            if timings and timings["ttft"] is not None:
+                print(f"Worker: Task complete. TTFT {timings['ttft']:.2f}s, TTLT {timings['ttlt']:.2f}s, {timings['tokens']} tokens.")
+            else:
                 print("Worker: Task complete.")
 
-            except Exception as e:
-                print(f"Worker: Task failed: {e}")
-                import traceback
-                traceback.print_exc()
-                self._output_queue.put({"status": "error", "error": str(e)})
+        except RequestCancelled:
+            print(f"Worker: Request {request_id} cancelled.")
+            self._output_queue.put({"status": "cancelled", "request_id": request_id})
+        except NoScreenshot as e:
+            # The caller can capture a screenshot and ask again
+            print(f"Worker: Task {request_id} has no screenshot.")
+            self._output_queue.put({"status": "error", "request_id": request_id, "error": str(e),
+                                    "code": "no_screenshot"})
+        except Exception as e:
+            print(f"Worker: Task failed: {e}")
+            import traceback
+            traceback.print_exc()
+            self._output_queue.put({"status": "error", "request_id": request_id, "error": str(e)})
+        finally:
+            self._requests.pop(request_id, None)
+            self._finish_request(request_id)
+            if key is not None:
+                self._vision_cache.release(key)